@@ -179,6 +179,105 @@ EMAIL_TIMEOUT = 30
 # -------------------------------------------------------------------
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY', 'your_default_encryption_key_change_this_in_production')
 
+# -------------------------------------------------------------------
+# CHAT CONFIGURATION
+# -------------------------------------------------------------------
+# Ciphertext format for new chat data: "room" (binary envelope under each room's
+# own data key), "gcm" (binary envelope under the global key) or "cbc" (legacy
+# base64 text). Legacy messages are rewritten when read (CHAT_REENCRYPT_ON_READ)
+# or by: python manage.py reencrypt_messages
+CHAT_ENCRYPTION_FORMAT = os.getenv('CHAT_ENCRYPTION_FORMAT', 'room')
+
+# Room data keys are wrapped under ENCRYPTION_KEY. To change ENCRYPTION_KEY, first
+# move all messages to room keys (python manage.py rotate_chat_keys), then set the
+# new key, list the old one in ENCRYPTION_KEY_PREVIOUS and run
+# python manage.py rotate_chat_keys --rewrap-only. Set CHAT_SEARCH_KEY beforehand,
+# or rebuild the search index afterwards.
+ENCRYPTION_KEY_PREVIOUS = [key for key in os.getenv('ENCRYPTION_KEY_PREVIOUS', '').split(',') if key]
+# Unwrapped room keys cached per process (entries, seconds)
+CHAT_ROOM_KEY_CACHE_SIZE = int(os.getenv('CHAT_ROOM_KEY_CACHE_SIZE', '10000'))
+CHAT_ROOM_KEY_CACHE_TTL = int(os.getenv('CHAT_ROOM_KEY_CACHE_TTL', '300'))
+CHAT_REENCRYPT_ON_READ = os.getenv('CHAT_REENCRYPT_ON_READ', 'True').lower() == 'true'
+
+# Messages of at least CHAT_COMPRESS_THRESHOLD UTF-8 bytes are zlib-compressed before
+# encryption (0 disables). Run python manage.py chat_storage_report to see the savings
+CHAT_COMPRESS_THRESHOLD = int(os.getenv('CHAT_COMPRESS_THRESHOLD', '256'))
+CHAT_COMPRESS_LEVEL = int(os.getenv('CHAT_COMPRESS_LEVEL', '6'))
+
+# In-process LRU cache of decrypted message text, bounded by total bytes per process.
+# Set to 0 to never keep decrypted plaintext in memory
+CHAT_DECRYPT_CACHE_BYTES = int(os.getenv('CHAT_DECRYPT_CACHE_BYTES', str(16 * 1024 * 1024)))
+
+# Threads used to decrypt large message batches (history pages, exports); 0 = CPU count
+CHAT_DECRYPT_WORKERS = int(os.getenv('CHAT_DECRYPT_WORKERS', '0'))
+
+# JSON codec for WebSocket frames: 'orjson', 'json' (standard library) or 'auto' (orjson when installed)
+CHAT_JSON_CODEC = os.getenv('CHAT_JSON_CODEC', 'auto')
+# Offer the binary 'msgpack' WebSocket sub-protocol (needs the msgpack package, installed
+# with channels-redis); clients that do not ask for it keep JSON text frames
+CHAT_MSGPACK = os.getenv('CHAT_MSGPACK', 'True').lower() == 'true'
+
+# Coalesce bursts of outgoing chat messages into one {"type": "batch"} WebSocket frame per
+# connection: hold frames up to CHAT_COALESCE_WINDOW_MS, or until CHAT_COALESCE_MAX_MESSAGES
+# frames / CHAT_COALESCE_MAX_BYTES are waiting. 0 disables; only clients connecting with
+# ?batch=1 are coalesced
+CHAT_COALESCE_WINDOW_MS = int(os.getenv('CHAT_COALESCE_WINDOW_MS', '0'))
+CHAT_COALESCE_MAX_MESSAGES = int(os.getenv('CHAT_COALESCE_MAX_MESSAGES', '50'))
+CHAT_COALESCE_MAX_BYTES = int(os.getenv('CHAT_COALESCE_MAX_BYTES', str(64 * 1024)))
+
+# Room message streams one per-user socket (ws/user/) may join at once
+CHAT_USER_MAX_STREAMS = int(os.getenv('CHAT_USER_MAX_STREAMS', '10'))
+
+# Who is online, fed by WebSocket connects, disconnects and heartbeats. "redis" shares it
+# between ASGI processes (default when REDIS_URL is set), "memory" keeps it per process.
+# Connections not heard from for CHAT_PRESENCE_TTL seconds expire (checked every
+# CHAT_PRESENCE_TICK seconds); clients send a heartbeat every CHAT_PRESENCE_HEARTBEAT seconds
+CHAT_PRESENCE_BACKEND = os.getenv('CHAT_PRESENCE_BACKEND', 'redis' if REDIS_URL else 'memory')
+CHAT_PRESENCE_TTL = int(os.getenv('CHAT_PRESENCE_TTL', '60'))
+CHAT_PRESENCE_TICK = float(os.getenv('CHAT_PRESENCE_TICK', '1'))
+CHAT_PRESENCE_HEARTBEAT = int(os.getenv('CHAT_PRESENCE_HEARTBEAT', '20'))
+
+# Write concern for chat message inserts, e.g. "1", "majority" or "0" (fire-and-forget)
+# Empty uses the MongoDB connection default
+CHAT_WRITE_CONCERN = os.getenv('CHAT_WRITE_CONCERN', '')
+CHAT_MESSAGE_WRITE_CONCERN = (
+    {'w': int(CHAT_WRITE_CONCERN) if CHAT_WRITE_CONCERN.isdigit() else CHAT_WRITE_CONCERN}
+    if CHAT_WRITE_CONCERN else {}
+)
+
+# Message storage: "documents" (one document per message) or "buckets"
+# (up to CHAT_BUCKET_SIZE messages per room bucket document).
+# Switch existing data with: python manage.py migrate_message_storage --to <mode>
+CHAT_MESSAGE_STORAGE = os.getenv('CHAT_MESSAGE_STORAGE', 'documents')
+CHAT_BUCKET_SIZE = int(os.getenv('CHAT_BUCKET_SIZE', '200'))
+
+# Messages older than this many days are moved to compressed cold storage
+# by: python manage.py archive_messages (the "archiver" docker-compose service)
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '90'))
+
+# Blind keyword index for per-room message search (HMAC tokens of message words).
+# CHAT_SEARCH_KEY defaults to a key derived from ENCRYPTION_KEY.
+# Index existing messages with: python manage.py backfill_search_index
+CHAT_SEARCH_INDEX = os.getenv('CHAT_SEARCH_INDEX', 'True').lower() == 'true'
+CHAT_SEARCH_KEY = os.getenv('CHAT_SEARCH_KEY', '')
+
+# Deleted rooms are purged in the background by: python manage.py purge_deleted_chats
+# (messages removed per batch, and the pause between batches to limit database load)
+CHAT_PURGE_BATCH_SIZE = int(os.getenv('CHAT_PURGE_BATCH_SIZE', '500'))
+CHAT_PURGE_PAUSE_MS = int(os.getenv('CHAT_PURGE_PAUSE_MS', '100'))
+
+# Native asyncio (motor) MongoDB access for the WebSocket consumer
+CHAT_ASYNC_MONGO = os.getenv('CHAT_ASYNC_MONGO', 'False').lower() == 'true'
+
+# Write-behind: broadcast WebSocket messages immediately and store them in batches
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', 'False').lower() == 'true'
+CHAT_WRITE_BEHIND_INTERVAL_MS = int(os.getenv('CHAT_WRITE_BEHIND_INTERVAL_MS', '50'))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CHAT_WRITE_BEHIND_BATCH_SIZE', '200'))
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.getenv('CHAT_WRITE_BEHIND_MAX_PENDING', '10000'))
+# Failed flushes back off exponentially; messages still failing after this many
+# attempts are moved to the chat_message_dead_letters collection
+CHAT_WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv('CHAT_WRITE_BEHIND_MAX_ATTEMPTS', '8'))
+
 # -------------------------------------------------------------------
 # GOOGLE OAUTH CONFIGURATION
 # -------------------------------------------------------------------
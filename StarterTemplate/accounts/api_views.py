@@ -5,6 +5,8 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.pagination import PageNumberPagination
 from django.contrib.auth import authenticate, login, logout
 from .models import User
+from chat.models import ChatRoomDeletion
+from chat.consumers import notify_room_deleted
 from .serializers import (
     UserSerializer,
     UserRegistrationSerializer,
@@ -230,6 +232,10 @@ def api_delete_account(request):
         # Logout before deleting
         logout(request)
         
+        # Delete the user's chats (messages are purged in the background)
+        for room_id, participant_ids in ChatRoomDeletion.schedule_for_user(user).items():
+            notify_room_deleted(room_id, participant_ids)
+        
         # Delete user
         user.delete()
         
@@ -0,0 +1,79 @@
+"""
+Native asyncio data access for the WebSocket consumer (enabled with CHAT_ASYNC_MONGO).
+Uses motor directly on the event loop instead of handing every query to the
+database_sync_to_async thread pool. Documents are still built and encoded by
+the MongoEngine models, so both paths store identical data
+"""
+import asyncio
+import weakref
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .models import (
+    ChatRoom, Message, MessageBucket, MessageSearchIndex,
+    bucket_storage_enabled, cache_plaintexts, search_index_enabled, with_message_write_concern
+)
+
+
+class AsyncChatStore:
+    """
+    Motor-backed reads and writes for ChatRoom and Message
+    """
+
+    def __init__(self, uri):
+        try:
+            from motor.motor_asyncio import AsyncIOMotorClient
+        except ImportError as e:
+            raise ImproperlyConfigured('CHAT_ASYNC_MONGO requires the motor package') from e
+
+        self.client = AsyncIOMotorClient(uri)
+        self.db = self.client.get_default_database()
+        self.rooms = self.db[ChatRoom._get_collection_name()]
+        self.messages = with_message_write_concern(self.db[Message._get_collection_name()])
+        self.buckets = with_message_write_concern(self.db[MessageBucket._get_collection_name()])
+        self.search = self.db[MessageSearchIndex._get_collection_name()]
+
+    async def get_room(self, room_id):
+        """
+        Load a chat room (participants are left as references), or None
+        """
+        try:
+            doc = await self.rooms.find_one({'_id': ObjectId(room_id)})
+        except (InvalidId, TypeError):
+            return None
+        return ChatRoom._from_son(doc) if doc else None
+
+    async def create_message(self, room, sender_id, content):
+        """
+        Store a new encrypted message and update the room summary:
+        one insert plus one atomic $set/$inc, same as Message.create_message
+        """
+        message = Message.build_message(room=room, sender=ObjectId(str(sender_id)), content=content)
+        if bucket_storage_enabled():
+            for query, update in MessageBucket.append_operations(room.id, [message]):
+                await self.buckets.update_one(query, update, upsert=True)
+        else:
+            await self.messages.insert_one(message.to_mongo())
+        await self.rooms.update_one({'_id': room.id}, room.summary_update([message]))
+        cache_plaintexts([message])
+        if search_index_enabled():
+            entries = MessageSearchIndex.entries_for([message])
+            if entries:
+                await self.search.insert_one(entries[0])
+        return message
+
+
+_stores = weakref.WeakKeyDictionary()
+
+
+def get_async_store():
+    """
+    Get the AsyncChatStore for the running event loop
+    (motor clients are bound to the loop they were created on)
+    """
+    loop = asyncio.get_running_loop()
+    store = _stores.get(loop)
+    if store is None:
+        store = _stores[loop] = AsyncChatStore(settings.MONGO_URI)
+    return store
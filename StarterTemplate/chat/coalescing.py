@@ -0,0 +1,138 @@
+"""
+Outbound frame coalescing for chat WebSockets.
+During a burst, a connection holds message frames for up to
+CHAT_COALESCE_WINDOW_MS (or until enough are waiting) and sends them as one
+{"type": "batch", "messages": [...]} frame: one frame header and one write
+per burst instead of per message. Only used for clients that asked for
+batch frames (?batch=1); CHAT_COALESCE_WINDOW_MS=0 turns it off
+"""
+import asyncio
+import threading
+import time
+from django.conf import settings
+from .codec import JsonWire
+
+
+def coalesce_window():
+    """
+    Seconds a message frame may wait for others (CHAT_COALESCE_WINDOW_MS)
+    """
+    return getattr(settings, 'CHAT_COALESCE_WINDOW_MS', 0) / 1000
+
+
+class CoalescingStats:
+    """
+    Per-process counters for monitoring: how many messages went out in how
+    many frames, and how long messages waited in send buffers
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.frames = 0
+        self.batches = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, messages, delay):
+        """
+        Count one flush of messages, the oldest of which waited delay seconds
+        """
+        with self.lock:
+            self.messages += messages
+            self.frames += 1
+            if messages > 1:
+                self.batches += 1
+            self.delay_total += delay
+            self.delay_max = max(self.delay_max, delay)
+
+    def reset(self):
+        with self.lock:
+            self.messages = self.frames = self.batches = 0
+            self.delay_total = self.delay_max = 0.0
+
+    def stats(self):
+        """
+        Counters for monitoring: messages, frames, batches, coalescing_ratio
+        (messages per frame), avg_delay_ms and max_delay_ms (added latency)
+        """
+        with self.lock:
+            return {
+                'messages': self.messages,
+                'frames': self.frames,
+                'batches': self.batches,
+                'coalescing_ratio': self.messages / self.frames if self.frames else 0.0,
+                'avg_delay_ms': self.delay_total / self.frames * 1000 if self.frames else 0.0,
+                'max_delay_ms': self.delay_max * 1000,
+            }
+
+
+_stats = CoalescingStats()
+
+
+def get_coalescing_stats():
+    """
+    Get the per-process coalescing counters
+    """
+    return _stats
+
+
+class FrameCoalescer:
+    """
+    Send buffer of one connection. Frames arrive already encoded by the
+    sender, so batch (the connection's wire format's batch builder) joins
+    them without re-encoding. Flushes window seconds after the first
+    buffered frame, or as soon as max_messages frames or max_bytes are waiting
+    """
+
+    def __init__(self, send, window, max_messages=50, max_bytes=64 * 1024, batch=JsonWire.batch):
+        self.send = send  # async callable taking an encoded frame
+        self.batch = batch
+        self.window = window
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.frames = []
+        self.size = 0
+        self.first_at = None
+        self.timer = None
+        self.lock = asyncio.Lock()  # keeps flushes (and so frames) in order
+
+    async def add(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        if len(self.frames) == 1:
+            self.first_at = time.monotonic()
+            self.timer = asyncio.ensure_future(self._flush_later())
+        if len(self.frames) >= self.max_messages or self.size >= self.max_bytes:
+            await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Send whatever is buffered: a lone frame as-is, several as one batch
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            if not self.frames:
+                return
+            frames, self.frames, self.size = self.frames, [], 0
+            get_coalescing_stats().record(len(frames), time.monotonic() - self.first_at)
+            if len(frames) == 1:
+                await self.send(frames[0])
+            else:
+                await self.send(self.batch(frames))
+
+    def close(self):
+        """
+        Drop the buffer of a closed connection
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.frames, self.size = [], 0
@@ -0,0 +1,180 @@
+"""
+Codecs for chat WebSocket frames.
+CHAT_JSON_CODEC picks the JSON implementation: 'orjson' (fast, optional
+dependency), 'json' (standard library) or 'auto' (orjson when installed).
+Both produce the same JSON; orjson writes non-ASCII text as UTF-8 instead of
+\\u escapes. Decode errors are json.JSONDecodeError either way.
+Clients offering the 'msgpack' sub-protocol get binary MessagePack frames
+with short field codes instead (see MsgpackWire)
+"""
+import json
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class StdlibCodec:
+    name = 'json'
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data)
+
+    @staticmethod
+    def loads(text):
+        return json.loads(text)
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(data):
+        return orjson.dumps(data).decode('utf-8')
+
+    @staticmethod
+    def loads(text):
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return orjson.loads(text)
+
+
+def get_codec(name=None):
+    """
+    The codec named by CHAT_JSON_CODEC (or name)
+    """
+    name = name or getattr(settings, 'CHAT_JSON_CODEC', 'auto')
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("CHAT_JSON_CODEC='orjson' needs the orjson package")
+        return OrjsonCodec
+    return StdlibCodec
+
+
+def encode_frame(data):
+    """
+    Encode a dict as a WebSocket text frame
+    """
+    return get_codec().dumps(data)
+
+
+def decode_frame(text):
+    """
+    Decode a WebSocket text frame
+    """
+    return get_codec().loads(text)
+
+
+# -------------------------------------------------------------------
+# WebSocket wire formats
+# -------------------------------------------------------------------
+# Short keys used on the msgpack sub-protocol instead of the JSON field names
+FIELD_CODES = {
+    'type': 't',
+    'message': 'm',
+    'messages': 'ms',
+    'sender_id': 's',
+    'sender_username': 'u',
+    'timestamp': 'ts',
+    'message_id': 'id',
+    'room_id': 'r',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+class InvalidFrame(ValueError):
+    """
+    Raised when a frame received from a client cannot be decoded
+    """
+    pass
+
+
+class JsonWire:
+    """
+    JSON text frames: the default, and the fallback for older clients
+    """
+    subprotocol = None
+    binary = False
+    event_key = 'frame'  # pre-encoded frame in chat_message events
+
+    @staticmethod
+    def encode(data):
+        return encode_frame(data)
+
+    @staticmethod
+    def decode(frame):
+        try:
+            data = decode_frame(frame)
+        except json.JSONDecodeError as e:
+            raise InvalidFrame(str(e))
+        if not isinstance(data, dict):
+            raise InvalidFrame('Expected a JSON object')
+        return data
+
+    @staticmethod
+    def batch(frames):
+        # Join the already encoded messages without re-encoding them
+        return '{"type":"batch","messages":[' + ','.join(frames) + ']}'
+
+
+class MsgpackWire:
+    """
+    Binary MessagePack frames keyed by FIELD_CODES, negotiated as the
+    'msgpack' WebSocket sub-protocol
+    """
+    subprotocol = 'msgpack'
+    binary = True
+    event_key = 'packed'
+
+    @staticmethod
+    def encode(data):
+        return msgpack.packb({FIELD_CODES.get(key, key): value for key, value in data.items()}, use_bin_type=True)
+
+    @staticmethod
+    def decode(frame):
+        try:
+            data = msgpack.unpackb(frame, raw=False)
+        except Exception as e:
+            raise InvalidFrame(str(e))
+        if not isinstance(data, dict):
+            raise InvalidFrame('Expected a MessagePack map')
+        return {FIELD_NAMES.get(key, key): value for key, value in data.items()}
+
+    @staticmethod
+    def batch(frames):
+        # Splice the already packed messages into a {t: 'batch', ms: [...]} map
+        packer = msgpack.Packer(use_bin_type=True)
+        return (
+            packer.pack_map_header(2) + packer.pack('t') + packer.pack('batch')
+            + packer.pack('ms') + packer.pack_array_header(len(frames)) + b''.join(frames)
+        )
+
+
+def msgpack_enabled():
+    """
+    Whether the msgpack sub-protocol is offered (CHAT_MSGPACK and msgpack installed)
+    """
+    return msgpack is not None and getattr(settings, 'CHAT_MSGPACK', True)
+
+
+def negotiate_wire(subprotocols):
+    """
+    Wire format for a connection, from the sub-protocols the client offered
+    """
+    if msgpack_enabled() and MsgpackWire.subprotocol in subprotocols:
+        return MsgpackWire
+    return JsonWire
+
+
+def wire_formats():
+    """
+    Wire formats a broadcast is pre-encoded in
+    """
+    return (JsonWire, MsgpackWire) if msgpack_enabled() else (JsonWire,)
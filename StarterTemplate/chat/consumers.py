@@ -1,27 +1,239 @@
 # filepath: g:\HackathonStarterTemplateInDjango\StarterTemplate\chat\consumers.py
 """
-WebSocket consumer for real-time chat functionality.
+WebSocket consumers for real-time chat functionality.
 Handles WebSocket connections, message broadcasting, and authentication.
+ChatConsumer serves one room (ws/chat/<room_id>/); UserConsumer serves all
+of a user's rooms over one connection (ws/user/).
 """
-import json
+from urllib.parse import parse_qs
+from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-from .models import ChatRoom, Message
-from .encryption import encrypt_message, decrypt_message
+from channels.layers import get_channel_layer
+from django.conf import settings
+from bson import ObjectId
+from .models import ChatRoom, Message, make_preview
+from .encryption import encryption_format
+from .room_keys import get_room_key, room_key_cached
+from .write_behind import get_write_behind
+from .async_store import get_async_store
+from .codec import JsonWire, InvalidFrame, negotiate_wire, wire_formats
+from .coalescing import FrameCoalescer, coalesce_window
+from .presence import get_presence
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+def room_group_name(room_id):
+    """Channel layer group for a chat room"""
+    return f'chat_{room_id}'
+
+
+def user_group_name(user_id):
+    """Channel layer group for all of a user's sockets"""
+    return f'user_{user_id}'
+
+
+def encoded_event(handler, payload):
+    """
+    Channel layer event carrying payload pre-encoded once in every wire
+    format, so receiving consumers forward it without re-encoding
+    """
+    event = {'type': handler}
+    for wire in wire_formats():
+        event[wire.event_key] = wire.encode(payload)
+    return event
+
+
+def message_payload(message_data):
+    """
+    The WebSocket frame contents for a new message
+    """
+    return {
+        'type': 'message',
+        'room_id': str(message_data['room_id']),
+        'message': message_data['content'],
+        'sender_id': str(message_data['sender_id']),
+        'sender_username': message_data['sender_username'],
+        'timestamp': message_data['timestamp'],
+        'message_id': str(message_data['message_id'])
+    }
+
+
+def message_event(message_data):
+    """
+    Room group event for a new message
+    """
+    return encoded_event('chat_message', message_payload(message_data))
+
+
+def inbox_payload(message_data):
+    """
+    The inbox frame for a new message: which room it went to and a preview.
+    Clients move the room to the top and, for messages from the other user,
+    count it as unread
+    """
+    return {
+        'type': 'new_message',
+        'room_id': str(message_data['room_id']),
+        'message': make_preview(message_data['content']),
+        'sender_id': str(message_data['sender_id']),
+        'sender_username': message_data['sender_username'],
+        'timestamp': message_data['timestamp'],
+        'last_message_at': message_data['sent_at'].strftime('%b %d, %Y %H:%M'),
+        'message_id': str(message_data['message_id'])
+    }
+
+
+async def notify_users(user_ids, payload):
+    """
+    Send a frame to every socket of the given users (UserConsumer).
+    Sent regardless of presence, which is only a status signal: a user
+    without open sockets has an empty group, which costs next to nothing
+    """
+    layer = get_channel_layer()
+    event = encoded_event('user_event', payload)
+    for user_id in dict.fromkeys(user_id for user_id in user_ids if user_id is not None):
+        await layer.group_send(user_group_name(user_id), event)
+
+
+def notify_message_sent(room, message, sender):
+    """
+    Push the inbox update for a message stored outside the chat socket
+    (called from sync views)
+    """
+    async_to_sync(notify_users)(room.participant_ids(), inbox_payload({
+        'room_id': room.id,
+        'content': message.decrypted_content,
+        'sender_id': sender.id,
+        'sender_username': sender.username,
+        'timestamp': message.timestamp.strftime('%H:%M'),
+        'sent_at': message.timestamp,
+        'message_id': message.id
+    }))
+
+
+def notify_unread_count(user_id, room_id, count):
+    """
+    Tell a user's sockets the unread count of one of their rooms
+    (called from sync views, e.g. after the room was read)
+    """
+    async_to_sync(notify_users)([user_id], {
+        'type': 'unread_count',
+        'room_id': str(room_id),
+        'unread_count': count
+    })
+
+
+def notify_room_deleted(room_id, participant_ids=()):
+    """
+    Tell every socket connected to a room that it was deleted, so they drop
+    their cached room and close, and take the room out of the participants'
+    inboxes (called from sync views)
+    """
+    async_to_sync(get_channel_layer().group_send)(
+        room_group_name(room_id),
+        {'type': 'room_deleted', 'room_id': str(room_id)}
+    )
+    async_to_sync(notify_users)(participant_ids, {
+        'type': 'room_order',
+        'room_id': str(room_id),
+        'action': 'remove'
+    })
+
+
+class FrameConsumer(AsyncWebsocketConsumer):
+    """
+    Base for the chat sockets: negotiates the wire format (JSON, or msgpack
+    if the client offers it), coalesces message frames for clients that
+    asked for batches, forwards frames pre-encoded by the broadcaster, and
+    reports the connection to the presence service. Every frame received
+    counts as a heartbeat; clients send {'type': 'heartbeat'} every
+    'heartbeat' seconds (from connection_established) while otherwise idle.
+    """
+    coalescer = None
+    wire = JsonWire
+    
+    async def accept_frames(self):
+        """Accept the connection in the negotiated wire format"""
+        self.wire = negotiate_wire(self.scope.get('subprotocols', []))
+        await self.accept(self.wire.subprotocol)
+        await get_presence().connect(self.channel_name, self.user.id)
+        
+        # Clients that understand batch frames (?batch=1) get bursts coalesced
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        if coalesce_window() > 0 and query.get('batch') == ['1']:
+            self.coalescer = FrameCoalescer(
+                self.send_encoded,
+                window=coalesce_window(),
+                batch=self.wire.batch,
+                max_messages=settings.CHAT_COALESCE_MAX_MESSAGES,
+                max_bytes=settings.CHAT_COALESCE_MAX_BYTES
+            )
+    
+    async def disconnect(self, close_code):
+        if self.coalescer is not None:
+            self.coalescer.close()
+        get_presence().disconnect(self.channel_name)
+    
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        Decode a received frame (text frames are always JSON); the client
+        is active, so this is also its presence heartbeat
+        """
+        get_presence().heartbeat(self.channel_name, self.user.id)
+        if bytes_data is not None:
+            return self.wire.decode(bytes_data)
+        return JsonWire.decode(text_data)
+    
+    async def send_encoded(self, frame):
+        """Send a frame already encoded in this connection's wire format"""
+        if self.wire.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+    
+    async def send_frame(self, data):
+        """
+        Encode data in this connection's wire format and send it,
+        after any message frames still waiting to be coalesced
+        """
+        if self.coalescer is not None:
+            await self.coalescer.flush()
+        await self.send_encoded(self.wire.encode(data))
+    
+    async def forward(self, event, payload=None):
+        """
+        Send the frame an encoded_event carries. payload builds it for events
+        from processes that did not encode this wire format (or still send
+        unencoded fields)
+        """
+        frame = event.get(self.wire.event_key)
+        if frame is None:
+            if JsonWire.event_key in event:
+                data = JsonWire.decode(event[JsonWire.event_key])
+            else:
+                data = payload(event)
+            frame = self.wire.encode(data)
+        if self.coalescer is not None:
+            await self.coalescer.add(frame)
+        else:
+            await self.send_encoded(frame)
+
+
+class ChatConsumer(FrameConsumer):
     """
     WebSocket consumer for 1-on-1 chat.
     Each chat room has a unique group name for broadcasting messages.
+    The room and the sender are resolved once in connect and reused, so
+    sending a message does no database reads.
     """
+    room = None
+    sender = None
     
     async def connect(self):
         """Handle WebSocket connection"""
         # Get room_id from URL route
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.room_group_name = room_group_name(self.room_id)
         
         # Get user from scope (set by AuthMiddlewareStack)
         self.user = self.scope.get('user')
@@ -33,7 +245,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         
         # Verify user has access to this chat room
-        has_access = await self.verify_room_access()
+        if settings.CHAT_ASYNC_MONGO:
+            has_access = await self.verify_room_access_async()
+        else:
+            has_access = await self.verify_room_access()
         if not has_access:
             await self.close()
             return
@@ -44,17 +259,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        # Accept the WebSocket connection
-        await self.accept()
+        # Accept the WebSocket connection, in msgpack if the client offered it
+        await self.accept_frames()
         
         # Send a connection confirmation
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'connection_established',
-            'message': 'Connected to chat room'
-        }))
+            'message': 'Connected to chat room',
+            'heartbeat': settings.CHAT_PRESENCE_HEARTBEAT
+        })
     
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection"""
+        await super().disconnect(close_code)
+        
         # Leave room group
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(
@@ -62,75 +280,168 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receive message from WebSocket.
         Expected format: {'message': 'text content'}
+        (a MessagePack map {'m': 'text content'} on the msgpack sub-protocol).
+        {'type': 'heartbeat'} frames only keep the connection's presence alive
         """
         try:
-            data = json.loads(text_data)
+            data = self.decode(text_data, bytes_data)
             message_content = data.get('message', '').strip()
             
             if not message_content:
                 return
             
-            # Save message to database (encrypted)
-            message_data = await self.save_message(message_content)
+            if self.room is None:
+                # Room was deleted while connected
+                return
+            
+            # Save message to database (encrypted), or queue it for a batched
+            # write and broadcast straight away in write-behind mode
+            if settings.CHAT_WRITE_BEHIND:
+                message_data = await self.queue_message(message_content)
+            elif settings.CHAT_ASYNC_MONGO:
+                message_data = await self.save_message_async(message_content)
+            else:
+                message_data = await self.save_message(message_content)
             
             if message_data:
-                # Broadcast message to room group
+                # Broadcast message to room group, encoded once for all listeners
                 await self.channel_layer.group_send(
                     self.room_group_name,
-                    {
-                        'type': 'chat_message',
-                        'message': message_data['content'],
-                        'sender_id': str(message_data['sender_id']),
-                        'sender_username': message_data['sender_username'],
-                        'timestamp': message_data['timestamp'],
-                        'message_id': str(message_data['message_id'])
-                    }
+                    message_event(message_data)
                 )
-        except json.JSONDecodeError:
-            # Invalid JSON
-            await self.send(text_data=json.dumps({
+                # Update both participants' inboxes (UserConsumer sockets)
+                await notify_users(self.room.participant_ids(), inbox_payload(message_data))
+        except InvalidFrame:
+            # Invalid JSON or MessagePack
+            await self.send_frame({
                 'type': 'error',
                 'message': 'Invalid message format'
-            }))
+            })
         except Exception as e:
             # Log error and send error message
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': 'Failed to send message'
-            }))
+            })
     
     async def chat_message(self, event):
         """
         Receive message from room group and send to WebSocket.
-        This is called when a message is broadcast to the group.
-        """
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message'],
-            'sender_id': event['sender_id'],
-            'sender_username': event['sender_username'],
-            'timestamp': event['timestamp'],
-            'message_id': event['message_id']
-        }))
+        This is called when a message is broadcast to the group; the frame
+        was encoded once by the sender and is forwarded as-is.
+        """
+        await self.forward(event, lambda event: message_payload(
+            dict(event, content=event['message'], room_id=self.room_id)
+        ))
+    
+    async def room_deleted(self, event):
+        """
+        The room was deleted (delete_chat): drop the cached room and close.
+        """
+        self.room = None
+        self.sender = None
+        await self.send_frame({
+            'type': 'room_deleted',
+            'message': 'This chat was deleted'
+        })
+        await self.close()
     
     @database_sync_to_async
     def verify_room_access(self):
-        """Verify that the user has access to this chat room"""
+        """
+        Verify that the user has access to this chat room.
+        Caches the room and the sender for the connection.
+        """
         try:
-            room = ChatRoom.objects.get(id=self.room_id)
+            # One room query plus one batched query for both participants
+            rooms = ChatRoom.objects(id=self.room_id).limit(1).select_related()
+            if not rooms:
+                return False
+            room = rooms[0]
+            
             # Check if user is part of this chat room
-            return (str(room.user1.id) == str(self.user.id) or 
-                    str(room.user2.id) == str(self.user.id))
-        except ChatRoom.DoesNotExist:
-            return False
+            participants = (room.user1, room.user2)
+            sender = next((user for user in participants if str(user.id) == str(self.user.id)), None)
+            if sender is None:
+                return False
+            
+            self.room, self.sender = room, sender
+            if encryption_format() == 'room':
+                get_room_key(room.id)  # warm the key cache for the send paths
+            return True
         except Exception:
             return False
     
+    async def verify_room_access_async(self):
+        """
+        Verify room access on the event loop (CHAT_ASYNC_MONGO).
+        Caches the room (participants stay as references) for the connection.
+        """
+        room = await get_async_store().get_room(self.room_id)
+        if room is None or not room.has_participant(self.user):
+            return False
+        
+        self.room = room
+        await self.ensure_room_key()
+        return True
+    
+    async def ensure_room_key(self):
+        """
+        Make sure the room's data key is cached, so building a message on the
+        event loop never blocks on a key lookup (it expires after the key TTL)
+        """
+        if encryption_format() == 'room' and not room_key_cached(self.room.id):
+            await database_sync_to_async(get_room_key)(self.room.id)
+    
+    async def save_message_async(self, content):
+        """
+        Save message on the event loop (CHAT_ASYNC_MONGO).
+        Returns message data for broadcasting.
+        """
+        try:
+            await self.ensure_room_key()
+            message = await get_async_store().create_message(self.room, self.user.id, content)
+            
+            return {
+                'room_id': self.room.id,
+                'content': content,
+                'sender_id': str(self.user.id),
+                'sender_username': self.user.username,
+                'timestamp': message.timestamp.strftime('%H:%M'),
+                'sent_at': message.timestamp,
+                'message_id': str(message.id)
+            }
+        except Exception as e:
+            print(f"Error saving message: {e}")
+            return None
+    
+    async def queue_message(self, content):
+        """
+        Build the message with its id and timestamp assigned and hand it to
+        the write-behind buffer. Returns message data for broadcasting
+        """
+        await self.ensure_room_key()
+        message = Message.build_message(
+            room=self.room,
+            sender=ObjectId(str(self.user.id)),
+            content=content
+        )
+        await get_write_behind().enqueue(message)
+        
+        return {
+            'room_id': self.room.id,
+            'content': content,
+            'sender_id': str(self.user.id),
+            'sender_username': self.user.username,
+            'timestamp': message.timestamp.strftime('%H:%M'),
+            'sent_at': message.timestamp,
+            'message_id': str(message.id)
+        }
+    
     @database_sync_to_async
     def save_message(self, content):
         """
@@ -138,30 +449,156 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Returns message data for broadcasting.
         """
         try:
-            from accounts.models import User
-            
-            # Get the chat room
-            room = ChatRoom.objects.get(id=self.room_id)
+            sender = self.sender
             
-            # Get the sender user object
-            sender = User.objects.get(id=self.user.id)
-            
-            # Create and save message (encrypted)
+            # Create and save message (encrypted) with the room and sender
+            # cached at connect time
             message = Message.create_message(
-                room=room,
+                room=self.room,
                 sender=sender,
                 content=content
             )
             
             # Return message data for broadcasting
             return {
+                'room_id': self.room.id,
                 'content': content,  # Send decrypted content over WebSocket
                 'sender_id': str(sender.id),
                 'sender_username': sender.username,
                 'timestamp': message.timestamp.strftime('%H:%M'),
+                'sent_at': message.timestamp,
                 'message_id': str(message.id)
             }
         except Exception as e:
             # Log the error (in production, use proper logging)
             print(f"Error saving message: {e}")
             return None
+
+
+class UserConsumer(FrameConsumer):
+    """
+    One WebSocket per user (ws/user/) instead of one per open room.
+    Joins the user's group, which carries inbox events for all of their
+    rooms: new_message, unread_count and room_order. The client subscribes
+    to a room's message stream by sending {'action': 'join', 'room_id': ...}
+    and drops it with {'action': 'leave', 'room_id': ...}; connecting does
+    no database reads, joining a room does one.
+    """
+    
+    async def connect(self):
+        """Handle WebSocket connection"""
+        self.user = self.scope.get('user')
+        if not self.user or not hasattr(self.user, 'id'):
+            await self.close()
+            return
+        
+        self.rooms = set()
+        self.user_group_name = user_group_name(self.user.id)
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept_frames()
+        await self.send_frame({
+            'type': 'connection_established',
+            'message': 'Connected to inbox',
+            'heartbeat': settings.CHAT_PRESENCE_HEARTBEAT
+        })
+    
+    async def disconnect(self, close_code):
+        """Handle WebSocket disconnection"""
+        await super().disconnect(close_code)
+        if not hasattr(self, 'user_group_name'):
+            return
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        for room_id in self.rooms:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Receive a control frame from WebSocket.
+        Expected format: {'action': 'join' | 'leave', 'room_id': '...'}
+        or {'type': 'heartbeat'}
+        """
+        try:
+            data = self.decode(text_data, bytes_data)
+        except InvalidFrame:
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Invalid message format'
+            })
+            return
+        
+        if data.get('type') == 'heartbeat':
+            return
+        
+        action = data.get('action')
+        room_id = str(data.get('room_id', ''))
+        if action == 'join':
+            await self.join_room(room_id)
+        elif action == 'leave':
+            await self.leave_room(room_id)
+        else:
+            await self.send_frame({
+                'type': 'error',
+                'message': 'Unknown action'
+            })
+    
+    async def join_room(self, room_id):
+        """Subscribe this socket to a room's message stream"""
+        if room_id not in self.rooms:
+            if len(self.rooms) >= settings.CHAT_USER_MAX_STREAMS:
+                await self.send_frame({
+                    'type': 'error',
+                    'room_id': room_id,
+                    'message': 'Too many open rooms'
+                })
+                return
+            if settings.CHAT_ASYNC_MONGO:
+                room = await get_async_store().get_room(room_id)
+            else:
+                room = await self.get_room(room_id)
+            if room is None or not room.has_participant(self.user):
+                await self.send_frame({
+                    'type': 'error',
+                    'room_id': room_id,
+                    'message': 'You do not have access to this chat room'
+                })
+                return
+            self.rooms.add(room_id)
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+        await self.send_frame({'type': 'joined', 'room_id': room_id})
+    
+    async def leave_room(self, room_id):
+        """Unsubscribe this socket from a room's message stream"""
+        if room_id in self.rooms:
+            self.rooms.discard(room_id)
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        await self.send_frame({'type': 'left', 'room_id': room_id})
+    
+    @database_sync_to_async
+    def get_room(self, room_id):
+        """Load just the participants of a room (None if it does not exist)"""
+        try:
+            return ChatRoom.objects(id=ObjectId(room_id)).only('user1', 'user2').first()
+        except Exception:
+            return None
+    
+    async def chat_message(self, event):
+        """Forward a message from one of the joined rooms"""
+        await self.forward(event, lambda event: message_payload(
+            dict(event, content=event['message'], room_id=event.get('room_id', ''))
+        ))
+    
+    async def user_event(self, event):
+        """Forward an inbox event (new_message, unread_count, room_order)"""
+        await self.forward(event)
+    
+    async def room_deleted(self, event):
+        """A joined room was deleted: drop its stream and tell the client"""
+        room_id = event.get('room_id')
+        if room_id in self.rooms:
+            self.rooms.discard(room_id)
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        await self.send_frame({
+            'type': 'room_deleted',
+            'room_id': room_id,
+            'message': 'This chat was deleted'
+        })
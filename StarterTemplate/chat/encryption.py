@@ -1,12 +1,151 @@
 """
-AES256 Encryption utility for chat messages
+AES256 Encryption utility for chat messages.
+
+Stored formats:
+- room envelope (current): raw bytes stored as BinData,
+  0x02 | 4-byte data key version | 12-byte nonce | 16-byte GCM tag | ciphertext,
+  encrypted with the room's own data key (see room_keys)
+- envelope: 0x01 | 12-byte nonce | 16-byte GCM tag | ciphertext, encrypted
+  with the global key derived from ENCRYPTION_KEY
+- legacy: base64 text of IV + AES-CBC ciphertext, stored as a string
+decrypt_message() tells them apart by type and version byte, so all of them
+can be read side by side while old messages are rewritten
+(see reencrypt_messages and rotate_chat_keys).
+Envelopes of long messages have FLAG_COMPRESSED set on the version byte:
+their plaintext was zlib-compressed before encryption
 """
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from bson import ObjectId
 from django.conf import settings
 import hashlib
+import hmac
+import os
+import re
+import threading
+import zlib
+
+
+# Envelope layout: version byte, nonce, tag, ciphertext
+ENVELOPE_GCM = b'\x01'
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
+ENVELOPE_HEADER_SIZE = 1 + GCM_NONCE_SIZE + GCM_TAG_SIZE
+
+# Room envelope layout: version byte, data key version, nonce, tag, ciphertext
+ENVELOPE_ROOM = b'\x02'
+KEY_VERSION_SIZE = 4
+ROOM_ENVELOPE_HEADER_SIZE = 1 + KEY_VERSION_SIZE + GCM_NONCE_SIZE + GCM_TAG_SIZE
+
+# Set on an envelope's version byte when the plaintext was compressed
+FLAG_COMPRESSED = 0x80
+
+# Returned in place of content that cannot be decrypted
+DECRYPTION_FAILED = '[Unable to decrypt message]'
+
+
+def is_legacy_ciphertext(ciphertext):
+    """
+    Whether a stored value is in the legacy base64 CBC format
+    (envelopes are stored as binary, legacy values as text)
+    """
+    return isinstance(ciphertext, str)
+
+
+def envelope_version(data):
+    """
+    Split an envelope's first byte into (version byte, compressed)
+    """
+    return bytes([data[0] & ~FLAG_COMPRESSED]), bool(data[0] & FLAG_COMPRESSED)
+
+
+def ciphertext_format(ciphertext):
+    """
+    Describe a stored value as (format, compressed), format being
+    'legacy', 'gcm', 'room' or 'unknown'
+    """
+    if is_legacy_ciphertext(ciphertext):
+        return 'legacy', False
+    if not ciphertext:
+        return 'unknown', False
+    version, compressed = envelope_version(bytes(ciphertext))
+    return {ENVELOPE_GCM: 'gcm', ENVELOPE_ROOM: 'room'}.get(version, 'unknown'), compressed
+
+
+def room_key_version(ciphertext):
+    """
+    Data key version of a room envelope, or None for the other formats
+    """
+    if (isinstance(ciphertext, bytes) and len(ciphertext) >= ROOM_ENVELOPE_HEADER_SIZE
+            and envelope_version(ciphertext)[0] == ENVELOPE_ROOM):
+        return int.from_bytes(ciphertext[1:1 + KEY_VERSION_SIZE], 'big')
+    return None
+
+
+def compress_threshold():
+    """
+    Smallest UTF-8 plaintext size in bytes that is compressed before
+    encryption (CHAT_COMPRESS_THRESHOLD; 0 disables compression)
+    """
+    return getattr(settings, 'CHAT_COMPRESS_THRESHOLD', 0)
+
+
+def pack_plaintext(plaintext):
+    """
+    Encode plaintext for encryption, zlib-compressing it when it is over the
+    threshold and compression actually shrinks it. Returns (flags, payload)
+    """
+    data = plaintext.encode('utf-8')
+    threshold = compress_threshold()
+    if threshold and len(data) >= threshold:
+        compressed = zlib.compress(data, getattr(settings, 'CHAT_COMPRESS_LEVEL', 6))
+        if len(compressed) < len(data):
+            return FLAG_COMPRESSED, compressed
+    return 0, data
+
+
+def unpack_plaintext(compressed, payload):
+    """
+    Reverse pack_plaintext
+    """
+    if compressed:
+        payload = zlib.decompress(payload)
+    return payload.decode('utf-8')
+
+
+def encrypt_with_room_key(plaintext, room_id, version, data_key):
+    """
+    Encrypt into a room envelope. The header (including the compression
+    flag) and room id are authenticated, so a ciphertext cannot be replayed
+    into another room
+    """
+    if not plaintext:
+        return b''
+    flags, payload = pack_plaintext(plaintext)
+    header = bytes([ENVELOPE_ROOM[0] | flags]) + version.to_bytes(KEY_VERSION_SIZE, 'big')
+    nonce = get_random_bytes(GCM_NONCE_SIZE)
+    room_cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+    room_cipher.update(header + ObjectId(str(room_id)).binary)
+    encrypted, tag = room_cipher.encrypt_and_digest(payload)
+    return header + nonce + tag + encrypted
+
+
+def decrypt_with_room_key(ciphertext, room_id, data_key):
+    """
+    Decrypt a room envelope with the data key its header names
+    """
+    data = bytes(ciphertext)
+    header = data[:1 + KEY_VERSION_SIZE]
+    nonce = data[1 + KEY_VERSION_SIZE:1 + KEY_VERSION_SIZE + GCM_NONCE_SIZE]
+    tag = data[1 + KEY_VERSION_SIZE + GCM_NONCE_SIZE:ROOM_ENVELOPE_HEADER_SIZE]
+    room_cipher = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+    room_cipher.update(header + ObjectId(str(room_id)).binary)
+    payload = room_cipher.decrypt_and_verify(data[ROOM_ENVELOPE_HEADER_SIZE:], tag)
+    return unpack_plaintext(envelope_version(header)[1], payload)
 
 
 class AESCipher:
@@ -24,9 +163,45 @@ class AESCipher:
         # Ensure key is exactly 32 bytes for AES256
         self.key = hashlib.sha256(key.encode()).digest()
     
+    @classmethod
+    def from_raw_key(cls, raw_key):
+        """
+        Build a cipher from an already derived 32-byte key
+        """
+        instance = cls.__new__(cls)
+        instance.key = raw_key
+        return instance
+    
     def encrypt(self, plaintext):
         """
-        Encrypt plaintext string using AES256
+        Encrypt plaintext string with the global key: 'gcm' envelope bytes,
+        or legacy text when CHAT_ENCRYPTION_FORMAT is 'cbc'
+        """
+        if encryption_format() == 'cbc':
+            return self.encrypt_cbc(plaintext)
+        return self.encrypt_gcm(plaintext)
+    
+    def encrypt_gcm(self, plaintext):
+        """
+        Encrypt plaintext string using AES256-GCM
+        Returns the binary envelope (authenticated)
+        """
+        if not plaintext:
+            return b''
+        
+        flags, payload = pack_plaintext(plaintext)
+        version = bytes([ENVELOPE_GCM[0] | flags])
+        nonce = get_random_bytes(GCM_NONCE_SIZE)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        if flags:
+            # Authenticate the flag (plain 0x01 envelopes predate this)
+            cipher.update(version)
+        encrypted, tag = cipher.encrypt_and_digest(payload)
+        return version + nonce + tag + encrypted
+    
+    def encrypt_cbc(self, plaintext):
+        """
+        Encrypt plaintext string using AES256-CBC (legacy format)
         Returns base64 encoded string
         """
         if not plaintext:
@@ -47,12 +222,34 @@ class AESCipher:
     
     def decrypt(self, ciphertext):
         """
-        Decrypt base64 encoded ciphertext
+        Decrypt ciphertext in either stored format
         Returns plaintext string
         """
         if not ciphertext:
             return ''
+        if is_legacy_ciphertext(ciphertext):
+            return self.decrypt_cbc(ciphertext)
         
+        try:
+            data = bytes(ciphertext)
+            version, compressed = envelope_version(data)
+            if version != ENVELOPE_GCM:
+                raise ValueError(f'Unknown envelope version {data[:1]!r}')
+            nonce = data[1:1 + GCM_NONCE_SIZE]
+            tag = data[1 + GCM_NONCE_SIZE:ENVELOPE_HEADER_SIZE]
+            cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+            if compressed:
+                cipher.update(data[:1])
+            return unpack_plaintext(compressed, cipher.decrypt_and_verify(data[ENVELOPE_HEADER_SIZE:], tag))
+        except Exception as e:
+            print(f"❌ Decryption error: {e}")
+            return DECRYPTION_FAILED
+    
+    def decrypt_cbc(self, ciphertext):
+        """
+        Decrypt base64 encoded ciphertext (legacy format)
+        Returns plaintext string
+        """
         try:
             # Decode base64
             data = base64.b64decode(ciphertext)
@@ -72,22 +269,181 @@ class AESCipher:
             print(f"   Ciphertext (first 50 chars): {ciphertext[:50]}")
             print(f"   Key (hash): {self.key.hex()[:20]}...")
             traceback.print_exc()
-            return '[Unable to decrypt message]'
+            return DECRYPTION_FAILED
 
 
 # Global cipher instance
 cipher = AESCipher()
 
 
-def encrypt_message(message):
+def encryption_format():
+    """
+    Format for new ciphertexts (CHAT_ENCRYPTION_FORMAT): 'room', 'gcm' or 'cbc'
+    """
+    return getattr(settings, 'CHAT_ENCRYPTION_FORMAT', 'room')
+
+
+def encrypt_message(message, room_id=None):
     """
-    Convenience function to encrypt a message
+    Convenience function to encrypt a message.
+    With a room id (and the 'room' format) the room's current data key is used
     """
+    if room_id is not None and encryption_format() == 'room':
+        from .room_keys import get_room_key
+        version, data_key = get_room_key(room_id)
+        return encrypt_with_room_key(message, room_id, version, data_key)
     return cipher.encrypt(message)
 
 
-def decrypt_message(encrypted_message):
+def decrypt_message(encrypted_message, room_id=None):
+    """
+    Convenience function to decrypt a message in any stored format
+    (room envelopes need the id of the room the message belongs to)
+    """
+    return decrypt_messages([encrypted_message], room_id=room_id)[0]
+
+
+# -------------------------------------------------------------------
+# Batch decryption
+# -------------------------------------------------------------------
+DECRYPT_CHUNK_SIZE = 256
+
+_thread_pool = None
+_process_pool = None
+_pool_lock = threading.Lock()
+
+
+def decrypt_workers():
+    """
+    Worker count for batch decryption (CHAT_DECRYPT_WORKERS, default: CPU count)
+    """
+    return getattr(settings, 'CHAT_DECRYPT_WORKERS', 0) or os.cpu_count() or 1
+
+
+def _get_thread_pool():
+    global _thread_pool
+    with _pool_lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=decrypt_workers(), thread_name_prefix='chat-decrypt')
+        return _thread_pool
+
+
+def _get_process_pool():
+    # Started on the first processes=True batch and reused by every later one
+    global _process_pool
+    with _pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=decrypt_workers())
+        return _process_pool
+
+
+def _decrypt_chunk(global_key, room_id, room_keys, chunk):
+    """
+    Decrypt one chunk (top-level so process pools can pickle it).
+    room_keys maps data key version -> key for the room's envelopes
+    """
+    global_cipher = AESCipher.from_raw_key(global_key)
+    plaintexts = []
+    for ciphertext in chunk:
+        version = room_key_version(ciphertext)
+        if version is None:
+            plaintexts.append(global_cipher.decrypt(ciphertext))
+            continue
+        try:
+            if version not in room_keys:
+                raise ValueError(f'No data key version {version} for room {room_id}')
+            plaintexts.append(decrypt_with_room_key(ciphertext, room_id, room_keys[version]))
+        except Exception as e:
+            print(f"❌ Decryption error: {e}")
+            plaintexts.append(DECRYPTION_FAILED)
+    return plaintexts
+
+
+def decrypt_messages(ciphertexts, room_id=None, processes=False, pool=None, chunk_size=DECRYPT_CHUNK_SIZE):
+    """
+    Decrypt many ciphertexts of one room, returning plaintexts in the same
+    order. The room's data keys are looked up once for the whole batch.
+    Batches larger than one chunk are split into chunks and decrypted on a
+    shared thread pool (pycryptodome releases the GIL inside AES), on a
+    shared process pool with processes=True for very large exports, or on
+    the caller's own executor passed as pool. Pools are started once and
+    reused across calls. Small batches are decrypted inline, where pool
+    overhead would outweigh the gain
+    """
+    ciphertexts = list(ciphertexts)
+    
+    room_keys = {}
+    versions = {room_key_version(ciphertext) for ciphertext in ciphertexts} - {None}
+    if versions and room_id is not None:
+        from .room_keys import get_room_key, RoomKeyError
+        for version in versions:
+            try:
+                room_keys[version] = get_room_key(room_id, version)[1]
+            except RoomKeyError as e:
+                print(f"❌ Decryption error: {e}")
+    decrypt_chunk = partial(_decrypt_chunk, cipher.key, room_id, room_keys)
+    
+    if len(ciphertexts) <= chunk_size or (pool is None and decrypt_workers() < 2):
+        return decrypt_chunk(ciphertexts)
+    
+    if pool is None:
+        pool = _get_process_pool() if processes else _get_thread_pool()
+    chunks = [ciphertexts[i:i + chunk_size] for i in range(0, len(ciphertexts), chunk_size)]
+    # Executor.map yields chunk results in submission order
+    return [plaintext for chunk in pool.map(decrypt_chunk, chunks) for plaintext in chunk]
+
+
+# -------------------------------------------------------------------
+# Blind keyword index
+# -------------------------------------------------------------------
+SEARCH_WORD_RE = re.compile(r'\w+')
+SEARCH_MIN_WORD_LENGTH = 2  # shorter words are not indexed
+
+
+class InvalidSearchQuery(ValueError):
+    """
+    Raised when a search query has no word the index could match
+    """
+    pass
+
+
+def search_index_key():
+    """
+    HMAC key for blind search tokens: CHAT_SEARCH_KEY if set, otherwise
+    derived from ENCRYPTION_KEY (never the AES key itself)
+    """
+    key = getattr(settings, 'CHAT_SEARCH_KEY', '') or 'chat-search:' + getattr(settings, 'ENCRYPTION_KEY', 'your_encryption_key')
+    return hashlib.sha256(key.encode()).digest()
+
+
+def blind_index_tokens(text, scope):
+    """
+    Turn text into keyed HMAC tokens for the search index, one per distinct
+    lowercased word. Tokens are scoped (e.g. per room) so equal words in
+    different rooms give unrelated tokens. The index can be matched against
+    query tokens without ever storing or revealing the words themselves.
+    Words shorter than SEARCH_MIN_WORD_LENGTH are skipped
+    """
+    key = search_index_key()
+    words = {word for word in SEARCH_WORD_RE.findall(text.lower()) if len(word) >= SEARCH_MIN_WORD_LENGTH}
+    return sorted(
+        hmac.new(key, f'{scope}:{word}'.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+        for word in words
+    )
+
+
+def search_query_tokens(query, scope):
     """
-    Convenience function to decrypt a message
+    blind_index_tokens for a search query. Raises InvalidSearchQuery when
+    the query has no words or a word too short to be indexed, rather than
+    silently searching for the remaining words only
     """
-    return cipher.decrypt(encrypted_message)
+    words = SEARCH_WORD_RE.findall(query.lower())
+    if not words:
+        raise InvalidSearchQuery('Search query must contain at least one word')
+    short = [word for word in words if len(word) < SEARCH_MIN_WORD_LENGTH]
+    if short:
+        raise InvalidSearchQuery(
+            f'Search words must be at least {SEARCH_MIN_WORD_LENGTH} characters long: {", ".join(short)}'
+        )
+    return blind_index_tokens(query, scope)
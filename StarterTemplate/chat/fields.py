@@ -0,0 +1,97 @@
+"""
+MongoEngine fields for encrypted chat data
+"""
+from mongoengine.base import BaseField
+from .encryption import encrypt_message
+from .message_cache import decrypt_cached, get_message_cache
+
+
+class CiphertextField(BaseField):
+    """
+    Encrypted value: a binary AES-GCM envelope (stored as BinData) or, for
+    data written before the envelope format, legacy base64 text
+    """
+
+    def validate(self, value):
+        if not isinstance(value, (bytes, str)):
+            self.error('Ciphertext must be bytes (envelope) or str (legacy)')
+
+
+class EncryptedStringField(CiphertextField):
+    """
+    Encrypted string with a plaintext attribute alongside it.
+
+    The field itself always holds the stored ciphertext, so bulk writes,
+    exports and migrations can move it without decrypting anything. The
+    plaintext attribute (named by plaintext) decrypts on first access and
+    keeps the result on the document; assigning to it encrypts the new value.
+    scope names the reference field whose id selects the encryption key, and
+    cache_key the attribute that keys the shared decrypted message cache.
+    Plaintext is assigned after construction, once scope is set
+    """
+
+    def __init__(self, plaintext, scope=None, cache_key=None, **kwargs):
+        self.plaintext_name = plaintext
+        self.scope = scope
+        self.cache_key = cache_key
+        self.memo_name = f'_{plaintext}_memo'
+        super().__init__(**kwargs)
+
+    def __set_name__(self, owner, name):
+        setattr(owner, self.plaintext_name, PlaintextAttribute(self))
+
+    def scope_id(self, instance):
+        if self.scope is None:
+            return None
+        value = instance._data.get(self.scope)
+        return getattr(value, 'id', value)
+
+    def has_plaintext(self, instance):
+        """
+        Whether the plaintext of the current ciphertext is already known
+        """
+        memo = instance.__dict__.get(self.memo_name)
+        return memo is not None and memo[0] is instance._data.get(self.name)
+
+    def remember_plaintext(self, instance, plaintext):
+        """
+        Record plaintext obtained elsewhere (e.g. a batch decryption) for
+        the current ciphertext, so accessing it does not decrypt again
+        """
+        instance.__dict__[self.memo_name] = (instance._data.get(self.name), plaintext)
+
+    def get_plaintext(self, instance):
+        ciphertext = instance._data.get(self.name)
+        if ciphertext is None:
+            return None
+        if self.has_plaintext(instance):
+            return instance.__dict__[self.memo_name][1]
+        key = getattr(instance, self.cache_key) if self.cache_key else None
+        plaintext = decrypt_cached(key, ciphertext, self.scope_id(instance))
+        self.remember_plaintext(instance, plaintext)
+        return plaintext
+
+    def set_plaintext(self, instance, plaintext):
+        setattr(instance, self.name, encrypt_message(plaintext, self.scope_id(instance)))
+        self.remember_plaintext(instance, plaintext)
+        cache = get_message_cache()
+        key = getattr(instance, self.cache_key) if self.cache_key else None
+        if cache is not None and key is not None:
+            cache.invalidate([key])
+
+
+class PlaintextAttribute:
+    """
+    Descriptor exposing the plaintext of an EncryptedStringField
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.field.get_plaintext(instance)
+
+    def __set__(self, instance, value):
+        self.field.set_plaintext(instance, value)
@@ -0,0 +1,87 @@
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import Message, MessageBucket, MessageArchive
+
+
+class Command(BaseCommand):
+    help = 'Move chat messages older than the hot window into compressed per-room archives'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=None,
+            help='Archive messages older than this many days (default: CHAT_ARCHIVE_AFTER_DAYS)'
+        )
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Messages per archive document')
+        parser.add_argument(
+            '--every', type=int, default=0,
+            help='Keep running and archive again every N seconds (scheduled job mode)'
+        )
+
+    def handle(self, *args, **options):
+        days = options['older_than_days']
+        if days is None:
+            days = settings.CHAT_ARCHIVE_AFTER_DAYS
+        if days < 1 or options['chunk_size'] < 1:
+            raise CommandError('--older-than-days and --chunk-size must be at least 1')
+
+        while True:
+            cutoff = datetime.now() - timedelta(days=days)
+            archived = self.archive_documents(cutoff, options['chunk_size']) + self.archive_buckets(cutoff)
+            self.stdout.write(self.style.SUCCESS(
+                f'Archived {archived} message(s) older than {cutoff:%Y-%m-%d %H:%M}'
+            ))
+
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+
+    def archive_documents(self, cutoff, chunk_size):
+        """
+        Archive old per-message documents, oldest first per room. Each archive
+        is written before its messages are removed, and writing it again
+        after an interruption is a no-op
+        """
+        messages = Message._get_collection()
+        archived = 0
+
+        for room_id in messages.distinct('room', {'timestamp': {'$lt': cutoff}}):
+            chunk = []
+            old = messages.find({'room': room_id, 'timestamp': {'$lt': cutoff}}).sort([('timestamp', 1), ('_id', 1)])
+            for doc in old:
+                doc.pop('room', None)
+                chunk.append(doc)
+                if len(chunk) == chunk_size:
+                    archived += self.move(messages, room_id, chunk)
+                    chunk = []
+            if chunk:
+                archived += self.move(messages, room_id, chunk)
+
+        return archived
+
+    def move(self, messages, room_id, chunk):
+        MessageArchive.archive(room_id, chunk)
+        messages.delete_many({'_id': {'$in': [doc['_id'] for doc in chunk]}})
+        return len(chunk)
+
+    def archive_buckets(self, cutoff):
+        """
+        Archive whole buckets whose newest message is older than the cutoff
+        """
+        buckets = MessageBucket._get_collection()
+        archived = 0
+
+        old = buckets.find({'last_timestamp': {'$lt': cutoff}}).sort([('room', 1), ('first_timestamp', 1)])
+        for bucket in old:
+            docs = sorted(bucket['messages'], key=lambda doc: (doc['timestamp'], doc['_id']))
+            if docs:
+                MessageArchive.archive(bucket['room'], docs)
+            # A message appended since the bucket was read changes count; archive it next run
+            if not buckets.delete_one({'_id': bucket['_id'], 'count': bucket['count']}).deleted_count:
+                if docs:
+                    MessageArchive.discard(bucket['room'], docs)
+                continue
+            archived += len(docs)
+
+        return archived
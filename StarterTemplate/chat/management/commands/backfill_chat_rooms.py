@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from mongoengine.queryset.visitor import Q
+from chat.models import ChatRoom, make_preview
+from chat.encryption import encrypt_message
+
+
+class Command(BaseCommand):
+    help = 'Backfill participants and denormalized inbox summaries on existing chat rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Recompute rooms that already have a summary')
+
+    def handle(self, *args, **options):
+        force = options['force']
+
+        # Participants array used by the room-list index
+        backfilled = 0
+        missing = Q(participants__exists=False) | Q(participants__size=0)
+        for room in ChatRoom.objects(missing).no_dereference().only('user1', 'user2'):
+            ChatRoom.objects(id=room.id).update_one(set__participants=[room.user1.id, room.user2.id])
+            backfilled += 1
+        self.stdout.write(f'Backfilled participants on {backfilled} chat room(s)')
+
+        # Inbox summaries
+        updated = 0
+        for room in ChatRoom.objects.no_dereference():
+            if room.last_message_preview and not force:
+                continue
+
+            # Newest message in whichever storage mode and tier holds it
+            newest = room.load_messages('before', None, 1)
+            if not newest:
+                continue
+            last_msg = newest[0]
+
+            unread_counts = {
+                str(user.id): room.count_unread(user)
+                for user in (room.user1, room.user2)
+            }
+
+            ChatRoom.objects(id=room.id).update_one(
+                set__last_message_at=last_msg.timestamp,
+                set__last_message_id=last_msg.id,
+                set__last_message_preview=encrypt_message(make_preview(last_msg.get_decrypted_content()), room.id),
+                set__last_sender=last_msg.sender,
+                set__unread_counts=unread_counts,
+            )
+            updated += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled inbox summaries on {updated} chat room(s)'))
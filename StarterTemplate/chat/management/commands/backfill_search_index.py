@@ -0,0 +1,60 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatRoom, Message, MessageBucket, MessageArchive, MessageSearchIndex
+from chat.encryption import decrypt_message
+
+
+class Command(BaseCommand):
+    help = 'Add existing chat messages (in every storage tier) to the blind keyword search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only index this room id')
+        parser.add_argument('--batch-size', type=int, default=500, help='Index entries written per insert')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Drop existing entries first (needed after changing CHAT_SEARCH_KEY)'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        if options['room']:
+            try:
+                room_ids = [ObjectId(options['room'])]
+            except InvalidId:
+                raise CommandError(f'Invalid room id: {options["room"]}')
+        else:
+            room_ids = ChatRoom._get_collection().distinct('_id')
+
+        indexed = 0
+        for room_id in room_ids:
+            if options['rebuild']:
+                MessageSearchIndex._get_collection().delete_many({'room': room_id})
+
+            batch = []
+            for doc in self.room_messages(room_id):
+                entry = MessageSearchIndex.entry(
+                    room_id, doc['_id'], doc['timestamp'], decrypt_message(doc.get('encrypted_content', ''), room_id)
+                )
+                if entry:
+                    batch.append(entry)
+                if len(batch) >= options['batch_size']:
+                    MessageSearchIndex.insert_entries(batch)
+                    indexed += len(batch)
+                    batch = []
+            MessageSearchIndex.insert_entries(batch)
+            indexed += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} message(s) in {len(room_ids)} room(s)'))
+
+    def room_messages(self, room_id):
+        """
+        Raw message documents of a room from the hot collections and archives
+        """
+        yield from Message._get_collection().find({'room': room_id})
+        for bucket in MessageBucket._get_collection().find({'room': room_id}):
+            yield from bucket['messages']
+        for archive in MessageArchive._get_collection().find({'room': room_id}):
+            yield from MessageArchive.unpack(archive['data'])
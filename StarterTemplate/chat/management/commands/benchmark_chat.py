@@ -0,0 +1,403 @@
+import asyncio
+import os
+import secrets
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from bson import ObjectId
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import User
+from chat.models import ChatRoom, ChatRoomDeletion, Message
+from chat.message_cache import get_message_cache
+from chat.room_keys import get_key_cache
+from chat.encryption import encrypt_message, decrypt_message, decrypt_messages, cipher, DECRYPT_CHUNK_SIZE
+from chat.async_store import AsyncChatStore
+from chat.codec import JsonWire, MsgpackWire, msgpack_enabled, orjson
+from chat.consumers import ChatConsumer, message_event
+from chat.coalescing import FrameCoalescer, get_coalescing_stats
+
+
+BENCH_PREFIX = 'bench_'
+
+
+def legacy_create_message(room_id, sender, content):
+    """
+    Message persistence as it used to be: insert the message, then load and
+    save the whole room to bump last_message_at
+    """
+    message = Message(room=room_id, sender=sender, encrypted_content=encrypt_message(content))
+    message.save()
+    room = ChatRoom.objects.get(id=room_id)
+    room.last_message_at = datetime.now()
+    room.save()
+    return message
+
+
+class Command(BaseCommand):
+    help = 'Benchmark chat hot paths against the configured MongoDB (creates and removes its own bench_<run>_ users)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(self.scenarios()), help='Benchmark to run')
+        parser.add_argument('--messages', type=int, default=1000, help='Number of messages per run')
+        parser.add_argument('--size', type=int, default=200, help='Message size in characters')
+        parser.add_argument('--concurrency', type=int, default=50, help='Concurrent senders for load tests')
+        parser.add_argument('--listeners', type=int, default=100, help='Sockets per room group for fanout')
+
+    @classmethod
+    def scenarios(cls):
+        return {
+            'consumer_paths': cls.bench_consumer_paths,
+            'create_message': cls.bench_create_message,
+            'decrypt_batch': cls.bench_decrypt_batch,
+            'decrypt_cache': cls.bench_decrypt_cache,
+            'coalescing': cls.bench_coalescing,
+            'encryption': cls.bench_encryption,
+            'fanout': cls.bench_fanout,
+        }
+
+    def handle(self, *args, **options):
+        if options['messages'] < 1:
+            raise CommandError('--messages must be at least 1')
+
+        self.content = 'x' * options['size']
+        self.alice, self.bob = self.make_users()
+        try:
+            self.scenarios()[options['scenario']](self, options)
+        finally:
+            self.cleanup()
+
+    # -------------------------------------------------------------------
+    # Fixtures
+    # -------------------------------------------------------------------
+    def make_users(self):
+        """
+        Two new users named for this run only, so existing accounts
+        (bench_ or not) are never reused or deleted
+        """
+        self.run_id = secrets.token_hex(4)
+        self.room_ids = []
+        users = []
+        for name in ('alice', 'bob'):
+            username = f'{BENCH_PREFIX}{self.run_id}_{name}'
+            if User.objects(username=username).first():
+                for user in users:
+                    user.delete()
+                raise CommandError(f'User {username} already exists; not touching it')
+            user = User(username=username, email=f'{username}@example.com')
+            user.save()
+            users.append(user)
+        return users
+
+    def make_room(self):
+        self.clear_rooms()
+        room = ChatRoom.get_or_create_room(self.alice, self.bob)
+        self.room_ids.append(room.id)
+        return room
+
+    def clear_rooms(self):
+        """
+        Delete the rooms this run created through the regular deletion path,
+        so buckets, archives, search index entries and cached keys/plaintexts
+        go too (data keys live on the room)
+        """
+        room_ids, self.room_ids = self.room_ids, []
+        ChatRoomDeletion.schedule(room_ids)
+        for deletion in ChatRoomDeletion.objects(room__in=room_ids):
+            while deletion.purge_batch(10000) is not None:
+                pass
+            deletion.delete()
+        for room_id in room_ids:
+            get_key_cache().invalidate_room(room_id)
+
+    def cleanup(self):
+        self.clear_rooms()
+        for user in (self.alice, self.bob):
+            user.delete()
+
+    def report(self, label, count, elapsed, unit='messages', latencies=None):
+        rate = count / elapsed if elapsed else float('inf')
+        line = f'{label:<36} {count:>8} {unit} in {elapsed:8.3f}s  {rate:12.1f} {unit}/s'
+        if latencies:
+            latencies = sorted(latencies)
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+            line += f'  p50 {p50 * 1000:7.2f}ms  p99 {p99 * 1000:7.2f}ms'
+        self.stdout.write(line)
+
+    def message_data(self):
+        return {
+            'room_id': str(ObjectId()),
+            'content': self.content,
+            'sender_id': str(self.alice.id),
+            'sender_username': self.alice.username,
+            'timestamp': datetime.now().strftime('%H:%M'),
+            'message_id': str(ObjectId()),
+        }
+
+    async def run_fanout(self, make_event, count, listeners, make_coalescer=None, wire=JsonWire):
+        """
+        Broadcast count events to listeners ChatConsumers through the configured
+        channel layer; returns (elapsed, WebSocket frames sent)
+        """
+        layer = get_channel_layer()
+        group = f'{BENCH_PREFIX}fanout'
+        sent = []
+
+        async def collect(message):
+            sent.append(message)
+
+        consumers = []
+        for _ in range(listeners):
+            consumer = ChatConsumer()
+            consumer.room_id = group
+            consumer.channel_layer = layer
+            consumer.channel_name = await layer.new_channel()
+            consumer.base_send = collect
+            consumer.wire = wire
+            if make_coalescer:
+                consumer.coalescer = make_coalescer(consumer)
+            await layer.group_add(group, consumer.channel_name)
+            consumers.append(consumer)
+        try:
+            start = time.perf_counter()
+            for _ in range(count):
+                await layer.group_send(group, make_event())
+                for consumer in consumers:
+                    await consumer.chat_message(await layer.receive(consumer.channel_name))
+            for consumer in consumers:
+                if consumer.coalescer is not None:
+                    await consumer.coalescer.flush()
+            elapsed = time.perf_counter() - start
+        finally:
+            for consumer in consumers:
+                await layer.group_discard(group, consumer.channel_name)
+        return elapsed, len(sent)
+
+    async def run_senders(self, send, count, concurrency):
+        """
+        Run count sends spread over concurrency tasks; returns (elapsed, latencies)
+        """
+        latencies = []
+
+        async def sender(n):
+            for _ in range(n):
+                start = time.perf_counter()
+                await send()
+                latencies.append(time.perf_counter() - start)
+
+        per_sender, extra = divmod(count, concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            sender(per_sender + (1 if i < extra else 0)) for i in range(concurrency)
+        ))
+        return time.perf_counter() - start, latencies
+
+    # -------------------------------------------------------------------
+    # Scenarios
+    # -------------------------------------------------------------------
+    def bench_create_message(self, options):
+        """Message persistence: legacy load-and-save vs. single atomic room update"""
+        count = options['messages']
+
+        room = self.make_room()
+        start = time.perf_counter()
+        for _ in range(count):
+            legacy_create_message(room.id, self.alice, self.content)
+        self.report('legacy (insert + room save)', count, time.perf_counter() - start)
+
+        room = self.make_room()
+        start = time.perf_counter()
+        for _ in range(count):
+            Message.create_message(room, self.alice, self.content)
+        self.report('create_message (insert + $set/$inc)', count, time.perf_counter() - start)
+
+    def bench_consumer_paths(self, options):
+        """WebSocket persistence: database_sync_to_async thread hop vs. native motor"""
+        count, concurrency = options['messages'], max(1, options['concurrency'])
+        room_id, sender_id = None, self.alice.id
+
+        @database_sync_to_async
+        def sync_save():
+            room = ChatRoom.objects.get(id=room_id)
+            sender = User.objects.get(id=sender_id)
+            Message.create_message(room, sender, self.content)
+
+        room_id = self.make_room().id
+        elapsed, latencies = asyncio.run(self.run_senders(sync_save, count, concurrency))
+        self.report(f'database_sync_to_async (c={concurrency})', count, elapsed, latencies=latencies)
+
+        room_id = self.make_room().id
+
+        async def run_async():
+            store = AsyncChatStore(settings.MONGO_URI)
+
+            async def async_save():
+                room = await store.get_room(room_id)
+                await store.create_message(room, sender_id, self.content)
+
+            try:
+                return await self.run_senders(async_save, count, concurrency)
+            finally:
+                store.client.close()
+
+        elapsed, latencies = asyncio.run(run_async())
+        self.report(f'motor (c={concurrency})', count, elapsed, latencies=latencies)
+
+    def bench_encryption(self, options):
+        """Ciphertext formats: legacy CBC/base64 text vs. AES-GCM envelopes (global and per-room key)"""
+        count = options['messages']
+        plaintext_size = len(self.content.encode('utf-8'))
+
+        room_id = self.make_room().id
+        formats = (
+            ('cbc/base64 (legacy)', cipher.encrypt_cbc),
+            ('gcm envelope', cipher.encrypt_gcm),
+            ('room key envelope', lambda content: encrypt_message(content, room_id)),
+        )
+        for label, encrypt in formats:
+            start = time.perf_counter()
+            ciphertexts = [encrypt(self.content) for _ in range(count)]
+            self.report(f'{label} encrypt', count, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for ciphertext in ciphertexts:
+                decrypt_message(ciphertext, room_id)
+            self.report(f'{label} decrypt', count, time.perf_counter() - start)
+
+            # Bytes as stored in MongoDB (strings are UTF-8, envelopes are BinData)
+            stored = len(ciphertexts[0].encode('utf-8') if isinstance(ciphertexts[0], str) else ciphertexts[0])
+            self.stdout.write(
+                f'{label + " stored":<36} {stored:>8} bytes per {plaintext_size}-byte message '
+                f'({stored - plaintext_size:+d} overhead)'
+            )
+
+    def bench_decrypt_cache(self, options):
+        """History page reads with and without the decrypted message cache"""
+        count = options['messages']
+        page_size, rounds = 100, 10
+
+        room = self.make_room()
+        Message.bulk_create([Message.build_message(room, self.alice, self.content) for _ in range(count)])
+
+        def read_pages():
+            cursor, pages, read = None, 0, 0
+            for _ in range(rounds):
+                while True:
+                    messages, cursor, _ = room.get_messages_page(limit=page_size, before=cursor)
+                    pages += 1
+                    read += len(messages)
+                    if not cursor:
+                        break
+            return read
+
+        cache_bytes = settings.CHAT_DECRYPT_CACHE_BYTES
+        try:
+            settings.CHAT_DECRYPT_CACHE_BYTES = 0
+            start = time.perf_counter()
+            read = read_pages()
+            self.report('pages, cache disabled', read, time.perf_counter() - start)
+
+            settings.CHAT_DECRYPT_CACHE_BYTES = cache_bytes or 16 * 1024 * 1024
+            cache = get_message_cache()
+            cache.clear()
+            start = time.perf_counter()
+            read = read_pages()
+            self.report('pages, cache enabled', read, time.perf_counter() - start)
+            self.stdout.write(f'cache stats: {cache.stats()}')
+        finally:
+            settings.CHAT_DECRYPT_CACHE_BYTES = cache_bytes
+
+    def bench_decrypt_batch(self, options):
+        """decrypt_messages scaling across worker counts, threads vs. processes"""
+        count = options['messages']
+        ciphertexts = [encrypt_message(self.content) for _ in range(count)]
+
+        start = time.perf_counter()
+        expected = [cipher.decrypt(ciphertext) for ciphertext in ciphertexts]
+        self.report('sequential loop', count, time.perf_counter() - start)
+
+        cores = os.cpu_count() or 1
+        worker_counts = sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+        for executor in (ThreadPoolExecutor, ProcessPoolExecutor):
+            kind = 'processes' if executor is ProcessPoolExecutor else 'threads'
+            for workers in worker_counts:
+                with executor(max_workers=workers) as pool:
+                    # Warm the pool up first, like a long export or rotation reusing it
+                    decrypt_messages(ciphertexts[:DECRYPT_CHUNK_SIZE + 1], pool=pool)
+                    start = time.perf_counter()
+                    plaintexts = decrypt_messages(ciphertexts, pool=pool)
+                    elapsed = time.perf_counter() - start
+                if plaintexts != expected:
+                    raise CommandError(f'decrypt_messages ({kind}, {workers}) returned wrong results')
+                self.report(f'decrypt_messages {kind} x{workers}', count, elapsed)
+
+    def bench_fanout(self, options):
+        """Room broadcasts to many listeners: per-listener encoding vs. one pre-encoded frame, per codec and wire format"""
+        count, listeners = options['messages'], max(1, options['listeners'])
+        message_data = self.message_data()
+
+        def field_event():
+            # Broadcast as it used to be: fields only, each listener encodes its own frame
+            return {
+                'type': 'chat_message',
+                'message': message_data['content'],
+                'sender_id': message_data['sender_id'],
+                'sender_username': message_data['sender_username'],
+                'timestamp': message_data['timestamp'],
+                'message_id': message_data['message_id'],
+            }
+
+        def frame_event():
+            return message_event(message_data)
+
+        codecs = ['json'] + (['orjson'] if orjson is not None else [])
+        codec_setting = getattr(settings, 'CHAT_JSON_CODEC', 'auto')
+        try:
+            for codec in codecs:
+                settings.CHAT_JSON_CODEC = codec
+                for label, make_event in (('per-listener encode', field_event), ('pre-encoded frame', frame_event)):
+                    elapsed, sent = asyncio.run(self.run_fanout(make_event, count, listeners))
+                    if sent != count * listeners:
+                        raise CommandError(f'Expected {count * listeners} frames, sent {sent}')
+                    self.report(f'{codec} {label} (x{listeners})', count * listeners, elapsed, unit='frames')
+        finally:
+            settings.CHAT_JSON_CODEC = codec_setting
+
+        if msgpack_enabled():
+            elapsed, sent = asyncio.run(self.run_fanout(frame_event, count, listeners, wire=MsgpackWire))
+            self.report(f'msgpack pre-encoded frame (x{listeners})', count * listeners, elapsed, unit='frames')
+            payload = JsonWire.decode(frame_event()[JsonWire.event_key])
+            self.stdout.write(
+                f'{"frame size":<36} json {len(JsonWire.encode(payload).encode("utf-8"))} bytes, '
+                f'msgpack {len(MsgpackWire.encode(payload))} bytes'
+            )
+
+    def bench_coalescing(self, options):
+        """Bursty room broadcasts with and without outbound frame coalescing (ratio and added latency)"""
+        count, listeners = options['messages'], max(1, options['listeners'])
+        message_data = self.message_data()
+
+        def frame_event():
+            return message_event(message_data)
+
+        elapsed, sent = asyncio.run(self.run_fanout(frame_event, count, listeners))
+        self.report(f'one frame per message (x{listeners})', count * listeners, elapsed)
+        self.stdout.write(f'{"":<36} {sent:>8} frames')
+
+        for window_ms, max_messages in ((5, 10), (5, 50), (20, 50)):
+            stats = get_coalescing_stats()
+            stats.reset()
+
+            def make_coalescer(consumer):
+                return FrameCoalescer(consumer.send_encoded, window=window_ms / 1000, max_messages=max_messages)
+
+            elapsed, sent = asyncio.run(self.run_fanout(frame_event, count, listeners, make_coalescer))
+            result = stats.stats()
+            self.report(f'coalesced {window_ms}ms/{max_messages} (x{listeners})', count * listeners, elapsed)
+            self.stdout.write(
+                f'{"":<36} {sent:>8} frames  ratio {result["coalescing_ratio"]:.1f} msg/frame  '
+                f'added latency avg {result["avg_delay_ms"]:.2f}ms max {result["max_delay_ms"]:.2f}ms'
+            )
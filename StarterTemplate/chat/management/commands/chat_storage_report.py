@@ -0,0 +1,107 @@
+from collections import Counter
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import Message
+from chat.encryption import (
+    decrypt_messages, ciphertext_format, pack_plaintext, compress_threshold,
+    DECRYPTION_FAILED, ENVELOPE_HEADER_SIZE, ROOM_ENVELOPE_HEADER_SIZE
+)
+
+HEADER_SIZES = {'gcm': ENVELOPE_HEADER_SIZE, 'room': ROOM_ENVELOPE_HEADER_SIZE}
+
+
+def stored_size(ciphertext):
+    """
+    Bytes a ciphertext takes in MongoDB (strings are UTF-8, envelopes are BinData)
+    """
+    if isinstance(ciphertext, str):
+        return len(ciphertext.encode('utf-8'))
+    return len(ciphertext or b'')
+
+
+class Command(BaseCommand):
+    help = 'Report ciphertext sizes in chat_messages and the bytes saved by compressing long messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only report on this room id')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages decrypted per batch')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        messages = Message._get_collection()
+        if options['room']:
+            try:
+                room_ids = [ObjectId(options['room'])]
+            except InvalidId:
+                raise CommandError(f'Invalid room id: {options["room"]}')
+        else:
+            room_ids = messages.distinct('room')
+
+        self.formats = Counter()
+        self.totals = Counter()
+        for room_id in room_ids:
+            batch = []
+            for doc in messages.find({'room': room_id}, {'encrypted_content': 1}):
+                batch.append(doc.get('encrypted_content'))
+                if len(batch) >= options['batch_size']:
+                    self.measure(room_id, batch)
+                    batch = []
+            self.measure(room_id, batch)
+
+        self.write_report()
+
+    def measure(self, room_id, ciphertexts):
+        """
+        Add a batch of one room's ciphertexts to the totals
+        """
+        if not ciphertexts:
+            return
+        for ciphertext, plaintext in zip(ciphertexts, decrypt_messages(ciphertexts, room_id=room_id)):
+            kind, compressed = ciphertext_format(ciphertext)
+            self.formats[kind] += 1
+            self.totals['messages'] += 1
+            self.totals['stored'] += stored_size(ciphertext)
+            if plaintext == DECRYPTION_FAILED:
+                self.totals['undecryptable'] += 1
+                continue
+
+            size = len(plaintext.encode('utf-8'))
+            self.totals['plaintext'] += size
+            if compressed:
+                self.totals['compressed'] += 1
+                self.totals['compressed_plaintext'] += size
+                self.totals['compressed_payload'] += stored_size(ciphertext) - HEADER_SIZES[kind]
+                continue
+
+            flags, payload = pack_plaintext(plaintext)
+            if flags:
+                # Not compressed yet (older or legacy ciphertext) but would be if rewritten
+                self.totals['eligible'] += 1
+                self.totals['eligible_savings'] += size - len(payload)
+
+    def write_report(self):
+        totals = self.totals
+        formats = ', '.join(f'{kind} {count}' for kind, count in sorted(self.formats.items())) or 'none'
+        self.stdout.write(f'Messages:           {totals["messages"]} ({formats})')
+        self.stdout.write(f'Plaintext:          {totals["plaintext"]} bytes')
+        self.stdout.write(
+            f'Stored ciphertext:  {totals["stored"]} bytes '
+            f'({totals["stored"] - totals["plaintext"]:+d} vs. plaintext)'
+        )
+        self.stdout.write(
+            f'Compressed:         {totals["compressed"]} message(s) over the '
+            f'{compress_threshold()}-byte threshold'
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Saved by compression: {totals["compressed_plaintext"] - totals["compressed_payload"]} bytes'
+        ))
+        if totals['eligible']:
+            self.stdout.write(
+                f'{totals["eligible"]} older message(s) would save another {totals["eligible_savings"]} bytes '
+                f'once rewritten (python manage.py rotate_chat_keys)'
+            )
+        if totals['undecryptable']:
+            self.stdout.write(self.style.WARNING(f'{totals["undecryptable"]} message(s) could not be decrypted'))
@@ -0,0 +1,38 @@
+import sys
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = 'Export the decrypted history of a chat room as a plain-text transcript'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id', help='Chat room id')
+        parser.add_argument('--output', help='Write to this file instead of stdout')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Messages decrypted per batch')
+        parser.add_argument(
+            '--processes', action='store_true',
+            help='Decrypt on a process pool instead of threads (for very large rooms)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            room = ChatRoom.objects.get(id=ObjectId(options['room_id']))
+        except (InvalidId, ChatRoom.DoesNotExist):
+            raise CommandError(f'Chat room not found: {options["room_id"]}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        exported = 0
+        try:
+            for msg in room.export_messages(batch_size=options['batch_size'], processes=options['processes']):
+                out.write(f"[{msg.timestamp:%Y-%m-%d %H:%M:%S}] {msg.sender.username}: {msg.decrypted_content}\n")
+                exported += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        self.stderr.write(self.style.SUCCESS(f'Exported {exported} message(s)'))
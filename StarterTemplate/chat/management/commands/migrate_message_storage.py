@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand
+from pymongo.errors import BulkWriteError
+from chat.models import Message, MessageBucket
+
+
+class Command(BaseCommand):
+    help = 'Move existing chat messages between per-message documents and per-room buckets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=['buckets', 'documents'], required=True, help='Target storage mode')
+
+    def handle(self, *args, **options):
+        if options['to'] == 'buckets':
+            moved = self.to_buckets()
+        else:
+            moved = self.to_documents()
+
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} message(s) to {options["to"]}'))
+        self.stdout.write(f'Set CHAT_MESSAGE_STORAGE={options["to"]} to read and write in this mode')
+
+    def to_buckets(self):
+        """
+        Pack each room's messages, oldest first, into full buckets.
+        Each bucket is written before its messages are removed, and messages
+        already in a bucket are not packed again, so an interrupted run can
+        simply be started again
+        """
+        messages = Message._get_collection()
+        buckets = MessageBucket._get_collection()
+        size = MessageBucket.bucket_size()
+        moved = 0
+
+        for room_id in messages.distinct('room'):
+            chunk = []
+            for doc in messages.find({'room': room_id}).sort([('timestamp', 1), ('_id', 1)]):
+                doc.pop('room', None)
+                chunk.append(doc)
+                if len(chunk) == size:
+                    moved += self.write_bucket(messages, buckets, room_id, chunk)
+                    chunk = []
+            if chunk:
+                moved += self.write_bucket(messages, buckets, room_id, chunk)
+
+        return moved
+
+    def write_bucket(self, messages, buckets, room_id, chunk):
+        # Packed by an interrupted run that did not get to remove them
+        stored = MessageBucket.stored_ids([doc['_id'] for doc in chunk])
+        fresh = [doc for doc in chunk if doc['_id'] not in stored]
+        if fresh:
+            buckets.insert_one({
+                'room': room_id,
+                'count': len(fresh),
+                'first_timestamp': fresh[0]['timestamp'],
+                'last_timestamp': fresh[-1]['timestamp'],
+                'messages': fresh,
+            })
+        messages.delete_many({'_id': {'$in': [doc['_id'] for doc in chunk]}})
+        return len(chunk)
+
+    def to_documents(self):
+        """
+        Unpack every bucket back into one document per message
+        """
+        messages = Message._get_collection()
+        buckets = MessageBucket._get_collection()
+        moved = 0
+
+        for bucket in buckets.find():
+            docs = [dict(doc, room=bucket['room']) for doc in bucket['messages']]
+            if docs:
+                try:
+                    messages.insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # Messages already unpacked by an interrupted run
+                    if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                        raise
+            buckets.delete_one({'_id': bucket['_id']})
+            moved += len(docs)
+
+        return moved
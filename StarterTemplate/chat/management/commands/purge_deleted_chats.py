@@ -0,0 +1,52 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatRoomDeletion
+
+
+class Command(BaseCommand):
+    help = 'Remove the messages of deleted chat rooms in small, throttled batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Messages deleted per batch (default: CHAT_PURGE_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--pause-ms', type=int, default=None,
+            help='Pause between batches in milliseconds (default: CHAT_PURGE_PAUSE_MS)'
+        )
+        parser.add_argument(
+            '--every', type=int, default=0,
+            help='Keep running and look for new deletions every N seconds (background worker mode)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or settings.CHAT_PURGE_BATCH_SIZE
+        pause_ms = settings.CHAT_PURGE_PAUSE_MS if options['pause_ms'] is None else options['pause_ms']
+        if batch_size < 1 or pause_ms < 0:
+            raise CommandError('--batch-size must be at least 1 and --pause-ms cannot be negative')
+
+        while True:
+            purged = 0
+            for deletion in ChatRoomDeletion.pending():
+                self.purge(deletion, batch_size, pause_ms / 1000)
+                purged += 1
+            if purged:
+                self.stdout.write(self.style.SUCCESS(f'Purged {purged} deleted room(s)'))
+
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+
+    def purge(self, deletion, batch_size, pause):
+        """
+        Purge one room batch by batch, reporting progress after each batch
+        """
+        while True:
+            deleted = deletion.purge_batch(batch_size)
+            if deleted is None:
+                break
+            self.stdout.write(f'Room {deletion.room}: {deletion.deleted_messages} message(s) deleted')
+            if pause:
+                time.sleep(pause)
@@ -0,0 +1,147 @@
+import time
+import bson
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+from chat.models import ChatRoom, Message, MessageBucket, MessageArchive
+from chat.encryption import (
+    encrypt_message, decrypt_message, encryption_format, is_legacy_ciphertext, DECRYPTION_FAILED
+)
+
+LEGACY = {'$type': 'string', '$ne': ''}
+
+
+class Command(BaseCommand):
+    help = 'Rewrite legacy CBC/base64 chat ciphertexts (every storage tier) in the AES-GCM envelope format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Messages rewritten per batch')
+        parser.add_argument('--pause-ms', type=int, default=0, help='Pause between batches in milliseconds')
+        parser.add_argument(
+            '--every', type=int, default=0,
+            help='Keep running and look for legacy data every N seconds (background job mode)'
+        )
+
+    def handle(self, *args, **options):
+        if encryption_format() == 'cbc':
+            raise CommandError('CHAT_ENCRYPTION_FORMAT is "cbc"; set it to "room" or "gcm" before re-encrypting')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        self.batch_size = options['batch_size']
+        self.pause = options['pause_ms'] / 1000
+
+        while True:
+            counts = {
+                'message(s)': self.reencrypt_documents(),
+                'bucketed message(s)': self.reencrypt_buckets(),
+                'archived message(s)': self.reencrypt_archives(),
+                'room preview(s)': self.reencrypt_previews(),
+            }
+            self.stdout.write(self.style.SUCCESS(
+                'Re-encrypted ' + ', '.join(f'{count} {label}' for label, count in counts.items())
+            ))
+
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+
+    def rewrite(self, ciphertext, room_id):
+        """
+        New envelope for a legacy ciphertext, or None if it cannot be decrypted
+        """
+        plaintext = decrypt_message(ciphertext, room_id)
+        if plaintext == DECRYPTION_FAILED:
+            return None
+        return encrypt_message(plaintext, room_id)
+
+    def throttle(self):
+        if self.pause:
+            time.sleep(self.pause)
+
+    def reencrypt_documents(self):
+        messages = Message._get_collection()
+        done, skip = 0, []
+        while True:
+            batch = list(messages.find(
+                {'encrypted_content': LEGACY, '_id': {'$nin': skip}}, {'encrypted_content': 1, 'room': 1}
+            ).limit(self.batch_size))
+            if not batch:
+                return done
+            updates = []
+            for doc in batch:
+                new = self.rewrite(doc['encrypted_content'], doc['room'])
+                if new is None:
+                    skip.append(doc['_id'])
+                    continue
+                # Only if unchanged since it was read
+                updates.append(UpdateOne(
+                    {'_id': doc['_id'], 'encrypted_content': doc['encrypted_content']},
+                    {'$set': {'encrypted_content': new}}
+                ))
+            if updates:
+                done += messages.bulk_write(updates, ordered=False).modified_count
+            self.throttle()
+
+    def reencrypt_buckets(self):
+        buckets = MessageBucket._get_collection()
+        done, skip = 0, []
+        while True:
+            bucket = buckets.find_one({
+                'messages': {'$elemMatch': {'encrypted_content': LEGACY}},
+                '_id': {'$nin': skip},
+            })
+            if not bucket:
+                return done
+            updates = []
+            for doc in bucket['messages']:
+                old = doc.get('encrypted_content')
+                if not old or not is_legacy_ciphertext(old):
+                    continue
+                new = self.rewrite(old, bucket['room'])
+                if new is not None:
+                    updates.append(UpdateOne(
+                        {'_id': bucket['_id'], 'messages': {'$elemMatch': {'_id': doc['_id'], 'encrypted_content': old}}},
+                        {'$set': {'messages.$.encrypted_content': new}}
+                    ))
+            if updates:
+                done += buckets.bulk_write(updates, ordered=False).modified_count
+            if len(updates) < sum(1 for doc in bucket['messages'] if is_legacy_ciphertext(doc.get('encrypted_content'))):
+                skip.append(bucket['_id'])
+            self.throttle()
+
+    def reencrypt_archives(self):
+        """
+        Archives are write-once, so each one is unpacked, rewritten and repacked whole
+        """
+        archives = MessageArchive._get_collection()
+        done = 0
+        for archive in archives.find({'legacy_ciphertexts': {'$ne': 0}}, {'data': 1, 'room': 1}):
+            docs = MessageArchive.unpack(archive['data'])
+            changed = failed = 0
+            for doc in docs:
+                old = doc.get('encrypted_content')
+                if old and is_legacy_ciphertext(old):
+                    new = self.rewrite(old, archive['room'])
+                    if new is None:
+                        failed += 1
+                    else:
+                        doc['encrypted_content'] = new
+                        changed += 1
+            update = {'legacy_ciphertexts': failed}
+            if changed:
+                update['data'] = bson.Binary(MessageArchive.pack(docs))
+                done += changed
+            archives.update_one({'_id': archive['_id'], 'data': archive['data']}, {'$set': update})
+            self.throttle()
+        return done
+
+    def reencrypt_previews(self):
+        rooms = ChatRoom._get_collection()
+        done = 0
+        for room in rooms.find({'last_message_preview': LEGACY}, {'last_message_preview': 1}):
+            new = self.rewrite(room['last_message_preview'], room['_id'])
+            if new is not None:
+                done += rooms.update_one(
+                    {'_id': room['_id'], 'last_message_preview': room['last_message_preview']},
+                    {'$set': {'last_message_preview': new}}
+                ).modified_count
+        return done
@@ -0,0 +1,297 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import bson
+from bson import ObjectId
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import UpdateOne
+from chat.models import ChatRoom, ChatKeyRotation, Message, MessageBucket, MessageArchive
+from chat.encryption import (
+    decrypt_messages, encrypt_with_room_key, room_key_version, DECRYPTION_FAILED
+)
+from chat.pagination import encode_cursor, decode_cursor
+from chat.room_keys import (
+    RoomKeyError, get_room_key, rotate_room_key, rewrap_room_keys, prune_room_keys, get_key_cache
+)
+
+TIERS = ('documents', 'buckets', 'archives')
+
+
+def id_marker(moment):
+    """
+    Smallest ObjectId generated at or after a local naive datetime
+    """
+    return ObjectId.from_datetime(moment + (datetime.utcnow() - datetime.now()))
+
+
+def catch_up_wait(rotation, ttl):
+    """
+    Seconds until no process can still hold a room key cached before the
+    rooms phase ended
+    """
+    # Rotations checkpointed before rooms_finished_at existed: wait a full TTL
+    finished = rotation.rooms_finished_at or datetime.now()
+    return (finished + timedelta(seconds=ttl) - datetime.now()).total_seconds()
+
+
+class Command(BaseCommand):
+    help = (
+        'Give every chat room a new data key and re-encrypt its messages (all tiers) in '
+        'throttled, checkpointed batches while chat traffic continues; resumes an interrupted run'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Messages re-encrypted per batch')
+        parser.add_argument('--workers', type=int, default=4, help='Threads encrypting each batch in parallel')
+        parser.add_argument('--pause-ms', type=int, default=50, help='Pause between batches in milliseconds')
+        parser.add_argument('--restart', action='store_true', help='Abandon an unfinished rotation and start over')
+        parser.add_argument(
+            '--rewrap-only', action='store_true',
+            help='Only re-wrap existing room keys under the current ENCRYPTION_KEY (after a master key change)'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1 or options['pause_ms'] < 0:
+            raise CommandError('--batch-size and --workers must be at least 1 and --pause-ms cannot be negative')
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.pause = options['pause_ms'] / 1000
+
+        if options['rewrap_only']:
+            rooms = 0
+            for room in ChatRoom._get_collection().find({'data_keys': {'$exists': True}}, {'_id': 1}):
+                rewrap_room_keys(room['_id'])
+                rooms += 1
+            self.stdout.write(self.style.SUCCESS(f'Re-wrapped the data keys of {rooms} room(s)'))
+            return
+
+        rotation = ChatKeyRotation.objects(finished_at=None).order_by('-started_at').first()
+        if rotation and options['restart']:
+            rotation.update(set__finished_at=datetime.now(), set__phase='abandoned')
+            rotation = None
+        if rotation:
+            self.stdout.write(f'Resuming rotation started {rotation.started_at:%Y-%m-%d %H:%M:%S} '
+                              f'({rotation.rooms_done} room(s) done)')
+        else:
+            rotation = ChatKeyRotation()
+            rotation.save()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as self.pool:
+            if rotation.phase == 'rooms':
+                self.rotate_rooms(rotation)
+                self.checkpoint(rotation, phase='catchup', rooms_finished_at=datetime.now())
+            if rotation.phase == 'catchup':
+                self.catch_up(rotation)
+                self.checkpoint(rotation, phase='prune')
+            if rotation.phase == 'prune':
+                pruned = sum(self.prune(room) for room in ChatRoom._get_collection().find(
+                    {'data_key_version': {'$ne': None}}, {'data_key_version': 1}
+                ))
+                self.stdout.write(f'Dropped {pruned} retired data key(s)')
+
+        self.checkpoint(rotation, finished_at=datetime.now())
+        self.stdout.write(self.style.SUCCESS(
+            f'Rotated {rotation.rooms_done} room(s): {rotation.reencrypted} message(s) re-encrypted, '
+            f'{rotation.failed} could not be decrypted'
+        ))
+
+    def checkpoint(self, rotation, **fields):
+        for name, value in fields.items():
+            setattr(rotation, name, value)
+        rotation.save()
+
+    # -------------------------------------------------------------------
+    # Re-encryption
+    # -------------------------------------------------------------------
+    def reencrypt(self, rotation, room_id, ciphertexts, version):
+        """
+        Re-encrypt ciphertexts of a room under data key version, in parallel.
+        Returns the new ciphertexts, None for ones already current or unreadable
+        """
+        stale = [i for i, ciphertext in enumerate(ciphertexts) if ciphertext and room_key_version(ciphertext) != version]
+        if not stale:
+            return [None] * len(ciphertexts)
+
+        plaintexts = decrypt_messages([ciphertexts[i] for i in stale], room_id=room_id, pool=self.pool)
+        _, key = get_room_key(room_id, version)
+
+        def encrypt_chunk(chunk):
+            return [None if plaintext == DECRYPTION_FAILED else encrypt_with_room_key(plaintext, room_id, version, key)
+                    for plaintext in chunk]
+
+        size = max(1, len(plaintexts) // self.workers + 1)
+        chunks = [plaintexts[i:i + size] for i in range(0, len(plaintexts), size)]
+        encrypted = [value for chunk in self.pool.map(encrypt_chunk, chunks) for value in chunk]
+
+        result = [None] * len(ciphertexts)
+        for i, value in zip(stale, encrypted):
+            result[i] = value
+        failed = sum(1 for value in encrypted if value is None)
+        rotation.reencrypted += len(encrypted) - failed
+        rotation.failed += failed
+        return result
+
+    def throttle(self):
+        if self.pause:
+            time.sleep(self.pause)
+
+    # -------------------------------------------------------------------
+    # Phase 1: every room, tier by tier, checkpointed per batch
+    # -------------------------------------------------------------------
+    def rotate_rooms(self, rotation):
+        rooms = ChatRoom._get_collection()
+        query = {}
+        if rotation.room:
+            query = {'_id': {'$gt' if rotation.tier == 'done' else '$gte': rotation.room}}
+
+        for room in rooms.find(query, {'_id': 1}).sort('_id', 1):
+            room_id = room['_id']
+            if rotation.room != room_id or rotation.tier == 'done':
+                try:
+                    rewrap_room_keys(room_id)
+                    version = rotate_room_key(room_id)
+                except RoomKeyError as e:
+                    # Deleted meanwhile, or rotated by someone else
+                    self.stderr.write(f'Skipping room {room_id}: {e}')
+                    continue
+                self.checkpoint(rotation, room=room_id, target_version=version, tier=TIERS[0], position=None)
+
+            for tier in TIERS[TIERS.index(rotation.tier):]:
+                if rotation.tier != tier:
+                    self.checkpoint(rotation, tier=tier, position=None)
+                getattr(self, f'rotate_{tier}')(rotation, room_id)
+            self.rotate_preview(rotation, room_id, rotation.target_version)
+
+            self.checkpoint(rotation, tier='done', position=None, rooms_done=rotation.rooms_done + 1)
+            self.stdout.write(f'Room {room_id}: data key v{rotation.target_version}, '
+                              f'{rotation.reencrypted} message(s) re-encrypted so far')
+
+    def rotate_documents(self, rotation, room_id, since=None):
+        messages = Message._get_collection()
+        while True:
+            query = {'room': room_id}
+            if since:
+                query['timestamp'] = {'$gte': since}
+            if rotation.position:
+                timestamp, object_id = decode_cursor(rotation.position)
+                query['$or'] = [{'timestamp': {'$gt': timestamp}}, {'timestamp': timestamp, '_id': {'$gt': object_id}}]
+            batch = list(messages.find(query, {'encrypted_content': 1, 'timestamp': 1})
+                         .sort([('timestamp', 1), ('_id', 1)]).limit(self.batch_size))
+            if not batch:
+                return
+
+            new = self.reencrypt(rotation, room_id, [doc.get('encrypted_content') for doc in batch],
+                                 self.current_version(rotation, room_id))
+            updates = [
+                # Only if unchanged since it was read
+                UpdateOne({'_id': doc['_id'], 'encrypted_content': doc['encrypted_content']},
+                          {'$set': {'encrypted_content': value}})
+                for doc, value in zip(batch, new) if value is not None
+            ]
+            if updates:
+                messages.bulk_write(updates, ordered=False)
+            self.checkpoint(rotation, position=encode_cursor(batch[-1]['timestamp'], batch[-1]['_id']))
+            self.throttle()
+
+    def rotate_buckets(self, rotation, room_id, since=None):
+        buckets = MessageBucket._get_collection()
+        while True:
+            query = {'room': room_id}
+            if since:
+                query['last_timestamp'] = {'$gte': since}
+            if rotation.position:
+                query['_id'] = {'$gt': ObjectId(rotation.position)}
+            bucket = buckets.find_one(query, sort=[('_id', 1)])
+            if not bucket:
+                return
+
+            docs = bucket['messages']
+            new = self.reencrypt(rotation, room_id, [doc.get('encrypted_content') for doc in docs],
+                                 self.current_version(rotation, room_id))
+            if any(value is not None for value in new):
+                for doc, value in zip(docs, new):
+                    if value is not None:
+                        doc['encrypted_content'] = value
+                # Messages appended meanwhile change count; such a bucket is retried
+                result = buckets.update_one({'_id': bucket['_id'], 'count': bucket['count']}, {'$set': {'messages': docs}})
+                if not result.modified_count:
+                    continue
+            self.checkpoint(rotation, position=str(bucket['_id']))
+            self.throttle()
+
+    def rotate_archives(self, rotation, room_id, since=None):
+        archives = MessageArchive._get_collection()
+        while True:
+            query = {'room': room_id}
+            if since:
+                query['_id'] = {'$gte': id_marker(since)}
+            if rotation.position:
+                query['_id'] = {'$gt': ObjectId(rotation.position)}
+            archive = archives.find_one(query, sort=[('_id', 1)])
+            if not archive:
+                return
+
+            docs = MessageArchive.unpack(archive['data'])
+            new = self.reencrypt(rotation, room_id, [doc.get('encrypted_content') for doc in docs],
+                                 self.current_version(rotation, room_id))
+            if any(value is not None for value in new):
+                for doc, value in zip(docs, new):
+                    if value is not None:
+                        doc['encrypted_content'] = value
+                archives.update_one(
+                    {'_id': archive['_id'], 'data': archive['data']},
+                    {'$set': {'data': bson.Binary(MessageArchive.pack(docs)), 'legacy_ciphertexts': 0}}
+                )
+            self.checkpoint(rotation, position=str(archive['_id']))
+            self.throttle()
+
+    def rotate_preview(self, rotation, room_id, version):
+        rooms = ChatRoom._get_collection()
+        room = rooms.find_one({'_id': room_id}, {'last_message_preview': 1})
+        preview = (room or {}).get('last_message_preview')
+        new = self.reencrypt(rotation, room_id, [preview], version)[0]
+        if new is not None:
+            rooms.update_one({'_id': room_id, 'last_message_preview': preview}, {'$set': {'last_message_preview': new}})
+
+    def current_version(self, rotation, room_id):
+        if rotation.phase == 'rooms':
+            return rotation.target_version
+        return get_room_key(room_id)[0]
+
+    # -------------------------------------------------------------------
+    # Phase 2: messages written with a cached old key while rooms rotated
+    # -------------------------------------------------------------------
+    def catch_up(self, rotation):
+        """
+        Processes keep using a room's previous key for up to the key cache
+        TTL after it was rotated, so wait one TTL past the end of the rooms
+        phase, then re-scan everything written since the rotation started
+        (plus one TTL of slack for buffered writes)
+        """
+        ttl = settings.CHAT_ROOM_KEY_CACHE_TTL
+        wait = catch_up_wait(rotation, ttl)
+        if wait > 0:
+            self.stdout.write(f'Waiting {wait:.0f}s for cached room keys to expire')
+            time.sleep(wait)
+        get_key_cache().clear()
+
+        since = rotation.started_at - timedelta(seconds=ttl)
+        recent = set(Message._get_collection().distinct('room', {'timestamp': {'$gte': since}}))
+        recent |= set(MessageBucket._get_collection().distinct('room', {'last_timestamp': {'$gte': since}}))
+        recent |= set(MessageArchive._get_collection().distinct('room', {'_id': {'$gte': id_marker(since)}}))
+
+        for room_id in sorted(recent):
+            if not ChatRoom._get_collection().count_documents({'_id': room_id}, limit=1):
+                continue  # deleted meanwhile
+            for tier in TIERS:
+                rotation.position = None
+                getattr(self, f'rotate_{tier}')(rotation, room_id, since=since)
+            self.rotate_preview(rotation, room_id, get_room_key(room_id)[0])
+        self.checkpoint(rotation, position=None)
+
+    # -------------------------------------------------------------------
+    # Phase 3: retire old data keys
+    # -------------------------------------------------------------------
+    def prune(self, room):
+        return prune_room_keys(room['_id'], room['data_key_version'])
@@ -0,0 +1,131 @@
+"""
+In-process LRU cache of decrypted chat message plaintext, keyed by message id.
+Spares re-decrypting the same messages on every page render, poll and inbox
+preview. Bounded by the total size of the cached strings; disabled with
+CHAT_DECRYPT_CACHE_BYTES=0 for deployments that must not keep plaintext in memory
+"""
+import sys
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from .encryption import decrypt_message, DECRYPTION_FAILED
+
+
+class DecryptedMessageCache:
+    """
+    Thread-safe LRU mapping of key -> plaintext, holding at most max_bytes of
+    strings. Entries can be tagged with a room id so a whole room can be
+    dropped at once when it is deleted
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (plaintext, size, room_id)
+        self.rooms = {}  # room_id -> set of keys
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Cached plaintext for key, or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, plaintext, room_id=None):
+        size = sys.getsizeof(plaintext)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (plaintext, size, room_id)
+            self.size += size
+            if room_id is not None:
+                self.rooms.setdefault(room_id, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        room_keys = self.rooms.get(entry[2])
+        if room_keys is not None:
+            room_keys.discard(key)
+            if not room_keys:
+                del self.rooms[entry[2]]
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self._remove(key)
+
+    def invalidate_room(self, room_id):
+        with self.lock:
+            for key in list(self.rooms.get(room_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.rooms.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Counters for monitoring: entries, bytes, hits, misses, evictions, hit_ratio
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_message_cache = None
+
+
+def get_message_cache():
+    """
+    Get the per-process decrypted message cache, or None when it is disabled
+    """
+    global _message_cache
+    max_bytes = getattr(settings, 'CHAT_DECRYPT_CACHE_BYTES', 0)
+    if max_bytes <= 0:
+        return None
+    if _message_cache is None or _message_cache.max_bytes != max_bytes:
+        _message_cache = DecryptedMessageCache(max_bytes)
+    return _message_cache
+
+
+def decrypt_cached(key, ciphertext, room_id=None):
+    """
+    Decrypt ciphertext through the decrypted message cache (when enabled).
+    key identifies the plaintext, normally the message id
+    """
+    cache = get_message_cache()
+    if cache is None or key is None:
+        return decrypt_message(ciphertext, room_id)
+    plaintext = cache.get(key)
+    if plaintext is None:
+        plaintext = decrypt_message(ciphertext, room_id)
+        if plaintext != DECRYPTION_FAILED:
+            cache.put(key, plaintext, room_id)
+    return plaintext
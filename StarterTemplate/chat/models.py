@@ -1,7 +1,172 @@
-from mongoengine import Document, StringField, DateTimeField, ReferenceField, ListField, BooleanField
+from mongoengine import Document, StringField, DateTimeField, ReferenceField, ListField, BooleanField, DictField, ObjectIdField, IntField, BinaryField
 from datetime import datetime
+import zlib
+import bson
+from django.conf import settings
 from accounts.models import User
-from .encryption import encrypt_message, decrypt_message
+from .encryption import (
+    encrypt_message, decrypt_messages, encryption_format,
+    blind_index_tokens, search_query_tokens, is_legacy_ciphertext, DECRYPTION_FAILED
+)
+from .fields import CiphertextField, EncryptedStringField
+from .message_cache import get_message_cache, decrypt_cached
+from .pagination import InvalidCursor, encode_cursor, decode_cursor, keyset_filter
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+
+PREVIEW_LENGTH = 50
+
+
+def with_message_write_concern(collection):
+    """
+    Apply CHAT_MESSAGE_WRITE_CONCERN to a raw (pymongo or motor) collection
+    """
+    write_concern = getattr(settings, 'CHAT_MESSAGE_WRITE_CONCERN', {})
+    if write_concern:
+        return collection.with_options(write_concern=WriteConcern(**write_concern))
+    return collection
+
+
+def bucket_storage_enabled():
+    """
+    Whether messages are stored in per-room buckets (CHAT_MESSAGE_STORAGE = 'buckets')
+    instead of one document per message
+    """
+    return getattr(settings, 'CHAT_MESSAGE_STORAGE', 'documents') == 'buckets'
+
+
+def _ref_id(value):
+    """
+    Return the ObjectId behind a reference value (Document, DBRef or ObjectId)
+    without dereferencing it
+    """
+    return getattr(value, 'id', value)
+
+
+def make_preview(content):
+    """
+    Truncate message content for the inbox preview
+    """
+    if len(content) > PREVIEW_LENGTH:
+        return content[:PREVIEW_LENGTH] + '...'
+    return content
+
+
+def search_index_enabled():
+    """
+    Whether new messages are added to the blind keyword search index
+    """
+    return getattr(settings, 'CHAT_SEARCH_INDEX', True)
+
+
+def decrypt_all(messages, room_id=None, processes=False, use_cache=True):
+    """
+    Decrypt every message's content up front, for pages that show all of
+    them. Cached plaintext is reused and the rest is decrypted as one batch
+    with decrypt_messages instead of one message at a time on access
+    (use_cache=False for bulk reads that should not evict hot entries)
+    """
+    field = Message.encrypted_content
+    cache = get_message_cache() if use_cache else None
+    pending = []
+    for msg in messages:
+        if field.has_plaintext(msg):
+            continue
+        plaintext = cache.get(msg.id) if cache is not None else None
+        if plaintext is None:
+            pending.append(msg)
+        else:
+            field.remember_plaintext(msg, plaintext)
+    
+    plaintexts = decrypt_messages((msg.encrypted_content for msg in pending), room_id=room_id, processes=processes)
+    for msg, plaintext in zip(pending, plaintexts):
+        field.remember_plaintext(msg, plaintext)
+        if cache is not None and plaintext != DECRYPTION_FAILED:
+            cache.put(msg.id, plaintext, room_id)
+
+
+def cache_plaintexts(messages):
+    """
+    Seed the decrypted message cache with messages that were just written
+    """
+    cache = get_message_cache()
+    if cache is not None:
+        for msg in messages:
+            cache.put(msg.id, msg.decrypted_content, _ref_id(msg._data.get('room')))
+
+
+def message_from_doc(room, doc, tier):
+    """
+    Load a Message from a raw document stored without its room. tier
+    ('buckets' or 'archives') records where it is stored, see message_tier
+    """
+    message = Message._from_son(doc)
+    message._data['room'] = room
+    message._tier = tier
+    return message
+
+
+def message_tier(message):
+    """
+    Storage tier a loaded message came from: 'documents', 'buckets' or 'archives'
+    """
+    return getattr(message, '_tier', 'documents')
+
+
+def chunk_range_query(room_id, bound, direction):
+    """
+    Query and sort for multi-message chunk documents (buckets, archives) with
+    first_timestamp/last_timestamp ranges that can hold messages past a bound
+    """
+    query = {'room': room_id}
+    if direction == 'after':
+        if bound:
+            query['last_timestamp'] = {'$gte': bound[0]}
+        return query, [('first_timestamp', 1)]
+    if bound:
+        query['first_timestamp'] = {'$lte': bound[0]}
+    return query, [('last_timestamp', -1)]
+
+
+def collect_from_chunks(chunks, bound, direction, count, messages_of=lambda chunk: chunk['messages']):
+    """
+    Collect up to count raw message documents past a (timestamp, id) bound
+    from chunk documents ordered as chunk_range_query sorts them. Returns
+    newest first for 'before' and oldest first for 'after'.
+    messages_of extracts the message documents of a chunk, only for chunks
+    that are actually needed. A message found in more than one chunk (an
+    interrupted archive run) is collected once
+    """
+    before = direction != 'after'
+    
+    def key(doc):
+        return (doc['timestamp'], doc['_id'])
+    
+    collected = []
+    seen = set()
+    for chunk in chunks:
+        # Stop once no remaining chunk can hold anything closer to the bound
+        if len(collected) >= count:
+            collected.sort(key=key, reverse=before)
+            collected = collected[:count]
+            edge = collected[-1]['timestamp']
+            if before and chunk['last_timestamp'] < edge:
+                break
+            if not before and chunk['first_timestamp'] > edge:
+                break
+        for doc in messages_of(chunk):
+            if doc['_id'] in seen:
+                continue
+            if bound is None or (key(doc) < bound if before else key(doc) > bound):
+                seen.add(doc['_id'])
+                collected.append(doc)
+    
+    collected.sort(key=key, reverse=before)
+    return collected[:count]
 
 
 class ChatRoom(Document):
@@ -10,13 +175,26 @@ class ChatRoom(Document):
     """
     user1 = ReferenceField(User, required=True)
     user2 = ReferenceField(User, required=True)
+    # Raw ids of both users, backs the single multikey room-list query
+    participants = ListField(ObjectIdField())
     created_at = DateTimeField(default=datetime.now)
     last_message_at = DateTimeField(default=datetime.now)
+    last_message_id = ObjectIdField()  # changes with every message, even within one millisecond
+    
+    # Denormalized inbox summary, kept up to date by Message.create_message
+    last_message_preview = CiphertextField(default='')  # AES256 encrypted, truncated
+    last_sender = ReferenceField(User)
+    unread_counts = DictField()  # str(user id) -> number of unread messages
+    read_watermarks = DictField()  # str(user id) -> timestamp the user has read up to
+    archived_until = DateTimeField()  # newest message moved to cold storage (MessageArchive)
+    data_key_version = IntField()  # current data key (see room_keys); created on first use
+    data_keys = DictField()  # str(version) -> data key wrapped under the master key
     
     meta = {
         'collection': 'chat_rooms',
         'indexes': [
             {'fields': ['user1', 'user2'], 'unique': True},
+            {'fields': ['participants', '-last_message_at', '-id']},
             'created_at',
             'last_message_at'
         ],
@@ -39,11 +217,32 @@ class ChatRoom(Document):
         room = cls.objects(user1=user1, user2=user2).first()
         
         if not room:
-            room = cls(user1=user1, user2=user2)
+            room = cls(user1=user1, user2=user2, participants=[user1.id, user2.id])
             room.save()
         
         return room
     
+    @classmethod
+    def get_rooms_for_user(cls, user, limit=20, cursor=None):
+        """
+        Get one page of a user's chat rooms, most recently active first.
+        Returns (rooms, next_cursor); next_cursor is None on the last page
+        """
+        query = cls.objects(participants=user.id)
+        if cursor:
+            query = query.filter(keyset_filter('last_message_at', cursor, 'before'))
+        
+        # Fetch one extra room to know whether another page exists
+        rooms = query.order_by('-last_message_at', '-id').limit(limit + 1).select_related()
+        rooms = list(rooms)
+        
+        next_cursor = None
+        if len(rooms) > limit:
+            rooms = rooms[:limit]
+            next_cursor = encode_cursor(rooms[-1].last_message_at, rooms[-1].id)
+        
+        return rooms, next_cursor
+    
     def get_other_user(self, current_user):
         """
         Get the other user in the chat (not the current user)
@@ -52,15 +251,393 @@ class ChatRoom(Document):
             return self.user2
         return self.user1
     
-    def get_messages(self, limit=50):
+    def has_participant(self, user):
+        """
+        Check whether a user belongs to this room without dereferencing participants
+        """
+        user_id = str(user.id)
+        return (str(_ref_id(self._data.get('user1'))) == user_id or
+                str(_ref_id(self._data.get('user2'))) == user_id)
+    
+    def participant_ids(self):
+        """
+        Ids of both users in this room, without dereferencing either
+        """
+        return [_ref_id(self._data.get('user1')), _ref_id(self._data.get('user2'))]
+    
+    def get_other_user_id(self, current_user):
+        """
+        Get the id of the other user without dereferencing either participant
+        """
+        current_user_id = str(_ref_id(current_user))
+        if self.participants:
+            return next((uid for uid in self.participants if str(uid) != current_user_id), None)
+        
+        user1_id = _ref_id(self._data.get('user1'))
+        if str(user1_id) == current_user_id:
+            return _ref_id(self._data.get('user2'))
+        return user1_id
+    
+    def summary_update(self, messages):
+        """
+        Build the raw MongoDB update that folds newly stored messages into the
+        room's last_message_at/last_message_id, preview and unread counters.
+        Messages must carry their plaintext in decrypted_content
+        """
+        last = max(messages, key=lambda msg: (msg.timestamp, msg.id))
+        unread = {}
+        for msg in messages:
+            key = f'unread_counts.{self.get_other_user_id(msg._data.get("sender"))}'
+            unread[key] = unread.get(key, 0) + 1
+        
+        return {
+            '$set': {
+                'last_message_at': last.timestamp,
+                'last_message_id': last.id,
+                'last_message_preview': encrypt_message(make_preview(last.decrypted_content), self.id),
+                'last_sender': _ref_id(last._data.get('sender')),
+            },
+            '$inc': unread,
+        }
+    
+    def record_messages(self, messages):
+        """
+        Apply summary_update for newly stored messages in a single atomic $set/$inc
+        """
+        ChatRoom._get_collection().update_one({'_id': self.id}, self.summary_update(messages))
+    
+    def resync_summary(self, messages):
+        """
+        Idempotent counterpart of record_messages, for a retried batch whose
+        summary update may already have been applied: last_message_at and
+        the preview only move forward, and unread counters are recounted
+        instead of incremented
+        """
+        update = self.summary_update(messages)
+        rooms = ChatRoom._get_collection()
+        rooms.update_one(
+            {'_id': self.id, 'last_message_at': {'$lte': update['$set']['last_message_at']}},
+            {'$set': update['$set']}
+        )
+        
+        room = ChatRoom.objects.only('read_watermarks').get(id=self.id)
+        unread = {}
+        for key in update['$inc']:
+            recipient = User(id=ObjectId(key.split('.', 1)[1]))
+            unread[key] = room.count_unread(recipient)
+        rooms.update_one({'_id': self.id}, {'$set': unread})
+    
+    def get_last_message_preview(self):
+        """
+        Decrypt and return the stored last-message preview
+        """
+        if not self.last_message_preview:
+            return 'No messages yet'
+        # last_message_id tells apart previews of messages in the same millisecond
+        version = self.last_message_id or self.last_message_at
+        return decrypt_cached(('preview', self.id, version), self.last_message_preview, self.id)
+    
+    def get_unread_count(self, user):
+        """
+        Get the number of unread messages in this room for a user
+        """
+        return (self.unread_counts or {}).get(str(user.id), 0)
+    
+    def get_read_watermark(self, user):
+        """
+        Get the timestamp a user has read this room up to (None if never read)
+        """
+        return (self.read_watermarks or {}).get(str(user.id))
+    
+    def count_unread(self, user):
+        """
+        Count messages from the other user newer than a user's read watermark.
+        Rooms read before watermarks existed fall back to the legacy is_read flags
+        """
+        watermark = self.get_read_watermark(user)
+        if bucket_storage_enabled():
+            return MessageBucket.count_unread(self, user, watermark)
+        
+        query = Message.objects(room=self, sender__ne=user.id)
+        if watermark:
+            return query.filter(timestamp__gt=watermark).count()
+        return query.filter(is_read=False).count()
+    
+    def mark_read(self, user):
+        """
+        Mark everything in this room up to the loaded last_message_at as read
+        for a user. Moves the user's read watermark and resets their unread
+        counter in one atomic update, only if no message arrived since the
+        room was loaded, then flips legacy is_read flags up to the watermark
+        with a single update_many (per collection in bucket mode). Returns
+        whether the summary changed
+        """
+        watermark = self.get_read_watermark(user)
+        if watermark and watermark >= self.last_message_at and not self.get_unread_count(user):
+            return False
+        
+        # Messages that arrived meanwhile have not been seen; the next load marks them
+        loaded = {'last_message_at': self.last_message_at}
+        if self.last_message_id:
+            loaded['last_message_id'] = self.last_message_id  # also catches one in the same millisecond
+        updated = ChatRoom.objects(id=self.id, **loaded).update_one(**{
+            f'set__read_watermarks__{user.id}': self.last_message_at,
+            f'set__unread_counts__{user.id}': 0,
+        })
+        Message.objects(
+            room=self, sender__ne=user.id, is_read=False, timestamp__lte=self.last_message_at
+        ).update(set__is_read=True)
+        if bucket_storage_enabled():
+            MessageBucket.mark_read(self, user, self.last_message_at)
+        if not updated:
+            return False
+        
+        self.read_watermarks[str(user.id)] = self.last_message_at
+        self.unread_counts[str(user.id)] = 0
+        return True
+    
+    def get_messages(self, limit=50, before=None, after=None):
         """
         Get recent messages in this room (decrypted)
         """
-        messages = Message.objects(room=self).order_by('-timestamp')[:limit]
-        # Decrypt messages
+        messages, _, _ = self.get_messages_page(limit=limit, before=before, after=after)
+        return messages
+    
+    def resolve_senders(self, messages):
+        """
+        Attach sender and room documents to messages loaded from this room.
+        Participants already loaded on the room are reused and any others are
+        fetched with one batched $in query, so reading msg.sender never
+        dereferences one user per message
+        """
+        users = {}
+        for value in (self._data.get('user1'), self._data.get('user2')):
+            if isinstance(value, Document):
+                users[value.id] = value
+        
+        missing = {_ref_id(msg._data.get('sender')) for msg in messages} - set(users)
+        if missing:
+            users.update(User.objects.in_bulk(list(missing)))
+        
+        for msg in messages:
+            sender = msg._data.get('sender')
+            msg._data['sender'] = users.get(_ref_id(sender), sender)
+            msg._data['room'] = self
+        return messages
+    
+    def get_message_cursor(self, message_id):
+        """
+        Build a pagination cursor pointing at a message of this room
+        """
+        try:
+            if bucket_storage_enabled():
+                message = MessageBucket.find_message(self, ObjectId(message_id))
+            else:
+                message = Message.objects(room=self, id=ObjectId(message_id)).only('timestamp').first()
+        except (InvalidId, TypeError):
+            message = None
+        if not message:
+            raise InvalidCursor(f'Unknown message: {message_id!r}')
+        return encode_cursor(message.timestamp, message.id)
+    
+    def load_messages(self, direction, cursor, count):
+        """
+        Load up to count raw (still encrypted) messages past a cursor, in
+        whichever storage mode is configured. direction 'before' returns the
+        newest messages older than the cursor (newest first); 'after' returns
+        the oldest messages newer than the cursor (oldest first)
+        """
+        if bucket_storage_enabled():
+            messages = MessageBucket.load_messages(self, direction, cursor, count)
+        else:
+            query = Message.objects(room=self)
+            if cursor:
+                query = query.filter(keyset_filter('timestamp', cursor, direction))
+            if direction == 'after':
+                query = query.order_by('timestamp', 'id')
+            else:
+                query = query.order_by('-timestamp', '-id')
+            messages = list(query.limit(count))
+        
+        # Read through to cold storage only when the page reaches past the hot window
+        if self.archived_until:
+            if direction == 'after':
+                needs_archive = not cursor or decode_cursor(cursor)[0] <= self.archived_until
+            else:
+                needs_archive = len(messages) < count
+            if needs_archive:
+                # Messages archived by a run interrupted before removing them exist in both tiers
+                hot = {msg.id for msg in messages}
+                messages += [msg for msg in MessageArchive.load_messages(self, direction, cursor, count)
+                             if msg.id not in hot]
+                messages.sort(key=lambda msg: (msg.timestamp, msg.id), reverse=direction != 'after')
+                messages = messages[:count]
+        
+        return messages
+    
+    def get_messages_page(self, limit=50, before=None, after=None):
+        """
+        Get one page of messages (decrypted, oldest first) using keyset pagination.
+        before/after are cursors from a previous page; with neither, the newest
+        page is returned. Returns (messages, prev_cursor, next_cursor) where
+        prev_cursor loads older messages and next_cursor loads newer ones
+        (None when there is nothing more in that direction)
+        """
+        # Fetch one extra message to know whether another page exists
+        if after:
+            messages = self.load_messages('after', after, limit + 1)
+            has_newer, has_older = len(messages) > limit, True
+            messages = messages[:limit]
+        else:
+            messages = self.load_messages('before', before, limit + 1)
+            has_older, has_newer = len(messages) > limit, bool(before)
+            messages = list(reversed(messages[:limit]))
+        
+        return self.finish_page(messages, has_older, has_newer)
+    
+    def finish_page(self, messages, has_older, has_newer):
+        """
+        Resolve senders, decrypt and build the (messages, prev_cursor,
+        next_cursor) result for one page of messages, oldest first
+        """
+        self.resolve_senders(messages)
+        
+        # Decrypt messages (cache misses as one batch)
+        decrypt_all(messages, self.id)
+        
+        if getattr(settings, 'CHAT_REENCRYPT_ON_READ', True):
+            self.upgrade_ciphertexts(messages)
+        
+        prev_cursor = next_cursor = None
+        if messages:
+            if has_older:
+                prev_cursor = encode_cursor(messages[0].timestamp, messages[0].id)
+            if has_newer:
+                next_cursor = encode_cursor(messages[-1].timestamp, messages[-1].id)
+        
+        return messages, prev_cursor, next_cursor
+    
+    def export_messages(self, batch_size=1000, processes=False):
+        """
+        Iterate over every message of the room (all storage tiers), oldest
+        first, decrypted in batches with decrypt_messages. processes=True
+        decrypts each batch on a process pool, for very large exports
+        """
+        cursor = None
+        while True:
+            messages = self.load_messages('after', cursor, batch_size)
+            if not messages:
+                return
+            self.resolve_senders(messages)
+            decrypt_all(messages, self.id, processes=processes, use_cache=False)
+            yield from messages
+            if len(messages) < batch_size:
+                return
+            cursor = encode_cursor(messages[-1].timestamp, messages[-1].id)
+    
+    def upgrade_ciphertexts(self, messages):
+        """
+        Lazily rewrite decrypted legacy (CBC/base64) messages of this room in
+        the current envelope format. Each update only applies if the stored
+        ciphertext is unchanged, so it never races a concurrent rewrite.
+        Each rewrite goes to the tier the message was loaded from; archived
+        messages are left to the reencrypt_messages job
+        """
+        if encryption_format() == 'cbc':
+            return
+        
+        field = Message.encrypted_content
+        updates = {'documents': [], 'buckets': []}
         for msg in messages:
-            msg.decrypted_content = decrypt_message(msg.encrypted_content)
-        return list(reversed(messages))
+            old = msg.encrypted_content
+            tier = message_tier(msg)
+            if tier not in updates or not is_legacy_ciphertext(old):
+                continue
+            plaintext = msg.decrypted_content
+            if plaintext == DECRYPTION_FAILED:
+                continue
+            # Same plaintext, so the raw field is set and the cached entry kept
+            msg.encrypted_content = encrypt_message(plaintext, self.id)
+            field.remember_plaintext(msg, plaintext)
+            if tier == 'buckets':
+                updates[tier].append(UpdateOne(
+                    {'room': self.id, 'messages': {'$elemMatch': {'_id': msg.id, 'encrypted_content': old}}},
+                    {'$set': {'messages.$.encrypted_content': msg.encrypted_content}}
+                ))
+            else:
+                updates[tier].append(UpdateOne(
+                    {'_id': msg.id, 'encrypted_content': old},
+                    {'$set': {'encrypted_content': msg.encrypted_content}}
+                ))
+        
+        for model, tier_updates in ((Message, updates['documents']), (MessageBucket, updates['buckets'])):
+            if not tier_updates:
+                continue
+            try:
+                model._get_collection().bulk_write(tier_updates, ordered=False)
+            except Exception as e:
+                # Reads must not fail because a rewrite did; the job will retry
+                print(f"Error re-encrypting {len(tier_updates)} chat message(s): {e}")
+    
+    def search_messages_page(self, query, limit=50, before=None, after=None):
+        """
+        Search this room's messages for every word of query, using the blind
+        keyword index. Only matching messages are loaded and decrypted.
+        Paging and the returned (messages, prev_cursor, next_cursor) work
+        exactly like get_messages_page. Raises InvalidSearchQuery for queries
+        the index cannot answer
+        """
+        tokens = search_query_tokens(query, self.id)
+        
+        if after:
+            entries = MessageSearchIndex.find(self.id, tokens, 'after', after, limit + 1)
+            has_newer, has_older = len(entries) > limit, True
+            entries = entries[:limit]
+        else:
+            entries = MessageSearchIndex.find(self.id, tokens, 'before', before, limit + 1)
+            has_older, has_newer = len(entries) > limit, bool(before)
+            entries = list(reversed(entries[:limit]))
+        
+        return self.finish_page(self.load_messages_by_id(entries), has_older, has_newer)
+    
+    def load_messages_by_id(self, entries):
+        """
+        Load raw messages for search index entries (dicts with _id and
+        timestamp), in the entries' order, from whichever tier holds them
+        """
+        ids = [entry['_id'] for entry in entries]
+        if not ids:
+            return []
+        
+        if bucket_storage_enabled():
+            found = {}
+            wanted = set(ids)
+            for bucket in MessageBucket._get_collection().find({'room': self.id, 'messages._id': {'$in': ids}}):
+                for doc in bucket['messages']:
+                    if doc['_id'] in wanted:
+                        found[doc['_id']] = message_from_doc(self, doc, 'buckets')
+        else:
+            found = {msg.id: msg for msg in Message.objects(room=self, id__in=ids)}
+        
+        # Anything not in the hot tier has been archived
+        missing = [entry for entry in entries if entry['_id'] not in found]
+        if missing and self.archived_until:
+            archives = MessageArchive._get_collection()
+            archived, unpacked = {}, []
+            for entry in missing:
+                if entry['_id'] not in archived:
+                    for archive in archives.find({
+                        'room': self.id,
+                        'first_timestamp': {'$lte': entry['timestamp']},
+                        'last_timestamp': {'$gte': entry['timestamp']},
+                        '_id': {'$nin': unpacked},
+                    }):
+                        unpacked.append(archive['_id'])
+                        archived.update((doc['_id'], doc) for doc in MessageArchive.unpack(archive['data']))
+                if entry['_id'] in archived:
+                    found[entry['_id']] = message_from_doc(self, archived[entry['_id']], 'archives')
+        
+        return [found[message_id] for message_id in ids if message_id in found]
 
 
 class Message(Document):
@@ -69,7 +646,8 @@ class Message(Document):
     """
     room = ReferenceField(ChatRoom, required=True)
     sender = ReferenceField(User, required=True)
-    encrypted_content = StringField(required=True)  # AES256 encrypted message
+    # AES256 encrypted message; decrypted_content is its plaintext, decrypted on first access
+    encrypted_content = EncryptedStringField(plaintext='decrypted_content', scope='room', cache_key='id', required=True)
     timestamp = DateTimeField(default=datetime.now)
     is_read = BooleanField(default=False)
     
@@ -77,43 +655,530 @@ class Message(Document):
         'collection': 'chat_messages',
         'indexes': [
             {'fields': ['-timestamp']},
-            'room',
-            'sender',
-            'is_read'
+            {'fields': ['room', '-timestamp', '-id']},
+            'sender'
         ],
     }
     
     def __str__(self):
         return f"{self.sender.username}: [Encrypted]"
     
+    @classmethod
+    def build_message(cls, room, sender, content):
+        """
+        Build (without saving) a new encrypted message with its id and
+        timestamp already assigned, so it can be broadcast before it is stored
+        """
+        message = cls(id=ObjectId(), room=room, sender=sender, timestamp=datetime.now())
+        message.decrypted_content = content  # encrypts with the room's key
+        return message
+    
     @classmethod
     def create_message(cls, room, sender, content):
         """
-        Create and save a new encrypted message
+        Create and save a new encrypted message.
+        Costs one insert plus one atomic room update; the room is never re-read
         """
-        encrypted = encrypt_message(content)
-        message = cls(
-            room=room,
-            sender=sender,
-            encrypted_content=encrypted
-        )
-        message.save()
+        message = cls.build_message(room, sender, content)
+        if bucket_storage_enabled():
+            MessageBucket.append(room.id, [message])
+        else:
+            message.save(
+                force_insert=True,
+                write_concern=getattr(settings, 'CHAT_MESSAGE_WRITE_CONCERN', {})
+            )
+        
+        # Update the room's last_message_at and inbox summary in a single atomic update
+        room.record_messages([message])
+        cache_plaintexts([message])
         
-        # Update room's last_message_at
-        room.last_message_at = datetime.now()
-        room.save()
+        if search_index_enabled():
+            MessageSearchIndex.index_messages([message])
         
         return message
     
+    @classmethod
+    def bulk_create(cls, messages, retry=False):
+        """
+        Store messages built with build_message using one insert_many, then
+        one summary update per room. Messages that were already stored (e.g. a
+        retried batch) are skipped rather than duplicated; pass retry=True
+        when some of the batch may already have been stored and summarized,
+        so summaries are recomputed rather than incremented again
+        """
+        if not messages:
+            return
+        
+        by_room, rooms = {}, {}
+        for msg in messages:
+            room = msg._data.get('room')
+            by_room.setdefault(_ref_id(room), []).append(msg)
+            if isinstance(room, ChatRoom):
+                rooms[room.id] = room
+        
+        if bucket_storage_enabled():
+            stored = MessageBucket.stored_ids([msg.id for msg in messages]) if retry else set()
+            for room_id, room_messages in by_room.items():
+                unstored = [msg for msg in room_messages if msg.id not in stored]
+                if unstored:
+                    MessageBucket.append(room_id, unstored)
+        else:
+            docs = [msg.to_mongo() for msg in messages]
+            try:
+                with_message_write_concern(cls._get_collection()).insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                    raise
+        
+        # Reuse rooms the messages were built with; only fetch the others
+        missing = [room_id for room_id in by_room if room_id not in rooms]
+        if missing:
+            rooms.update(ChatRoom.objects.only('user1', 'user2', 'participants').in_bulk(missing))
+        for room_id, room_messages in by_room.items():
+            if room_id in rooms:
+                if retry:
+                    rooms[room_id].resync_summary(room_messages)
+                else:
+                    rooms[room_id].record_messages(room_messages)
+        
+        cache_plaintexts(messages)
+        
+        if search_index_enabled():
+            MessageSearchIndex.index_messages(messages)
+    
     def get_decrypted_content(self):
         """
         Decrypt and return the message content
+        (reusing plaintext already decrypted for this message)
         """
-        return decrypt_message(self.encrypted_content)
+        return self.decrypted_content
+    
+    def delete(self, *args, **kwargs):
+        cache = get_message_cache()
+        if cache is not None:
+            cache.invalidate([self.id])
+        return super().delete(*args, **kwargs)
     
     def mark_as_read(self):
         """
         Mark message as read
+        (prefer ChatRoom.mark_read, which marks a whole room in one update)
         """
         self.is_read = True
         self.save()
+
+
+class MessageBucket(Document):
+    """
+    Up to CHAT_BUCKET_SIZE consecutive messages of one room stored in a single
+    document (CHAT_MESSAGE_STORAGE = 'buckets'). History reads fetch a few
+    bucket documents instead of one document per message. Messages are kept
+    in their normal Message document form (minus the room) and are loaded
+    back as Message instances, so callers never see the difference
+    """
+    room = ReferenceField(ChatRoom, required=True)
+    count = IntField(default=0)
+    first_timestamp = DateTimeField()
+    last_timestamp = DateTimeField()
+    messages = ListField(DictField())
+    
+    meta = {
+        'collection': 'chat_message_buckets',
+        'indexes': [
+            {'fields': ['room', '-last_timestamp']},
+            {'fields': ['room', 'first_timestamp']},
+            {'fields': ['room', 'count']},
+            'messages._id'
+        ],
+    }
+    
+    @staticmethod
+    def bucket_size():
+        return getattr(settings, 'CHAT_BUCKET_SIZE', 200)
+    
+    @staticmethod
+    def to_bucket_doc(message):
+        doc = message.to_mongo()
+        doc.pop('room', None)
+        return doc
+    
+    @classmethod
+    def append_operations(cls, room_id, messages):
+        """
+        Yield (filter, update) pairs that append messages of one room with
+        $push-style updates into the room's open bucket, opening a new bucket
+        (upsert) when it cannot hold them. $addToSet keeps a retried batch
+        from being stored twice
+        """
+        size = cls.bucket_size()
+        for start in range(0, len(messages), size):
+            chunk = messages[start:start + size]
+            timestamps = [msg.timestamp for msg in chunk]
+            yield (
+                {'room': room_id, 'count': {'$lte': size - len(chunk)}},
+                {
+                    '$addToSet': {'messages': {'$each': [cls.to_bucket_doc(msg) for msg in chunk]}},
+                    '$inc': {'count': len(chunk)},
+                    '$min': {'first_timestamp': min(timestamps)},
+                    '$max': {'last_timestamp': max(timestamps)},
+                }
+            )
+    
+    @classmethod
+    def append(cls, room_id, messages):
+        """
+        Append messages of one room to its buckets
+        """
+        collection = with_message_write_concern(cls._get_collection())
+        for query, update in cls.append_operations(room_id, messages):
+            collection.update_one(query, update, upsert=True)
+    
+    @classmethod
+    def stored_ids(cls, message_ids):
+        """
+        The ids among message_ids that are already stored in some bucket
+        """
+        wanted = set(message_ids)
+        return wanted & set(cls._get_collection().distinct('messages._id', {'messages._id': {'$in': message_ids}}))
+    
+    @classmethod
+    def load_messages(cls, room, direction, cursor, count):
+        """
+        Bucket-mode counterpart of ChatRoom.load_messages
+        """
+        bound = decode_cursor(cursor) if cursor else None
+        query, sort = chunk_range_query(room.id, bound, direction)
+        docs = collect_from_chunks(cls._get_collection().find(query).sort(sort), bound, direction, count)
+        return [message_from_doc(room, doc, 'buckets') for doc in docs]
+    
+    @classmethod
+    def find_message(cls, room, message_id):
+        """
+        Find one message of a room by id, or None
+        """
+        bucket = cls._get_collection().find_one(
+            {'room': room.id, 'messages._id': message_id},
+            {'messages': {'$elemMatch': {'_id': message_id}}}
+        )
+        if not bucket:
+            return None
+        return message_from_doc(room, bucket['messages'][0], 'buckets')
+    
+    @classmethod
+    def mark_read(cls, room, user, until):
+        """
+        Bucket-mode counterpart of the is_read update in ChatRoom.mark_read:
+        flips the flags of the other user's messages up to until in place
+        """
+        cls._get_collection().update_many(
+            {'room': room.id, 'first_timestamp': {'$lte': until}, 'messages.is_read': False},
+            {'$set': {'messages.$[m].is_read': True}},
+            array_filters=[{'m.sender': {'$ne': user.id}, 'm.is_read': False, 'm.timestamp': {'$lte': until}}],
+        )
+    
+    @classmethod
+    def count_unread(cls, room, user, watermark):
+        """
+        Bucket-mode counterpart of ChatRoom.count_unread
+        """
+        match = {'messages.sender': {'$ne': user.id}}
+        if watermark:
+            match['messages.timestamp'] = {'$gt': watermark}
+        else:
+            match['messages.is_read'] = False
+        
+        result = list(cls._get_collection().aggregate([
+            {'$match': {'room': room.id}},
+            {'$unwind': '$messages'},
+            {'$match': match},
+            {'$count': 'unread'},
+        ]))
+        return result[0]['unread'] if result else 0
+
+
+class MessageArchive(Document):
+    """
+    Cold storage for old messages of one room: a zlib-compressed BSON array
+    of Message documents (still encrypted), moved out of the hot collections
+    by the archive_messages command. ChatRoom.load_messages reads through to
+    it when a page reaches past the room's archived_until horizon
+    """
+    room = ReferenceField(ChatRoom, required=True)
+    count = IntField(default=0)
+    first_timestamp = DateTimeField()
+    last_timestamp = DateTimeField()
+    data = BinaryField()
+    legacy_ciphertexts = IntField()  # legacy CBC messages inside; unset on archives from before it existed
+    first_id = ObjectIdField()  # first and last message inside, identify the chunk
+    last_id = ObjectIdField()
+    
+    meta = {
+        'collection': 'chat_message_archives',
+        'indexes': [
+            {'fields': ['room', '-last_timestamp']},
+            {'fields': ['room', 'first_timestamp']},
+            {'fields': ['room', 'first_id', 'last_id']},
+        ],
+    }
+    
+    @staticmethod
+    def pack(docs):
+        return zlib.compress(bson.encode({'messages': docs}), 6)
+    
+    @staticmethod
+    def unpack(data):
+        return bson.decode(zlib.decompress(data))['messages']
+    
+    @staticmethod
+    def chunk_key(room_id, docs):
+        # Archiving the same messages again (after a crash before they were
+        # removed from the hot tier) finds the archive written the first time
+        return {'room': room_id, 'first_id': docs[0]['_id'], 'last_id': docs[-1]['_id']}
+    
+    @classmethod
+    def archive(cls, room_id, docs):
+        """
+        Store raw message documents (oldest first, room field removed) as one
+        archive, unless an archive of exactly these messages already exists
+        """
+        cls._get_collection().update_one(cls.chunk_key(room_id, docs), {'$setOnInsert': {
+            'count': len(docs),
+            'first_timestamp': docs[0]['timestamp'],
+            'last_timestamp': docs[-1]['timestamp'],
+            'data': bson.Binary(cls.pack(docs)),
+            'legacy_ciphertexts': sum(1 for doc in docs if is_legacy_ciphertext(doc.get('encrypted_content'))),
+        }}, upsert=True)
+        ChatRoom._get_collection().update_one(
+            {'_id': room_id},
+            {'$max': {'archived_until': docs[-1]['timestamp']}}
+        )
+    
+    @classmethod
+    def discard(cls, room_id, docs):
+        """
+        Remove the archive of docs written by archive(), when their hot copy
+        changed before it could be removed
+        """
+        cls._get_collection().delete_one(cls.chunk_key(room_id, docs))
+    
+    @classmethod
+    def load_messages(cls, room, direction, cursor, count):
+        """
+        Archive counterpart of ChatRoom.load_messages
+        """
+        bound = decode_cursor(cursor) if cursor else None
+        query, sort = chunk_range_query(room.id, bound, direction)
+        docs = collect_from_chunks(
+            cls._get_collection().find(query).sort(sort), bound, direction, count,
+            messages_of=lambda archive: cls.unpack(archive['data'])
+        )
+        return [message_from_doc(room, doc, 'archives') for doc in docs]
+
+
+class ChatRoomDeletion(Document):
+    """
+    Pending purge of a deleted chat room. Deleting a room only removes the
+    ChatRoom document and records one of these; the purge_deleted_chats
+    worker then removes the room's messages, buckets and archives in
+    bounded batches and records its progress here
+    """
+    room = ObjectIdField(required=True, unique=True)
+    created_at = DateTimeField(default=datetime.now)
+    deleted_messages = IntField(default=0)
+    finished_at = DateTimeField()
+    
+    meta = {
+        'collection': 'chat_room_deletions',
+        'indexes': [
+            {'fields': ['finished_at', 'created_at']},
+        ],
+    }
+    
+    def __str__(self):
+        return f"Deletion of room {self.room}"
+    
+    @classmethod
+    def schedule(cls, room_ids):
+        """
+        Mark rooms as deleted right away: record a pending purge for each,
+        then remove the ChatRoom documents so the rooms disappear from
+        inboxes and access checks. Messages are left for the worker
+        """
+        room_ids = [ObjectId(str(room_id)) for room_id in room_ids]
+        if not room_ids:
+            return
+        deletions = cls._get_collection()
+        for room_id in room_ids:
+            deletions.update_one(
+                {'room': room_id},
+                {'$setOnInsert': {'room': room_id, 'created_at': datetime.now(), 'deleted_messages': 0}},
+                upsert=True
+            )
+        ChatRoom._get_collection().delete_many({'_id': {'$in': room_ids}})
+        
+        cache = get_message_cache()
+        if cache is not None:
+            for room_id in room_ids:
+                cache.invalidate_room(room_id)
+    
+    @classmethod
+    def schedule_for_user(cls, user):
+        """
+        Mark every room the user takes part in as deleted; returns
+        {room id: participant ids} for the deleted rooms
+        """
+        user_id = _ref_id(user)
+        rooms = {
+            doc['_id']: [doc.get('user1'), doc.get('user2')]
+            for doc in ChatRoom._get_collection().find(
+                {'$or': [{'participants': user_id}, {'user1': user_id}, {'user2': user_id}]},
+                {'user1': 1, 'user2': 1}
+            )
+        }
+        cls.schedule(list(rooms))
+        return rooms
+    
+    @classmethod
+    def pending(cls):
+        return cls.objects(finished_at=None).order_by('created_at')
+    
+    def purge_batch(self, batch_size):
+        """
+        Delete roughly batch_size of the room's messages and return how many
+        were removed, or None once the room is fully purged (the deletion is
+        then marked finished)
+        """
+        deleted, found = 0, False
+        # Per-message documents: one indexed read of ids, one delete
+        messages = Message._get_collection()
+        ids = [doc['_id'] for doc in messages.find({'room': self.room}, {'_id': 1}).limit(batch_size)]
+        if ids:
+            messages.delete_many({'_id': {'$in': ids}})
+            deleted += len(ids)
+            found = True
+        
+        # Search index entries go along with their messages
+        search = MessageSearchIndex._get_collection()
+        ids = [doc['_id'] for doc in search.find({'room': self.room}, {'_id': 1}).limit(batch_size)]
+        if ids:
+            search.delete_many({'_id': {'$in': ids}})
+            found = True
+        
+        # Buckets and archives hold many messages each, so remove them a few at a time
+        for model in (MessageBucket, MessageArchive):
+            if deleted >= batch_size:
+                break
+            collection = model._get_collection()
+            for chunk in collection.find({'room': self.room}, {'count': 1}).limit(max(1, batch_size // 100)):
+                collection.delete_one({'_id': chunk['_id']})
+                deleted += chunk.get('count', 0)
+                found = True
+                if deleted >= batch_size:
+                    break
+        
+        cache = get_message_cache()
+        if cache is not None:
+            cache.invalidate_room(self.room)
+        
+        if not found:
+            self.finished_at = datetime.now()
+            self.__class__.objects(id=self.id).update_one(set__finished_at=self.finished_at)
+            return None
+        self.__class__.objects(id=self.id).update_one(inc__deleted_messages=deleted)
+        self.deleted_messages += deleted
+        return deleted
+
+
+class MessageSearchIndex(Document):
+    """
+    Blind keyword index for message search: one entry per message holding
+    keyed HMAC tokens of its words (see encryption.blind_index_tokens), so
+    searches are index lookups and never decrypt non-matching messages.
+    Entries share the message id and are kept when messages are archived
+    """
+    room = ObjectIdField(required=True)
+    timestamp = DateTimeField(required=True)
+    tokens = ListField(StringField())
+    
+    meta = {
+        'collection': 'chat_message_search',
+        'indexes': [
+            {'fields': ['room', 'tokens', '-timestamp', '-id']},
+        ],
+    }
+    
+    @staticmethod
+    def entry(room_id, message_id, timestamp, content):
+        tokens = blind_index_tokens(content, room_id)
+        if tokens:
+            return {'_id': message_id, 'room': room_id, 'timestamp': timestamp, 'tokens': tokens}
+        return None
+    
+    @classmethod
+    def entries_for(cls, messages):
+        """
+        Index entries for messages built with Message.build_message
+        """
+        entries = (
+            cls.entry(_ref_id(msg._data.get('room')), msg.id, msg.timestamp, msg.decrypted_content)
+            for msg in messages
+        )
+        return [entry for entry in entries if entry]
+    
+    @classmethod
+    def insert_entries(cls, entries):
+        """
+        Insert index entries, skipping messages that are already indexed
+        """
+        if not entries:
+            return
+        try:
+            cls._get_collection().insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+    
+    @classmethod
+    def index_messages(cls, messages):
+        cls.insert_entries(cls.entries_for(messages))
+    
+    @classmethod
+    def find(cls, room_id, tokens, direction, cursor, count):
+        """
+        Entries of messages containing every token, keyset-paged on
+        (timestamp, _id) with the same cursors as ChatRoom.load_messages
+        """
+        query = cls.objects(room=room_id, tokens__all=tokens)
+        if cursor:
+            query = query.filter(keyset_filter('timestamp', cursor, direction))
+        if direction == 'after':
+            query = query.order_by('timestamp', 'id')
+        else:
+            query = query.order_by('-timestamp', '-id')
+        return list(query.only('timestamp').limit(count).as_pymongo())
+
+
+class ChatKeyRotation(Document):
+    """
+    Checkpoint of a rotate_chat_keys run, so an interrupted rotation resumes
+    where it stopped. Rooms are rotated in _id order; within the current room
+    tier/position record how far its messages have been re-encrypted
+    """
+    started_at = DateTimeField(default=datetime.now)
+    rooms_finished_at = DateTimeField()  # when the last room got its new key
+    finished_at = DateTimeField()
+    phase = StringField(default='rooms')  # rooms, catchup, prune
+    room = ObjectIdField()  # room being (or last) rotated
+    target_version = IntField()  # new data key version of that room
+    tier = StringField()  # documents, buckets, archives, done
+    position = StringField()  # cursor / last _id within the tier
+    rooms_done = IntField(default=0)
+    reencrypted = IntField(default=0)
+    failed = IntField(default=0)
+    
+    meta = {
+        'collection': 'chat_key_rotations',
+    }
+    
+    def __str__(self):
+        return f"Key rotation started {self.started_at:%Y-%m-%d %H:%M}"
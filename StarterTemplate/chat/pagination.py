@@ -0,0 +1,48 @@
+"""
+Keyset (cursor) pagination helpers for chat queries
+"""
+import base64
+from datetime import datetime
+from bson import ObjectId
+from bson.errors import InvalidId
+from mongoengine.queryset.visitor import Q
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a pagination cursor cannot be decoded
+    """
+    pass
+
+
+def encode_cursor(value, object_id):
+    """
+    Encode a (datetime, ObjectId) sort key as an opaque cursor string
+    """
+    raw = f'{value.isoformat()}|{object_id}'
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode an opaque cursor string back into a (datetime, ObjectId) sort key
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        value, object_id = raw.split('|', 1)
+        return datetime.fromisoformat(value), ObjectId(object_id)
+    except (ValueError, TypeError, InvalidId, UnicodeError) as e:
+        raise InvalidCursor(f'Invalid cursor: {cursor!r}') from e
+
+
+def keyset_filter(field, cursor, direction):
+    """
+    Build a query that continues a (field, id) ordering past a cursor.
+    direction is 'before' (older / smaller keys) or 'after' (newer / larger keys)
+    """
+    value, object_id = decode_cursor(cursor)
+    op = 'lt' if direction == 'before' else 'gt'
+    return (
+        Q(**{f'{field}__{op}': value}) |
+        Q(**{field: value, f'id__{op}': object_id})
+    )
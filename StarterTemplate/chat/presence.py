@@ -0,0 +1,309 @@
+"""
+Presence tracking for chat users.
+WebSocket consumers report connect, disconnect and heartbeats (any frame a
+client sends). A user is online while at least one of their connections has
+been heard from within CHAT_PRESENCE_TTL seconds. Idle connections expire
+through one timer wheel per process instead of a timer per connection.
+
+CHAT_PRESENCE_BACKEND picks where per-user connection counts are published:
+'memory' (this process only) or 'redis' (shared by every ASGI process,
+needed whenever the Redis channel layer is used). Presence queries take a
+list of users and cost one lookup per user, so checking a page of rooms is
+O(rooms) however many connections are open
+"""
+import asyncio
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel of slots tick seconds apart.
+    schedule() drops a key into the slot its deadline falls in (rescheduling
+    moves it), and advance() empties the slots that have come due. Both are
+    O(1) per key, and one periodic advance() replaces a timer per key.
+    Deadlines are accurate to one tick and at most slots - 1 ticks away
+    """
+
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.position = {}  # key -> slot index
+        self.current = 0
+        self.last_tick = time.monotonic()
+
+    def __len__(self):
+        return len(self.position)
+
+    def schedule(self, key, delay):
+        self.cancel(key)
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        index = (self.current + ticks) % len(self.slots)
+        self.slots[index].add(key)
+        self.position[key] = index
+
+    def cancel(self, key):
+        index = self.position.pop(key, None)
+        if index is not None:
+            self.slots[index].discard(key)
+
+    def advance(self, now=None):
+        """
+        Move the wheel up to now and return the keys whose deadline passed
+        """
+        now = time.monotonic() if now is None else now
+        steps = int((now - self.last_tick) / self.tick)
+        self.last_tick += steps * self.tick
+        expired = []
+        for _ in range(min(steps, len(self.slots))):
+            self.current = (self.current + 1) % len(self.slots)
+            due, self.slots[self.current] = self.slots[self.current], set()
+            for key in due:
+                del self.position[key]
+            expired.extend(due)
+        return expired
+
+
+class MemoryPresenceBackend:
+    """
+    Presence of this process's connections only (single-process setups)
+    """
+    blocking = False
+
+    def __init__(self):
+        self.counts = {}
+
+    def publish(self, counts):
+        for user_id, count in counts.items():
+            if count:
+                self.counts[user_id] = count
+            else:
+                self.counts.pop(user_id, None)
+
+    def online(self, user_ids):
+        return {user_id for user_id in user_ids if user_id in self.counts}
+
+
+class RedisPresenceBackend:
+    """
+    Presence shared through Redis: one hash per user mapping each ASGI
+    process to its connection count for that user. The hash expires ttl
+    seconds after its last refresh, so counts left by a crashed process
+    disappear on their own
+    """
+    blocking = True
+
+    def __init__(self, url, ttl, prefix='chat:presence:'):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImproperlyConfigured("CHAT_PRESENCE_BACKEND='redis' requires the redis package") from e
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.process_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    def publish(self, counts):
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, count in counts.items():
+            key = self.prefix + user_id
+            if count:
+                pipe.hset(key, self.process_id, count)
+                pipe.expire(key, self.ttl)
+            else:
+                pipe.hdel(key, self.process_id)
+        pipe.execute()
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(self.prefix + user_id)
+        return {user_id for user_id, exists in zip(user_ids, pipe.execute()) if exists}
+
+
+class PresenceService:
+    """
+    Per-process registry of WebSocket connections (by channel name) and
+    their users. Changes in a user's connection count are published to the
+    backend: straight away for the in-memory backend, and for blocking
+    backends once per tick from a background task on the event loop, except
+    that a user coming online is published before connect() returns. Every
+    user with local connections is re-published each ttl / 3 seconds
+    """
+
+    def __init__(self, backend, ttl=60, tick=1.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.tick = tick
+        self.wheel = TimerWheel(tick, slots=math.ceil(ttl / tick) + 1)
+        self.connections = {}  # channel name -> user id
+        self.counts = {}  # user id -> connections in this process
+        self.dirty = set()  # users whose count has not been published yet
+        self.lock = threading.Lock()
+        self.last_refresh = time.monotonic()
+        self._task = None
+        self._loop = None
+
+    def _ensure_started(self):
+        """
+        Start the expiry ticker on the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.expire()
+            if time.monotonic() - self.last_refresh >= self.ttl / 3:
+                self.last_refresh = time.monotonic()
+                with self.lock:
+                    self.dirty.update(self.counts)
+            await self.flush()
+
+    def _add(self, connection, user_id):
+        # Caller holds the lock; returns whether the user just came online
+        self.connections[connection] = user_id
+        self.counts[user_id] = self.counts.get(user_id, 0) + 1
+        self.dirty.add(user_id)
+        return self.counts[user_id] == 1
+
+    def _remove(self, connection):
+        # Caller holds the lock
+        user_id = self.connections.pop(connection, None)
+        if user_id is None:
+            return
+        self.wheel.cancel(connection)
+        self.counts[user_id] -= 1
+        if not self.counts[user_id]:
+            del self.counts[user_id]
+        self.dirty.add(user_id)
+
+    async def connect(self, connection, user_id):
+        """
+        Register a new connection of a user
+        """
+        self._ensure_started()
+        with self.lock:
+            self._remove(connection)
+            came_online = self._add(connection, str(user_id))
+            self.wheel.schedule(connection, self.ttl)
+        if came_online or not self.backend.blocking:
+            await self.flush()
+
+    def heartbeat(self, connection, user_id):
+        """
+        Keep a connection alive for another ttl seconds (re-registering it
+        if it had already expired)
+        """
+        with self.lock:
+            if connection not in self.connections:
+                self._add(connection, str(user_id))
+            self.wheel.schedule(connection, self.ttl)
+        if not self.backend.blocking:
+            self.publish_changes()
+
+    def disconnect(self, connection):
+        """
+        Forget a closed connection
+        """
+        with self.lock:
+            self._remove(connection)
+        if not self.backend.blocking:
+            self.publish_changes()
+
+    def expire(self, now=None):
+        """
+        Drop connections not heard from for ttl seconds; returns how many
+        """
+        with self.lock:
+            expired = self.wheel.advance(now)
+            for connection in expired:
+                self._remove(connection)
+        if expired and not self.backend.blocking:
+            self.publish_changes()
+        return len(expired)
+
+    def publish_changes(self):
+        """
+        Publish the connection counts of users that changed since the last call
+        """
+        with self.lock:
+            changes = {user_id: self.counts.get(user_id, 0) for user_id in self.dirty}
+            self.dirty.clear()
+        if not changes:
+            return
+        try:
+            self.backend.publish(changes)
+        except Exception as e:
+            # Keep them dirty so they are retried on the next tick
+            print(f"Error publishing presence of {len(changes)} user(s): {e}")
+            with self.lock:
+                self.dirty.update(changes)
+
+    async def flush(self):
+        if self.backend.blocking:
+            await sync_to_async(self.publish_changes, thread_sensitive=False)()
+        else:
+            self.publish_changes()
+
+    def online(self, user_ids):
+        """
+        The subset of user_ids (as strings) that are online.
+        If the backend is unreachable everyone counts as online, so callers
+        skipping offline users never skip someone who is connected
+        """
+        user_ids = {str(user_id) for user_id in user_ids}
+        if not user_ids:
+            return set()
+        try:
+            return self.backend.online(user_ids)
+        except Exception as e:
+            print(f"Error reading presence: {e}")
+            return user_ids
+
+    def stats(self):
+        """
+        Counters for monitoring: connections and users in this process
+        """
+        with self.lock:
+            return {'connections': len(self.connections), 'users': len(self.counts)}
+
+
+def room_presence(rooms, user):
+    """
+    {room id: whether the other participant is online} for a page of rooms,
+    from one presence lookup
+    """
+    other_ids = {room.id: room.get_other_user_id(user) for room in rooms}
+    online = get_presence().online(other_ids.values())
+    return {room_id: str(other_id) in online for room_id, other_id in other_ids.items()}
+
+
+_presence = None
+
+
+def get_presence():
+    """
+    Get the per-process presence service configured from settings
+    """
+    global _presence
+    if _presence is None:
+        ttl = getattr(settings, 'CHAT_PRESENCE_TTL', 60)
+        if getattr(settings, 'CHAT_PRESENCE_BACKEND', 'memory') == 'redis':
+            backend = RedisPresenceBackend(settings.REDIS_URL, ttl)
+        else:
+            backend = MemoryPresenceBackend()
+        _presence = PresenceService(backend, ttl=ttl, tick=getattr(settings, 'CHAT_PRESENCE_TICK', 1.0))
+    return _presence
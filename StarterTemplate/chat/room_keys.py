@@ -0,0 +1,251 @@
+"""
+Per-room data keys for envelope encryption.
+Every ChatRoom holds its own random AES256 data keys, stored wrapped
+(AES-GCM) under the master key derived from ENCRYPTION_KEY. Messages name
+the data key version they were encrypted with, so a room's key can be
+rotated (rotate_chat_keys) while older messages stay readable, and the
+master key can be changed by re-wrapping the small data keys instead of
+re-encrypting every message. Unwrapped keys live in a bounded TTL cache
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from bson import Binary, ObjectId
+from django.conf import settings
+
+DATA_KEY_SIZE = 32
+WRAP_NONCE_SIZE = 12
+WRAP_TAG_SIZE = 16
+
+
+class RoomKeyError(Exception):
+    """
+    Raised when a room's data key is missing or cannot be unwrapped
+    """
+    pass
+
+
+def master_keys():
+    """
+    Master keys, current first: ENCRYPTION_KEY, then ENCRYPTION_KEY_PREVIOUS
+    (comma separated) so data keys wrapped before a master key change can
+    still be unwrapped until they are re-wrapped
+    """
+    secrets = [getattr(settings, 'ENCRYPTION_KEY', 'your_encryption_key')]
+    secrets += [key for key in getattr(settings, 'ENCRYPTION_KEY_PREVIOUS', []) if key]
+    return [hashlib.sha256(secret.encode()).digest() for secret in secrets]
+
+
+def _wrap_aad(room_id, version):
+    # Binds a wrapped key to its room and version
+    return b'chat-room-key' + ObjectId(str(room_id)).binary + version.to_bytes(4, 'big')
+
+
+def wrap_key(data_key, room_id, version):
+    """
+    Wrap a data key under the current master key: nonce | tag | ciphertext
+    """
+    nonce = get_random_bytes(WRAP_NONCE_SIZE)
+    wrapper = AES.new(master_keys()[0], AES.MODE_GCM, nonce=nonce)
+    wrapper.update(_wrap_aad(room_id, version))
+    encrypted, tag = wrapper.encrypt_and_digest(data_key)
+    return nonce + tag + encrypted
+
+
+def unwrap_key(wrapped, room_id, version):
+    """
+    Unwrap a data key with whichever master key wrapped it
+    """
+    wrapped = bytes(wrapped)
+    nonce = wrapped[:WRAP_NONCE_SIZE]
+    tag = wrapped[WRAP_NONCE_SIZE:WRAP_NONCE_SIZE + WRAP_TAG_SIZE]
+    for master_key in master_keys():
+        wrapper = AES.new(master_key, AES.MODE_GCM, nonce=nonce)
+        wrapper.update(_wrap_aad(room_id, version))
+        try:
+            return wrapper.decrypt_and_verify(wrapped[WRAP_NONCE_SIZE + WRAP_TAG_SIZE:], tag)
+        except ValueError:
+            continue
+    raise RoomKeyError(f'Cannot unwrap data key {version} of room {room_id} with any master key')
+
+
+class RoomKeyCache:
+    """
+    Thread-safe LRU of unwrapped data keys (and each room's current key
+    version), holding at most max_entries for at most ttl seconds each
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, expires_at)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_room(self, room_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == room_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_key_cache = None
+
+
+def get_key_cache():
+    """
+    Get the per-process cache of unwrapped room keys
+    """
+    global _key_cache
+    if _key_cache is None:
+        _key_cache = RoomKeyCache(
+            max_entries=getattr(settings, 'CHAT_ROOM_KEY_CACHE_SIZE', 10000),
+            ttl=getattr(settings, 'CHAT_ROOM_KEY_CACHE_TTL', 300)
+        )
+    return _key_cache
+
+
+def _rooms():
+    from .models import ChatRoom
+    return ChatRoom._get_collection()
+
+
+def _load_room_keys(room_id):
+    """
+    Read a room's wrapped keys (creating its first key if it has none) and
+    unwrap them into the cache. Returns (current version, {version: key})
+    """
+    rooms = _rooms()
+    doc = rooms.find_one({'_id': room_id}, {'data_key_version': 1, 'data_keys': 1})
+    if doc is None:
+        raise RoomKeyError(f'Unknown chat room {room_id}')
+
+    if not doc.get('data_key_version'):
+        # First key for this room; if another process wins the race, use its key
+        rooms.update_one(
+            {'_id': room_id, 'data_key_version': None},
+            {'$set': {'data_key_version': 1, 'data_keys.1': Binary(wrap_key(get_random_bytes(DATA_KEY_SIZE), room_id, 1))}}
+        )
+        doc = rooms.find_one({'_id': room_id}, {'data_key_version': 1, 'data_keys': 1})
+
+    keys = {
+        int(version): unwrap_key(wrapped, room_id, int(version))
+        for version, wrapped in (doc.get('data_keys') or {}).items()
+    }
+    cache = get_key_cache()
+    for version, key in keys.items():
+        cache.put((room_id, version), key)
+    cache.put((room_id, None), doc['data_key_version'])
+    return doc['data_key_version'], keys
+
+
+def get_room_key(room_id, version=None):
+    """
+    Get (version, data key) for a room: the given version, or the room's
+    current key. Costs one room read per room per cache TTL
+    """
+    if room_id is None:
+        raise RoomKeyError('A room id is required for room-key encryption')
+    room_id = ObjectId(str(room_id))
+    cache = get_key_cache()
+
+    wanted = version if version is not None else cache.get((room_id, None))
+    if wanted is not None:
+        key = cache.get((room_id, wanted))
+        if key is not None:
+            return wanted, key
+
+    current, keys = _load_room_keys(room_id)
+    wanted = version if version is not None else current
+    key = keys.get(wanted)
+    if key is None:
+        raise RoomKeyError(f'Room {room_id} has no data key version {wanted}')
+    return wanted, key
+
+
+def room_key_cached(room_id):
+    """
+    Whether the room's current key can be served without a database read
+    """
+    cache = get_key_cache()
+    room_id = ObjectId(str(room_id))
+    version = cache.get((room_id, None))
+    return version is not None and cache.get((room_id, version)) is not None
+
+
+def rotate_room_key(room_id):
+    """
+    Give a room a new current data key and return its version.
+    Older versions are kept so existing messages stay readable
+    """
+    room_id = ObjectId(str(room_id))
+    get_room_key(room_id)  # make sure the room has a first key
+    rooms = _rooms()
+    current = rooms.find_one({'_id': room_id}, {'data_key_version': 1})['data_key_version']
+    new = current + 1
+    result = rooms.update_one(
+        {'_id': room_id, 'data_key_version': current},
+        {'$set': {
+            'data_key_version': new,
+            f'data_keys.{new}': Binary(wrap_key(get_random_bytes(DATA_KEY_SIZE), room_id, new)),
+        }}
+    )
+    if not result.modified_count:
+        raise RoomKeyError(f'Data key of room {room_id} was rotated concurrently')
+    get_key_cache().invalidate_room(room_id)
+    return new
+
+
+def rewrap_room_keys(room_id):
+    """
+    Re-wrap all of a room's data keys under the current master key
+    """
+    room_id = ObjectId(str(room_id))
+    rooms = _rooms()
+    doc = rooms.find_one({'_id': room_id}, {'data_keys': 1})
+    if not doc or not doc.get('data_keys'):
+        return 0
+    rewrapped = {
+        version: Binary(wrap_key(unwrap_key(wrapped, room_id, int(version)), room_id, int(version)))
+        for version, wrapped in doc['data_keys'].items()
+    }
+    rooms.update_one({'_id': room_id, 'data_keys': doc['data_keys']}, {'$set': {'data_keys': rewrapped}})
+    return len(rewrapped)
+
+
+def prune_room_keys(room_id, keep_version):
+    """
+    Drop every data key of a room except keep_version
+    (only once no stored message uses them any more)
+    """
+    room_id = ObjectId(str(room_id))
+    rooms = _rooms()
+    doc = rooms.find_one({'_id': room_id}, {'data_keys': 1})
+    stale = [version for version in (doc or {}).get('data_keys') or {} if int(version) != keep_version]
+    if stale:
+        rooms.update_one({'_id': room_id}, {'$unset': {f'data_keys.{version}': '' for version in stale}})
+    get_key_cache().invalidate_room(room_id)
+    return len(stale)
@@ -8,4 +8,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_id>[^/]+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/user/$', consumers.UserConsumer.as_asgi()),
 ]
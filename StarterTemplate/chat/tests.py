@@ -1,3 +1,1309 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+from bson import ObjectId
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from mongoengine import connect, disconnect
+from mongoengine.connection import get_connection
+from mongoengine.context_managers import query_counter
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from accounts.models import User
+from . import codec, consumers, encryption, message_cache, room_keys, views
+from .async_store import AsyncChatStore
+from .coalescing import FrameCoalescer, get_coalescing_stats
+from .codec import FIELD_NAMES, InvalidFrame, JsonWire, MsgpackWire, negotiate_wire, wire_formats
+from .encryption import (
+    DECRYPT_CHUNK_SIZE, InvalidSearchQuery, blind_index_tokens, decrypt_messages, encrypt_message,
+    search_query_tokens
+)
+from .management.commands import archive_messages, migrate_message_storage, rotate_chat_keys
+from .message_cache import DecryptedMessageCache, decrypt_cached, get_message_cache
+from .models import (
+    ChatRoom, ChatRoomDeletion, ChatKeyRotation, Message, MessageArchive, MessageBucket, MessageSearchIndex,
+    collect_from_chunks, make_preview
+)
+from .pagination import InvalidCursor, decode_cursor, encode_cursor
+from .presence import TimerWheel
+from .routing import websocket_urlpatterns
+from .write_behind import MessageWriteBehind
 
-# Create your tests here.
+try:
+    from motor import motor_asyncio
+except ImportError:
+    motor_asyncio = None
+
+MONGO_TEST_URI = os.getenv('MONGO_TEST_URI', 'mongodb://localhost:27017/chat_tests')
+
+
+class MongoTestCase(SimpleTestCase):
+    """
+    Runs against a throwaway MongoDB database (skipped if MongoDB is unreachable)
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        disconnect()
+        connect(host=MONGO_TEST_URI, serverSelectionTimeoutMS=1000)
+        try:
+            get_connection().admin.command('ping')
+        except PyMongoError:
+            cls._restore_connection()
+            raise unittest.SkipTest('MongoDB is not reachable at MONGO_TEST_URI')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._restore_connection()
+        super().tearDownClass()
+
+    @classmethod
+    def _restore_connection(cls):
+        disconnect()
+        connect(host=settings.MONGO_URI)
+
+    def setUp(self):
+        for document in (User, ChatRoom, Message):
+            document.drop_collection()
+
+
+class MessageSenderResolutionTests(MongoTestCase):
+    """
+    Reading msg.sender on a history page must not dereference one user per message
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+        for i in range(40):
+            sender = self.alice if i % 2 else self.bob
+            Message.create_message(self.room, sender, f'message {i}')
+
+    def count_page_queries(self, limit):
+        room = ChatRoom.objects.get(id=self.room.id)
+        with query_counter() as queries:
+            messages = room.get_messages(limit=limit)
+            usernames = [msg.sender.username for msg in messages]
+            count = int(queries)
+        self.assertEqual(len(usernames), limit)
+        return count
+
+    def test_query_count_constant_with_page_size(self):
+        self.assertEqual(self.count_page_queries(5), self.count_page_queries(40))
+
+
+class KeyRotationCatchUpTests(MongoTestCase):
+    """
+    Old room keys are only pruned once no process can still hold them cached
+    """
+
+    def setUp(self):
+        super().setUp()
+        ChatKeyRotation.drop_collection()
+        alice = User(username='alice', email='alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        self.room = ChatRoom.get_or_create_room(alice, bob)
+        Message.create_message(self.room, alice, 'hello')
+
+    @override_settings(CHAT_ROOM_KEY_CACHE_TTL=60)
+    def test_waits_one_ttl_after_a_rooms_phase_longer_than_the_ttl(self):
+        # Started ten TTLs ago, so only the end of the rooms phase bounds the wait
+        ChatKeyRotation(started_at=datetime.now() - timedelta(minutes=10)).save()
+        events = []
+
+        def prune(command, room):
+            events.append('prune')
+            return 0
+
+        with mock.patch.object(rotate_chat_keys.time, 'sleep', side_effect=lambda s: events.append(s)), \
+                mock.patch.object(rotate_chat_keys.Command, 'prune', prune):
+            call_command('rotate_chat_keys', pause_ms=0, stdout=StringIO())
+
+        rotation = ChatKeyRotation.objects.get()
+        self.assertIsNotNone(rotation.rooms_finished_at)
+        self.assertGreater(events[0], 55)
+        self.assertEqual(events[1:], ['prune'])
+
+
+class CatchUpWaitTests(SimpleTestCase):
+    def test_catch_up_wait_counts_from_end_of_rooms_phase(self):
+        rotation = ChatKeyRotation(
+            started_at=datetime.now() - timedelta(seconds=600),
+            rooms_finished_at=datetime.now() - timedelta(seconds=10)
+        )
+        self.assertAlmostEqual(rotate_chat_keys.catch_up_wait(rotation, 60), 50, delta=1)
+
+
+class ArchiveRetryTests(MongoTestCase):
+    """
+    An archive run interrupted between writing an archive and removing its
+    messages must not duplicate them in history
+    """
+
+    def setUp(self):
+        super().setUp()
+        MessageArchive.drop_collection()
+        alice = User(username='alice', email='alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        self.room = ChatRoom.get_or_create_room(alice, bob)
+        old = datetime.now() - timedelta(days=200)
+        for i in range(5):
+            message = Message.build_message(self.room, alice, f'old {i}')
+            message.timestamp = old + timedelta(seconds=i)
+            message.save()
+
+    def test_rerun_after_crash_before_delete(self):
+        with mock.patch.object(archive_messages.Command, 'move', lambda command, messages, room_id, chunk:
+                               MessageArchive.archive(room_id, chunk) or len(chunk)):
+            call_command('archive_messages', older_than_days=90, stdout=StringIO())
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(len(room.get_messages(limit=50)), 5)
+
+        call_command('archive_messages', older_than_days=90, stdout=StringIO())
+        self.assertEqual(MessageArchive.objects.count(), 1)
+        self.assertEqual(Message.objects(room=self.room).count(), 0)
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual([msg.decrypted_content for msg in room.get_messages(limit=50)],
+                         [f'old {i}' for i in range(5)])
+
+
+class ChatPurgeTests(MongoTestCase):
+    """
+    Deleting an account removes its rooms at once and leaves the messages,
+    search entries and archives to purge_deleted_chats
+    """
+
+    def setUp(self):
+        super().setUp()
+        for document in (ChatRoomDeletion, MessageArchive, MessageSearchIndex):
+            document.drop_collection()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        carol = User(username='carol', email='carol@example.com')
+        carol.save()
+        self.rooms = [ChatRoom.get_or_create_room(self.alice, bob), ChatRoom.get_or_create_room(self.alice, carol)]
+        self.kept = ChatRoom.get_or_create_room(bob, carol)
+        old = datetime.now() - timedelta(days=200)
+        for i in range(4):
+            message = Message.build_message(self.rooms[0], self.alice, f'old {i}')
+            message.timestamp = old + timedelta(seconds=i)
+            message.save()
+        call_command('archive_messages', older_than_days=90, stdout=StringIO())
+        for room in self.rooms + [self.kept]:
+            for i in range(3):
+                Message.create_message(room, bob if room is self.kept else self.alice, f'message {i}')
+
+    def stored(self, room_id):
+        return sum(model._get_collection().count_documents({'room': room_id})
+                   for model in (Message, MessageArchive, MessageSearchIndex))
+
+    def test_account_deletion_purged_to_completion(self):
+        deleted = ChatRoomDeletion.schedule_for_user(self.alice)
+        self.assertEqual(set(deleted), {room.id for room in self.rooms})
+        self.assertEqual(list(ChatRoom.objects.scalar('id')), [self.kept.id])
+        self.assertTrue(all(self.stored(room.id) for room in self.rooms))
+
+        call_command('purge_deleted_chats', batch_size=2, pause_ms=0, stdout=StringIO())
+        for room in self.rooms:
+            self.assertEqual(self.stored(room.id), 0)
+        self.assertEqual(ChatRoomDeletion.pending().count(), 0)
+        self.assertEqual(ChatRoomDeletion.objects.get(room=self.rooms[0].id).deleted_messages, 7)
+        self.assertEqual(Message.objects(room=self.kept).count(), 3)
+
+
+class MarkReadTests(MongoTestCase):
+    """
+    Marking a room read only covers the messages the reader loaded
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+        Message.create_message(self.room, self.bob, 'seen')
+
+    def test_message_arriving_after_page_load_stays_unread(self):
+        loaded = ChatRoom.objects.get(id=self.room.id)
+        later = Message.build_message(self.room, self.bob, 'not seen yet')
+        later.timestamp += timedelta(seconds=1)
+        Message.bulk_create([later])
+
+        self.assertFalse(loaded.mark_read(self.alice))
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.get_unread_count(self.alice), 2)
+        self.assertFalse(Message.objects.get(id=later.id).is_read)
+        self.assertTrue(Message.objects.get(room=self.room, id__ne=later.id).is_read)
+
+    def test_message_in_same_millisecond_detected(self):
+        loaded = ChatRoom.objects.get(id=self.room.id)
+        later = Message.build_message(self.room, self.bob, 'not seen yet')
+        later.timestamp = loaded.last_message_at
+        Message.bulk_create([later])
+
+        self.assertFalse(loaded.mark_read(self.alice))
+        self.assertEqual(ChatRoom.objects.get(id=self.room.id).get_unread_count(self.alice), 2)
+
+    def test_marks_loaded_messages_read(self):
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertTrue(room.mark_read(self.alice))
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.get_unread_count(self.alice), 0)
+        self.assertEqual(room.count_unread(self.alice), 0)
+
+    @override_settings(CHAT_MESSAGE_STORAGE='buckets')
+    def test_flags_flipped_inside_buckets(self):
+        MessageBucket.drop_collection()
+        room = ChatRoom.get_or_create_room(self.alice, self.bob)
+        Message.objects(room=room).delete()
+        Message.create_message(room, self.bob, 'seen')
+        Message.create_message(room, self.alice, 'own')
+        loaded = ChatRoom.objects.get(id=room.id)
+        later = Message.build_message(room, self.bob, 'not seen yet')
+        later.timestamp += timedelta(seconds=1)
+        Message.bulk_create([later])
+
+        # No watermark is set, so counting falls back to the is_read flags
+        self.assertFalse(loaded.mark_read(self.alice))
+        self.assertEqual(ChatRoom.objects.get(id=room.id).count_unread(self.alice), 1)
+        flags = {msg['sender']: msg['is_read'] for bucket in MessageBucket._get_collection().find()
+                 for msg in bucket['messages'] if msg['_id'] != later.id}
+        self.assertEqual(flags, {self.bob.id: True, self.alice.id: False})
+
+
+class BulkCreateRetryTests(MongoTestCase):
+    """
+    Retrying a write-behind batch that was (partly) stored must not store
+    messages twice or count them twice as unread
+    """
+
+    def setUp(self):
+        super().setUp()
+        MessageBucket.drop_collection()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+
+    def store_twice(self):
+        batch = [Message.build_message(self.room, self.alice, f'hi {i}') for i in range(3)]
+        Message.bulk_create(batch)
+        Message.bulk_create(batch, retry=True)
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.get_unread_count(self.bob), 3)
+        self.assertEqual(room.get_unread_count(self.alice), 0)
+        self.assertEqual(len(room.get_messages(limit=50)), 3)
+
+    def test_documents(self):
+        self.store_twice()
+
+    @override_settings(CHAT_MESSAGE_STORAGE='buckets', CHAT_BUCKET_SIZE=3)
+    def test_full_bucket(self):
+        self.store_twice()
+        self.assertEqual(MessageBucket.objects.count(), 1)
+
+
+class DecryptMessagesPoolTests(SimpleTestCase):
+    """
+    Batch decryption reuses one executor across calls instead of starting
+    a new pool for every batch
+    """
+
+    def setUp(self):
+        self.ciphertexts = [encrypt_message(f'message {i}') for i in range(3 * DECRYPT_CHUNK_SIZE)]
+        self.expected = [f'message {i}' for i in range(3 * DECRYPT_CHUNK_SIZE)]
+
+    def test_process_pool_started_once(self):
+        with mock.patch.object(encryption, '_process_pool', None), \
+                mock.patch.object(encryption, 'ProcessPoolExecutor', side_effect=ThreadPoolExecutor) as executor, \
+                mock.patch.object(encryption, 'decrypt_workers', return_value=2):
+            for _ in range(3):
+                self.assertEqual(decrypt_messages(self.ciphertexts, processes=True), self.expected)
+            encryption._process_pool.shutdown()
+        self.assertEqual(executor.call_count, 1)
+
+    def test_caller_pool(self):
+        with ThreadPoolExecutor(max_workers=2) as pool, mock.patch.object(pool, 'map', wraps=pool.map) as pool_map:
+            self.assertEqual(decrypt_messages(self.ciphertexts, pool=pool), self.expected)
+            self.assertEqual(decrypt_messages(self.ciphertexts[:5], pool=pool), self.expected[:5])
+        self.assertEqual(pool_map.call_count, 1)  # small batches stay inline
+
+
+class SearchQueryTokenTests(SimpleTestCase):
+    """
+    Words the index cannot hold are rejected instead of silently widening a search
+    """
+
+    def test_short_word_rejected(self):
+        with self.assertRaisesMessage(InvalidSearchQuery, '7'):
+            search_query_tokens('number 7', 'room')
+        with self.assertRaises(InvalidSearchQuery):
+            search_query_tokens('7', 'room')
+
+    def test_query_without_words_rejected(self):
+        with self.assertRaises(InvalidSearchQuery):
+            search_query_tokens('?!', 'room')
+
+    def test_query_tokens_match_index_tokens(self):
+        self.assertEqual(search_query_tokens('Number SEVEN', 'room'),
+                         blind_index_tokens('seven, number, a', 'room'))
+        self.assertNotEqual(search_query_tokens('seven', 'room'), search_query_tokens('seven', 'other'))
+
+
+class UpgradeCiphertextsTests(MongoTestCase):
+    """
+    Legacy ciphertexts are rewritten on read in the tier holding them;
+    archived ones are left to reencrypt_messages
+    """
+
+    def setUp(self):
+        super().setUp()
+        MessageArchive.drop_collection()
+        alice = User(username='alice', email='alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        self.room = ChatRoom.get_or_create_room(alice, bob)
+        self.old = self.legacy_message(alice, 'old', datetime.now() - timedelta(days=200))
+        self.new = self.legacy_message(alice, 'new', datetime.now())
+        call_command('archive_messages', older_than_days=90, stdout=StringIO())
+
+    def legacy_message(self, sender, content, timestamp):
+        message = Message(room=self.room, sender=sender, timestamp=timestamp,
+                          encrypted_content=encryption.cipher.encrypt_cbc(content))
+        message.save()
+        return message
+
+    def test_only_hot_messages_rewritten(self):
+        room = ChatRoom.objects.get(id=self.room.id)
+        with mock.patch('chat.models.UpdateOne', wraps=UpdateOne) as update:
+            messages, _, _ = room.get_messages_page(limit=10)
+        self.assertEqual([msg.decrypted_content for msg in messages], ['old', 'new'])
+        self.assertEqual(update.call_count, 1)
+        self.assertNotIsInstance(Message.objects.get(id=self.new.id).encrypted_content, str)
+
+    def test_rewrite_keeps_cached_plaintext(self):
+        room = ChatRoom.objects.get(id=self.room.id)
+        room.get_messages_page(limit=10)
+        self.assertEqual(get_message_cache().get(self.new.id), 'new')
+
+
+@override_settings(CHAT_DECRYPT_CACHE_BYTES=0)
+class EncryptedStringFieldTests(MongoTestCase):
+    """
+    The field holds the stored ciphertext; decrypted_content decrypts it on
+    first access only
+    """
+
+    def setUp(self):
+        super().setUp()
+        alice = User(username='alice', email='alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        self.room = ChatRoom.get_or_create_room(alice, bob)
+        self.message = Message.create_message(self.room, alice, 'hello')
+
+    def test_decrypts_lazily_once(self):
+        with mock.patch('chat.fields.decrypt_cached', wraps=decrypt_cached) as decrypt:
+            message = Message.objects.get(id=self.message.id)
+            self.assertEqual(decrypt.call_count, 0)
+            self.assertEqual(message.decrypted_content, 'hello')
+            self.assertEqual(message.decrypted_content, 'hello')
+        self.assertEqual(decrypt.call_count, 1)
+
+    def test_raw_ciphertext_access(self):
+        message = Message.objects.get(id=self.message.id)
+        stored = Message._get_collection().find_one({'_id': self.message.id})['encrypted_content']
+        with mock.patch('chat.fields.decrypt_cached') as decrypt:
+            self.assertEqual(message.encrypted_content, stored)
+        decrypt.assert_not_called()
+        self.assertEqual(encryption.decrypt_message(message.encrypted_content, self.room.id), 'hello')
+
+    def test_assignment_reencrypts(self):
+        message = Message.objects.get(id=self.message.id)
+        old = message.encrypted_content
+        with mock.patch('chat.fields.decrypt_cached') as decrypt:
+            message.decrypted_content = 'changed'
+            self.assertEqual(message.decrypted_content, 'changed')
+        decrypt.assert_not_called()
+        self.assertNotEqual(message.encrypted_content, old)
+        message.save()
+        self.assertEqual(Message.objects.get(id=self.message.id).decrypted_content, 'changed')
+
+
+class EnvelopeFormatTests(SimpleTestCase):
+    """
+    Every stored ciphertext format stays readable: legacy base64 CBC text,
+    0x01 GCM envelopes and 0x02 room envelopes under wrapped data keys
+    """
+    ROOM_ID = '5f0c1b2a3d4e5f6071829304'
+    DATA_KEY = bytes(range(32))
+
+    # Written by earlier releases with AESCipher('test-key') / DATA_KEY
+    LEGACY_CBC = 'j4ijESyPWO1W0yWlBta+AdsP8x8kXMV2A+zmnhwX7YY='
+    GCM_ENVELOPE = bytes.fromhex(
+        '0108e8fe42dcdf6ac470add0445544b69634f5aa3d98f8e99acfe4c698993527519404fcecf0'
+    )
+    ROOM_ENVELOPE = bytes.fromhex(
+        '020000000369a466fcf9f5c49e60e349d8fc1eaba6f18d0ad35277e51d60dfbb30ff906c1efc83848aa755'
+    )
+
+    def setUp(self):
+        self.cipher = encryption.AESCipher('test-key')
+
+    def test_stored_formats_still_decrypt(self):
+        self.assertEqual(self.cipher.decrypt(self.LEGACY_CBC), 'legacy hello')
+        self.assertEqual(self.cipher.decrypt(self.GCM_ENVELOPE), 'gcm hello')
+        self.assertEqual(encryption.room_key_version(self.ROOM_ENVELOPE), 3)
+        self.assertEqual(encryption.decrypt_with_room_key(self.ROOM_ENVELOPE, self.ROOM_ID, self.DATA_KEY), 'room hello')
+
+    def test_ciphertext_format(self):
+        self.assertEqual(encryption.ciphertext_format(self.LEGACY_CBC), ('legacy', False))
+        self.assertEqual(encryption.ciphertext_format(self.GCM_ENVELOPE), ('gcm', False))
+        self.assertEqual(encryption.ciphertext_format(self.ROOM_ENVELOPE), ('room', False))
+        self.assertEqual(encryption.ciphertext_format(b'\x07abc'), ('unknown', False))
+
+    def test_round_trips(self):
+        self.assertEqual(self.cipher.decrypt(self.cipher.encrypt_cbc('héllo')), 'héllo')
+        envelope = self.cipher.encrypt_gcm('héllo')
+        self.assertEqual(envelope[:1], encryption.ENVELOPE_GCM)
+        self.assertEqual(self.cipher.decrypt(envelope), 'héllo')
+        envelope = encryption.encrypt_with_room_key('héllo', self.ROOM_ID, 7, self.DATA_KEY)
+        self.assertEqual(envelope[:1], encryption.ENVELOPE_ROOM)
+        self.assertEqual(encryption.room_key_version(envelope), 7)
+        self.assertEqual(encryption.decrypt_with_room_key(envelope, self.ROOM_ID, self.DATA_KEY), 'héllo')
+        self.assertEqual(self.cipher.encrypt_gcm(''), b'')
+
+    def test_tampering_detected(self):
+        envelope = bytearray(self.GCM_ENVELOPE)
+        envelope[-1] ^= 1
+        self.assertEqual(self.cipher.decrypt(bytes(envelope)), encryption.DECRYPTION_FAILED)
+        self.assertEqual(encryption.AESCipher('other-key').decrypt(self.GCM_ENVELOPE), encryption.DECRYPTION_FAILED)
+
+    def test_room_envelope_bound_to_room(self):
+        with self.assertRaises(ValueError):
+            encryption.decrypt_with_room_key(self.ROOM_ENVELOPE, '5f0c1b2a3d4e5f6071829305', self.DATA_KEY)
+
+    @override_settings(ENCRYPTION_KEY='new-master', ENCRYPTION_KEY_PREVIOUS=['old-master'])
+    def test_wrapped_data_keys(self):
+        wrapped = room_keys.wrap_key(self.DATA_KEY, self.ROOM_ID, 3)
+        self.assertEqual(room_keys.unwrap_key(wrapped, self.ROOM_ID, 3), self.DATA_KEY)
+        with self.assertRaises(room_keys.RoomKeyError):
+            room_keys.unwrap_key(wrapped, self.ROOM_ID, 4)
+
+        # Wrapped before the master key changed
+        with override_settings(ENCRYPTION_KEY='old-master', ENCRYPTION_KEY_PREVIOUS=[]):
+            old_wrapped = room_keys.wrap_key(self.DATA_KEY, self.ROOM_ID, 3)
+        self.assertEqual(room_keys.unwrap_key(old_wrapped, self.ROOM_ID, 3), self.DATA_KEY)
+        with override_settings(ENCRYPTION_KEY_PREVIOUS=[]), self.assertRaises(room_keys.RoomKeyError):
+            room_keys.unwrap_key(old_wrapped, self.ROOM_ID, 3)
+
+    def test_mixed_batch(self):
+        ciphertexts = [
+            encryption.cipher.encrypt_cbc('legacy'),
+            encryption.cipher.encrypt_gcm('gcm'),
+            encryption.encrypt_with_room_key('room', self.ROOM_ID, 3, self.DATA_KEY),
+            '',
+        ]
+        with mock.patch.object(room_keys, 'get_room_key', return_value=(3, self.DATA_KEY)):
+            self.assertEqual(decrypt_messages(ciphertexts, room_id=self.ROOM_ID), ['legacy', 'gcm', 'room', ''])
+
+
+@override_settings(CHAT_COMPRESS_THRESHOLD=16)
+class CompressedEnvelopeTests(SimpleTestCase):
+    """
+    Long messages are compressed before encryption (flag 0x80 on the
+    envelope version byte) and the flag is authenticated
+    """
+    ROOM_ID = EnvelopeFormatTests.ROOM_ID
+    DATA_KEY = EnvelopeFormatTests.DATA_KEY
+    LONG = 'compress me ' * 10
+
+    # Written by an earlier release with AESCipher('test-key')
+    COMPRESSED_GCM_ENVELOPE = bytes.fromhex(
+        '81335bb4fb05d736eabeda6e2504f32a544efaae1c957675f2afc4e973a142186a8d13105207c636cb12ac304f148f84d492694f'
+    )
+
+    def setUp(self):
+        self.cipher = encryption.AESCipher('test-key')
+
+    def test_stored_compressed_envelope_still_decrypts(self):
+        self.assertEqual(encryption.ciphertext_format(self.COMPRESSED_GCM_ENVELOPE), ('gcm', True))
+        self.assertEqual(self.cipher.decrypt(self.COMPRESSED_GCM_ENVELOPE), self.LONG)
+
+    def test_long_messages_compressed(self):
+        envelope = self.cipher.encrypt_gcm(self.LONG)
+        self.assertEqual(envelope[0], 0x81)
+        self.assertLess(len(envelope), len(self.LONG.encode()))
+        self.assertEqual(self.cipher.decrypt(envelope), self.LONG)
+
+        envelope = encryption.encrypt_with_room_key(self.LONG, self.ROOM_ID, 2, self.DATA_KEY)
+        self.assertEqual(envelope[0], 0x82)
+        self.assertEqual(encryption.ciphertext_format(envelope), ('room', True))
+        self.assertEqual(encryption.room_key_version(envelope), 2)
+        self.assertEqual(encryption.decrypt_with_room_key(envelope, self.ROOM_ID, self.DATA_KEY), self.LONG)
+
+    def test_short_or_incompressible_messages_left_alone(self):
+        self.assertEqual(self.cipher.encrypt_gcm('short')[0], 0x01)
+        incompressible = 'abcdefghijklmnopqrstuvwxyz'  # zlib output would be longer
+        self.assertEqual(encryption.pack_plaintext(incompressible), (0, incompressible.encode()))
+        with override_settings(CHAT_COMPRESS_THRESHOLD=0):
+            self.assertEqual(self.cipher.encrypt_gcm(self.LONG)[0], 0x01)
+
+    def test_flag_is_authenticated(self):
+        # Clearing the flag must not turn a compressed envelope into a readable plain one
+        envelope = bytearray(self.cipher.encrypt_gcm(self.LONG))
+        envelope[0] = 0x01
+        self.assertEqual(self.cipher.decrypt(bytes(envelope)), encryption.DECRYPTION_FAILED)
+        envelope = bytearray(encryption.encrypt_with_room_key(self.LONG, self.ROOM_ID, 2, self.DATA_KEY))
+        envelope[0] = 0x02
+        with self.assertRaises(ValueError):
+            encryption.decrypt_with_room_key(bytes(envelope), self.ROOM_ID, self.DATA_KEY)
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        key = (datetime(2024, 5, 1, 12, 30, 15, 123000), ObjectId())
+        cursor = encode_cursor(*key)
+        self.assertIsInstance(cursor, str)
+        self.assertEqual(decode_cursor(cursor), key)
+
+    def test_invalid_cursors(self):
+        valid = encode_cursor(datetime(2024, 5, 1), ObjectId())
+        for cursor in ('', 'not a cursor', valid[:-4], encode_cursor(datetime(2024, 5, 1), 'x' * 24),
+                       base64.urlsafe_b64encode(b'2024-05-01T00:00:00').decode()):
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+
+class ChunkPagingTests(SimpleTestCase):
+    """
+    collect_from_chunks (buckets, archives) pages on (timestamp, _id), so
+    messages sharing a timestamp are neither skipped nor repeated
+    """
+
+    def setUp(self):
+        moment = datetime(2024, 5, 1)
+        ids = sorted(ObjectId() for _ in range(7))
+        # Five messages in the same millisecond, spread over two chunks
+        timestamps = [moment] * 5 + [moment + timedelta(seconds=1)] * 2
+        self.docs = [{'_id': i, 'timestamp': t} for i, t in zip(ids, timestamps)]
+        self.chunks = [
+            {'first_timestamp': moment, 'last_timestamp': moment, 'messages': self.docs[:3]},
+            {'first_timestamp': moment, 'last_timestamp': timestamps[-1], 'messages': self.docs[3:]},
+        ]
+
+    def page_through(self, direction, size):
+        chunks = self.chunks if direction == 'after' else list(reversed(self.chunks))
+        seen, bound = [], None
+        while True:
+            page = collect_from_chunks(chunks, bound, direction, size)
+            if not page:
+                return seen
+            seen += page
+            bound = (page[-1]['timestamp'], page[-1]['_id'])
+
+    def test_forward(self):
+        for size in (1, 2, 3):
+            self.assertEqual(self.page_through('after', size), self.docs)
+
+    def test_backward(self):
+        for size in (1, 2, 3):
+            self.assertEqual(self.page_through('before', size), list(reversed(self.docs)))
+
+    def test_duplicate_chunks_collected_once(self):
+        chunks = self.chunks + [dict(self.chunks[0])]
+        self.assertEqual(collect_from_chunks(chunks, None, 'after', 10), self.docs)
+
+
+class KeysetPaginationTests(MongoTestCase):
+    """
+    History pages continue on (timestamp, id), so messages stored in the
+    same millisecond are neither skipped nor repeated across pages
+    """
+
+    def setUp(self):
+        super().setUp()
+        alice = User(username='alice', email='alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        self.room = ChatRoom.get_or_create_room(alice, bob)
+        moment = datetime.now().replace(microsecond=0)
+        messages = [Message.build_message(self.room, alice, f'message {i}') for i in range(7)]
+        for message in messages:
+            message.timestamp = moment
+        Message.bulk_create(messages)
+        self.contents = [f'message {i}' for i in range(7)]
+
+    def test_paging_backward_and_forward(self):
+        room = ChatRoom.objects.get(id=self.room.id)
+        older, cursor = [], None
+        while True:
+            page, cursor, _ = room.get_messages_page(limit=3, before=cursor)
+            older = [msg.decrypted_content for msg in page] + older
+            if not cursor:
+                break
+        self.assertEqual(older, self.contents)
+
+        first, _, cursor = room.get_messages_page(limit=3, after=encode_cursor(datetime(2000, 1, 1), ObjectId()))
+        newer = [msg.decrypted_content for msg in first]
+        while cursor:
+            page, _, cursor = room.get_messages_page(limit=3, after=cursor)
+            newer += [msg.decrypted_content for msg in page]
+        self.assertEqual(newer, self.contents)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            self.room.get_messages_page(before='garbage')
+
+
+class RoomSummaryTests(MongoTestCase):
+    """
+    Stored messages keep the room's inbox summary (preview, last message,
+    unread counters) current without reading the messages back
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+
+    def test_summary_follows_messages(self):
+        Message.create_message(self.room, self.alice, 'hi bob')
+        Message.create_message(self.room, self.alice, 'are you there?')
+        last = Message.create_message(self.room, self.bob, 'x' * 200)
+
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.get_unread_count(self.bob), 2)
+        self.assertEqual(room.get_unread_count(self.alice), 1)
+        self.assertEqual(room.get_last_message_preview(), make_preview('x' * 200))
+        self.assertEqual(room.last_message_id, last.id)
+        self.assertEqual(room.last_sender.id, self.bob.id)
+
+    def test_counters_incremented_not_overwritten(self):
+        Message.create_message(self.room, self.alice, 'first')
+        # A message stored concurrently by another process
+        ChatRoom.objects(id=self.room.id).update_one(**{f'inc__unread_counts__{self.bob.id}': 4})
+        messages = [Message.build_message(self.room, self.alice, f'batch {i}') for i in range(3)]
+        Message.bulk_create(messages)
+
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.get_unread_count(self.bob), 8)
+        self.assertEqual(room.get_unread_count(self.alice), 0)
+        self.assertEqual(room.get_last_message_preview(), 'batch 2')
+
+
+class RoomListPaginationTests(MongoTestCase):
+    """
+    The room list is one sorted query on participants, paged on
+    (last_message_at, id) so rooms active in the same millisecond are
+    neither skipped nor repeated
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        moment = datetime.now().replace(microsecond=0)
+        self.rooms = []
+        for i in range(5):
+            other = User(username=f'user{i}', email=f'user{i}@example.com')
+            other.save()
+            room = ChatRoom.get_or_create_room(self.alice, other)
+            # Three rooms share a timestamp and straddle the page boundaries
+            room.update(set__last_message_at=moment - timedelta(seconds=min(i, 2)))
+            self.rooms.append(room.id)
+        outsider = User(username='outsider', email='outsider@example.com')
+        outsider.save()
+        ChatRoom.get_or_create_room(outsider, User.objects.get(username='user0'))
+
+    def test_pages_cover_every_room_once(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = ChatRoom.get_rooms_for_user(self.alice, limit=2, cursor=cursor)
+            self.assertLessEqual(len(page), 2)
+            seen += [room.id for room in page]
+            if not cursor:
+                break
+        expected = self.rooms[:2] + sorted(self.rooms[2:], reverse=True)
+        self.assertEqual(seen, expected)
+
+    def test_last_page_has_no_cursor(self):
+        page, cursor = ChatRoom.get_rooms_for_user(self.alice, limit=5)
+        self.assertEqual(len(page), 5)
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor_rejected_by_api(self):
+        request = RequestFactory().get('/chat/api/rooms/', {'cursor': 'garbage'})
+        request.user = self.alice
+        response = views.get_rooms_api(request)
+        self.assertEqual(response.status_code, 400)
+
+
+class FrameCoalescerTests(SimpleTestCase):
+    """
+    Bursts of outgoing frames go out as one batch frame, in order
+    """
+
+    def setUp(self):
+        self.sent = []
+        get_coalescing_stats().reset()
+
+    async def send(self, frame):
+        self.sent.append(frame)
+
+    def frame(self, i):
+        return json.dumps({'type': 'message', 'id': i})
+
+    async def test_burst_sent_as_one_batch_after_window(self):
+        coalescer = FrameCoalescer(self.send, window=0.01)
+        for i in range(3):
+            await coalescer.add(self.frame(i))
+        self.assertEqual(self.sent, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.sent), 1)
+        batch = json.loads(self.sent[0])
+        self.assertEqual(batch['type'], 'batch')
+        self.assertEqual([message['id'] for message in batch['messages']], [0, 1, 2])
+        stats = get_coalescing_stats().stats()
+        self.assertEqual((stats['messages'], stats['frames'], stats['batches']), (3, 1, 1))
+
+    async def test_lone_frame_sent_unwrapped(self):
+        coalescer = FrameCoalescer(self.send, window=0.01)
+        await coalescer.add(self.frame(0))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [self.frame(0)])
+
+    async def test_limits_flush_immediately(self):
+        coalescer = FrameCoalescer(self.send, window=60, max_messages=2)
+        for i in range(5):
+            await coalescer.add(self.frame(i))
+        self.assertEqual(len(self.sent), 2)
+        await coalescer.flush()
+        self.assertEqual([json.loads(frame).get('id') for frame in self.sent], [None, None, 4])
+
+        self.sent.clear()
+        coalescer = FrameCoalescer(self.send, window=60, max_bytes=len(self.frame(0)) * 2)
+        await coalescer.add(self.frame(0))
+        await coalescer.add(self.frame(1))
+        self.assertEqual(len(self.sent), 1)
+        coalescer.close()
+
+    async def test_close_drops_buffer(self):
+        coalescer = FrameCoalescer(self.send, window=0.01)
+        await coalescer.add(self.frame(0))
+        coalescer.close()
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [])
+
+
+@unittest.skipIf(codec.msgpack is None, 'msgpack is not installed')
+class WireFormatTests(SimpleTestCase):
+    """
+    Clients offering the msgpack sub-protocol get compact binary frames that
+    decode back to the JSON field names
+    """
+
+    def test_negotiation(self):
+        self.assertIs(negotiate_wire(['chat', 'msgpack']), MsgpackWire)
+        self.assertIs(negotiate_wire([]), JsonWire)
+        with override_settings(CHAT_MSGPACK=False):
+            self.assertIs(negotiate_wire(['msgpack']), JsonWire)
+            self.assertEqual(wire_formats(), (JsonWire,))
+
+    def test_round_trip_with_field_codes(self):
+        data = {'type': 'chat_message', 'message': 'héllo', 'sender_id': 'abc', 'timestamp': 1.5, 'extra': [1, 2]}
+        frame = MsgpackWire.encode(data)
+        self.assertIsInstance(frame, bytes)
+        self.assertEqual(codec.msgpack.unpackb(frame)['m'], 'héllo')
+        self.assertEqual(MsgpackWire.decode(frame), data)
+        self.assertLess(len(frame), len(JsonWire.encode(data)))
+
+    def test_batch_splices_packed_frames(self):
+        messages = [{'type': 'chat_message', 'message': str(i)} for i in range(3)]
+        batch = MsgpackWire.decode(MsgpackWire.batch([MsgpackWire.encode(data) for data in messages]))
+        self.assertEqual(batch['type'], 'batch')
+        self.assertEqual([{FIELD_NAMES.get(key, key): value for key, value in msg.items()}
+                          for msg in batch['messages']], messages)
+
+    def test_invalid_frames_rejected(self):
+        for frame in (b'\xc1', codec.msgpack.packb([1, 2])):
+            with self.assertRaises(InvalidFrame):
+                MsgpackWire.decode(frame)
+
+
+class TimerWheelTests(SimpleTestCase):
+    """
+    Presence deadlines expire within one tick of when they are due
+    """
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1, slots=8)
+        self.start = self.wheel.last_tick
+
+    def test_expires_when_due(self):
+        self.wheel.schedule('a', 2)
+        self.wheel.schedule('b', 3.5)
+        self.assertEqual(self.wheel.advance(self.start + 1.5), [])
+        self.assertEqual(self.wheel.advance(self.start + 2), ['a'])
+        self.assertEqual(self.wheel.advance(self.start + 3.9), [])
+        self.assertEqual(self.wheel.advance(self.start + 4), ['b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule('a', 2)
+        self.wheel.schedule('a', 5)  # heartbeat pushes the deadline back
+        self.wheel.schedule('b', 2)
+        self.wheel.cancel('b')
+        self.assertEqual(self.wheel.advance(self.start + 4), [])
+        self.assertEqual(self.wheel.advance(self.start + 5), ['a'])
+        self.wheel.cancel('missing')
+
+    def test_delays_clamped_to_wheel(self):
+        self.wheel.schedule('now', 0)
+        self.wheel.schedule('far', 100)
+        self.assertEqual(self.wheel.advance(self.start + 1), ['now'])
+        self.assertEqual(self.wheel.advance(self.start + 7), ['far'])
+
+    def test_long_pause_expires_everything(self):
+        for i in range(5):
+            self.wheel.schedule(i, i + 1)
+        self.assertEqual(sorted(self.wheel.advance(self.start + 50)), list(range(5)))
+        self.wheel.schedule('next', 2)
+        self.assertEqual(self.wheel.advance(self.start + 51), [])
+        self.assertEqual(self.wheel.advance(self.start + 52), ['next'])
+
+
+@unittest.skipIf(motor_asyncio is None, 'motor is not installed')
+class AsyncChatStoreTests(MongoTestCase):
+    """
+    The motor path stores the same documents as the MongoEngine models
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+
+    async def test_stores_and_reads_message(self):
+        store = AsyncChatStore(MONGO_TEST_URI)
+        self.addCleanup(store.client.close)
+        self.assertIsNone(await store.get_room('not an id'))
+        room = await store.get_room(str(self.room.id))
+        self.assertTrue(room.has_participant(self.bob))
+
+        message = await store.create_message(room, self.bob.id, 'over motor')
+        self.assertEqual(Message.objects.get(id=message.id).decrypted_content, 'over motor')
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.last_message_id, message.id)
+        self.assertEqual(room.get_last_message_preview(), 'over motor')
+        self.assertEqual(room.get_unread_count(self.alice), 1)
+
+
+class NotifyUsersTests(SimpleTestCase):
+    """
+    User events reach every socket of a user, whatever presence says
+    """
+
+    async def test_sends_to_users_presence_missed(self):
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        presence = mock.Mock(online=mock.Mock(return_value=set()))
+        with mock.patch.object(consumers, 'get_channel_layer', return_value=layer), \
+                mock.patch.object(consumers, 'get_presence', return_value=presence):
+            await consumers.notify_users(['a', 'a', 'b', None], {'type': 'unread_count', 'count': 1})
+        groups = [call.args[0] for call in layer.group_send.call_args_list]
+        self.assertEqual(groups, [consumers.user_group_name('a'), consumers.user_group_name('b')])
+        event = layer.group_send.call_args.args[1]
+        self.assertEqual(event['type'], 'user_event')
+        presence.online.assert_not_called()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_ASYNC_MONGO=False, CHAT_COALESCE_WINDOW_MS=0
+)
+class UserConsumerTests(MongoTestCase):
+    """
+    One socket per user: inbox events plus the streams of the rooms it joined
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.carol = User(username='carol', email='carol@example.com')
+        self.carol.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+        self.room_id = str(self.room.id)
+        presence = mock.Mock(connect=mock.AsyncMock())
+        patcher = mock.patch.object(consumers, 'get_presence', return_value=presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/user/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        if connected:
+            self.assertEqual((await communicator.receive_json_from())['type'], 'connection_established')
+        return communicator, connected
+
+    async def broadcast(self, text):
+        await get_channel_layer().group_send(consumers.room_group_name(self.room_id), consumers.message_event({
+            'message_id': ObjectId(), 'content': text, 'sender_id': str(self.bob.id),
+            'sender_username': 'bob', 'timestamp': '2024-01-01T00:00:00', 'room_id': self.room_id,
+        }))
+
+    async def test_anonymous_rejected(self):
+        communicator, connected = await self.connect(None)
+        self.assertFalse(connected)
+
+    async def test_join_room_of_other_users_refused(self):
+        communicator, _ = await self.connect(self.carol)
+        await communicator.send_json_to({'action': 'join', 'room_id': self.room_id})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['type'], 'error')
+        self.assertEqual(frame['room_id'], self.room_id)
+        await self.broadcast('private')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_join_forwards_until_leave(self):
+        communicator, _ = await self.connect(self.alice)
+        await communicator.send_json_to({'action': 'join', 'room_id': self.room_id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'joined', 'room_id': self.room_id})
+        await self.broadcast('hello')
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['type'], frame['message'], frame['room_id']), ('message', 'hello', self.room_id))
+
+        await communicator.send_json_to({'action': 'leave', 'room_id': self.room_id})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'left', 'room_id': self.room_id})
+        await self.broadcast('gone')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_broadcast_encoded_once_for_every_socket(self):
+        sockets = []
+        for user, subprotocols in ((self.alice, None), (self.bob, None), (self.alice, ['msgpack'])):
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/user/', subprotocols=subprotocols)
+            communicator.scope['user'] = user
+            await communicator.connect()
+            await communicator.receive_from()
+            await communicator.send_json_to({'action': 'join', 'room_id': self.room_id})
+            await communicator.receive_from()
+            sockets.append(communicator)
+
+        event = consumers.message_event({
+            'message_id': ObjectId(), 'content': 'once', 'sender_id': str(self.bob.id),
+            'sender_username': 'bob', 'timestamp': '12:00', 'room_id': self.room_id,
+        })
+        with mock.patch.object(JsonWire, 'encode') as json_encode, \
+                mock.patch.object(MsgpackWire, 'encode') as msgpack_encode:
+            await get_channel_layer().group_send(consumers.room_group_name(self.room_id), event)
+            frames = [await communicator.receive_from() for communicator in sockets]
+        json_encode.assert_not_called()
+        msgpack_encode.assert_not_called()
+        self.assertEqual(frames, [event['frame'], event['frame'], event['packed']])
+        for communicator in sockets:
+            await communicator.disconnect()
+
+    async def test_room_deleted_drops_stream(self):
+        communicator, _ = await self.connect(self.alice)
+        await communicator.send_json_to({'action': 'join', 'room_id': self.room_id})
+        await communicator.receive_json_from()
+        await get_channel_layer().group_send(
+            consumers.room_group_name(self.room_id), {'type': 'room_deleted', 'room_id': self.room_id}
+        )
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['type'], frame['room_id']), ('room_deleted', self.room_id))
+        await self.broadcast('after delete')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_ASYNC_MONGO=False, CHAT_WRITE_BEHIND=False, CHAT_COALESCE_WINDOW_MS=0
+)
+class ChatConsumerTests(MongoTestCase):
+    """
+    A room socket resolves the room once and lets go of it when the room is deleted
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, bob)
+        presence = mock.Mock(connect=mock.AsyncMock())
+        patcher = mock.patch.object(consumers, 'get_presence', return_value=presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_room_deleted_closes_socket(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chat/{self.room.id}/')
+        communicator.scope['user'] = self.alice
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_json_from()
+        with mock.patch.object(Message, 'create_message', wraps=Message.create_message) as create:
+            await communicator.send_json_to({'message': 'hello'})
+            self.assertEqual((await communicator.receive_json_from())['message'], 'hello')
+        self.assertEqual(create.call_count, 1)
+
+        await get_channel_layer().group_send(consumers.room_group_name(self.room.id), {'type': 'room_deleted'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'room_deleted')
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        await communicator.disconnect()
+
+
+class MessagesEtagTests(MongoTestCase):
+    """
+    Every stored message changes the messages API ETag, even one stored in
+    the same millisecond as the previous message
+    """
+
+    def test_same_millisecond_messages(self):
+        alice = User(username='alice', email='alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        room = ChatRoom.get_or_create_room(alice, bob)
+        request = RequestFactory().get('/chat/api/messages/', {'since': 'x'})
+        moment = datetime.now().replace(microsecond=0)
+
+        etags = []
+        for content in ('first', 'second'):
+            message = Message.build_message(room, alice, content)
+            message.timestamp = moment
+            Message.bulk_create([message])
+            etags.append(views._messages_etag(ChatRoom.objects.get(id=room.id), request))
+        self.assertNotEqual(etags[0], etags[1])
+        self.assertEqual(etags[1], views._messages_etag(ChatRoom.objects.get(id=room.id), request))
+
+
+class BucketMigrationTests(MongoTestCase):
+    """
+    Moving to bucket storage survives interruption, and tools built on the
+    model API keep working in bucket mode
+    """
+
+    def setUp(self):
+        super().setUp()
+        MessageBucket.drop_collection()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+        for i in range(5):
+            Message.create_message(self.room, self.alice, f'message {i}')
+
+    @override_settings(CHAT_MESSAGE_STORAGE='buckets', CHAT_BUCKET_SIZE=3)
+    def test_rerun_after_crash_before_delete(self):
+        write_bucket = migrate_message_storage.Command.write_bucket
+
+        def crash_before_delete(command, messages, buckets, room_id, chunk):
+            # Buckets are written, but the interrupted run never removes the messages
+            return write_bucket(command, mock.Mock(), buckets, room_id, chunk)
+
+        with mock.patch.object(migrate_message_storage.Command, 'write_bucket', crash_before_delete):
+            call_command('migrate_message_storage', to='buckets', stdout=StringIO())
+        call_command('migrate_message_storage', to='buckets', stdout=StringIO())
+
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(sum(bucket.count for bucket in MessageBucket.objects), 5)
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.count_unread(self.bob), 5)
+        self.assertEqual([msg.decrypted_content for msg in room.get_messages(limit=50)],
+                         [f'message {i}' for i in range(5)])
+
+    @override_settings(CHAT_MESSAGE_STORAGE='buckets', CHAT_BUCKET_SIZE=3)
+    def test_backfill_summaries_in_bucket_mode(self):
+        call_command('migrate_message_storage', to='buckets', stdout=StringIO())
+        ChatRoom.objects(id=self.room.id).update_one(
+            unset__last_message_preview=True, unset__unread_counts=True, unset__last_message_id=True
+        )
+
+        call_command('backfill_chat_rooms', stdout=StringIO())
+        room = ChatRoom.objects.get(id=self.room.id)
+        self.assertEqual(room.get_last_message_preview(), 'message 4')
+        self.assertEqual(room.get_unread_count(self.bob), 5)
+        self.assertEqual(room.get_unread_count(self.alice), 0)
+
+
+class BenchmarkIsolationTests(MongoTestCase):
+    """
+    benchmark_chat runs against the configured database, so it must only
+    remove the users and rooms it created itself
+    """
+
+    def test_existing_accounts_left_alone(self):
+        alice = User(username='bench_alice', email='bench_alice@example.com')
+        alice.save()
+        bob = User(username='bob', email='bob@example.com')
+        bob.save()
+        room = ChatRoom.get_or_create_room(alice, bob)
+        Message.create_message(room, alice, 'keep me')
+
+        call_command('benchmark_chat', 'create_message', messages=3, concurrency=1, stdout=StringIO())
+
+        self.assertEqual(sorted(user.username for user in User.objects), ['bench_alice', 'bob'])
+        self.assertEqual(ChatRoom.objects.count(), 1)
+        self.assertEqual(Message.objects.count(), 1)
+
+
+class WriteBehindFailureTests(SimpleTestCase):
+    """
+    A batch that can never be stored is given up on after max_attempts
+    instead of blocking every message queued behind it
+    """
+
+    async def test_failing_batch_dead_lettered_and_slots_released(self):
+        buffer = MessageWriteBehind(flush_interval=0.001, batch_size=10, max_pending=3,
+                                    max_attempts=3, max_backoff=0.002)
+        messages = [SimpleNamespace(id=ObjectId()) for _ in range(3)]
+        dead, stored = [], []
+
+        with mock.patch.object(Message, 'bulk_create', side_effect=RuntimeError('bad batch')) as bulk_create, \
+                mock.patch.object(buffer, '_dead_letter', side_effect=dead.extend), \
+                self.assertLogs('chat.write_behind', 'ERROR'):
+            for message in messages:
+                await buffer.enqueue(message)
+            # Blocks until the failing messages give their slots back
+            await asyncio.wait_for(buffer.enqueue(SimpleNamespace(id=ObjectId())), 2)
+            self.assertEqual(dead, messages)
+            self.assertEqual(bulk_create.call_args_list[0].kwargs, {'retry': False})
+            self.assertEqual(bulk_create.call_args_list[1].kwargs, {'retry': True})
+
+            bulk_create.side_effect = lambda batch, retry: stored.extend(batch)
+            await asyncio.sleep(0.05)
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(buffer.failed, {})
+        buffer._task.cancel()
+
+
+class DecryptedMessageCacheTests(SimpleTestCase):
+    """
+    Bounded LRU of decrypted plaintext
+    """
+
+    def test_evicts_least_recently_used_within_byte_bound(self):
+        entry_size = sys.getsizeof('message 0')
+        cache = DecryptedMessageCache(max_bytes=entry_size * 3)
+        for i in range(3):
+            cache.put(i, f'message {i}')
+        cache.get(0)  # now most recently used
+        cache.put(3, 'message 3')
+
+        self.assertIsNone(cache.get(1))
+        self.assertEqual([cache.get(i) for i in (0, 2, 3)], ['message 0', 'message 2', 'message 3'])
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        cache.put('huge', 'x' * entry_size * 4)  # larger than the whole cache: not cached
+        self.assertIsNone(cache.get('huge'))
+        self.assertEqual(cache.stats()['entries'], 3)
+
+    def test_counters(self):
+        cache = DecryptedMessageCache(max_bytes=sys.getsizeof('a') * 2)
+        cache.put('a', 'a')
+        cache.get('a')
+        cache.get('b')
+        cache.put('b', 'b')
+        cache.put('c', 'c')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+        self.assertEqual(stats['entries'], 2)
+
+    def test_invalidate_room(self):
+        cache = DecryptedMessageCache(max_bytes=10000)
+        cache.put(1, 'one', room_id='room a')
+        cache.put(2, 'two', room_id='room b')
+        cache.put(('preview', 'room a', 1), 'one', room_id='room a')
+        cache.invalidate_room('room a')
+        self.assertEqual([cache.get(1), cache.get(2), cache.get(('preview', 'room a', 1))], [None, 'two', None])
+        self.assertEqual(cache.size, sys.getsizeof('two'))
+
+    @override_settings(CHAT_DECRYPT_CACHE_BYTES=0)
+    def test_disabled(self):
+        self.assertIsNone(get_message_cache())
+        ciphertext = encrypt_message('not cached')
+        with mock.patch.object(message_cache, 'decrypt_message', wraps=message_cache.decrypt_message) as decrypt:
+            self.assertEqual(decrypt_cached('id', ciphertext), 'not cached')
+            self.assertEqual(decrypt_cached('id', ciphertext), 'not cached')
+        self.assertEqual(decrypt.call_count, 2)
+
+    @override_settings(CHAT_DECRYPT_CACHE_BYTES=10000)
+    def test_enabled(self):
+        ciphertext = encrypt_message('cached')
+        with mock.patch.object(message_cache, 'decrypt_message', wraps=message_cache.decrypt_message) as decrypt:
+            self.assertEqual(decrypt_cached('cache test id', ciphertext), 'cached')
+            self.assertEqual(decrypt_cached('cache test id', ciphertext), 'cached')
+        self.assertEqual(decrypt.call_count, 1)
+
+
+@override_settings(CHAT_DECRYPT_CACHE_BYTES=100000)
+class CachedPreviewTests(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User(username='alice', email='alice@example.com')
+        self.alice.save()
+        self.bob = User(username='bob', email='bob@example.com')
+        self.bob.save()
+        self.room = ChatRoom.get_or_create_room(self.alice, self.bob)
+
+    def test_preview_of_message_in_same_millisecond(self):
+        moment = datetime.now().replace(microsecond=0)
+        for content in ('first', 'second'):
+            message = Message.build_message(self.room, self.alice, content)
+            message.timestamp = moment
+            Message.bulk_create([message])
+            self.assertEqual(ChatRoom.objects.get(id=self.room.id).get_last_message_preview(), content)
+
+    def test_room_deletion_drops_cached_plaintext(self):
+        message = Message.create_message(self.room, self.alice, 'secret')
+        ChatRoom.objects.get(id=self.room.id).get_last_message_preview()
+        cache = get_message_cache()
+        self.assertEqual(cache.get(message.id), 'secret')
+
+        ChatRoomDeletion.schedule([self.room.id])
+        self.assertIsNone(cache.get(message.id))
+        self.assertNotIn(self.room.id, cache.rooms)
@@ -9,5 +9,8 @@ urlpatterns = [
     path('search/', views.search_user, name='search_user'),
     path('room/<str:room_id>/', views.chat_room, name='chat_room'),
     path('delete/<str:room_id>/', views.delete_chat, name='delete_chat'),
+    path('export/<str:room_id>/', views.export_chat, name='export_chat'),
+    path('api/rooms/', views.get_rooms_api, name='get_rooms_api'),
     path('api/messages/<str:room_id>/', views.get_messages_api, name='get_messages_api'),
+    path('api/messages/<str:room_id>/search/', views.search_messages_api, name='search_messages_api'),
 ]
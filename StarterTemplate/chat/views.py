@@ -1,11 +1,52 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import parse_etags
 from accounts.models import User
-from .models import ChatRoom, Message
+from .models import ChatRoom, ChatRoomDeletion, Message
 from .forms import MessageForm, SearchUserForm
+from .encryption import InvalidSearchQuery
+from .pagination import InvalidCursor
+from .presence import room_presence
+from .consumers import notify_room_deleted, notify_message_sent, notify_unread_count
 from bson import ObjectId
+import hashlib
+
+
+ROOMS_PAGE_SIZE = 20
+MESSAGES_PAGE_SIZE = 100
+
+
+def _annotate_room(room, current_user):
+    """
+    Attach the inbox summary fields used by the templates and the rooms API
+    """
+    room.other_user = room.get_other_user(current_user)
+    room.last_message = room.get_last_message_preview()
+    room.unread_count = room.get_unread_count(current_user)
+    return room
+
+
+def _annotate_presence(rooms, current_user):
+    """
+    Attach other_online to a page of rooms with one presence lookup
+    """
+    online = room_presence(rooms, current_user)
+    for room in rooms:
+        room.other_online = online[room.id]
+
+
+def _messages_etag(room, request):
+    """
+    ETag for a messages API response; it only changes when a new message is
+    posted to the room or the query parameters change. last_message_id tells
+    apart messages stored within the same millisecond, which last_message_at
+    (kept for rooms without messages since it was added) cannot
+    """
+    last = room.last_message_id or room.last_message_at.isoformat()
+    key = f'{room.id}:{last}:{request.GET.urlencode()}'
+    return '"%s"' % hashlib.md5(key.encode('utf-8')).hexdigest()
 
 
 @login_required
@@ -15,36 +56,55 @@ def chat_home(request):
     """
     current_user = User.objects.get(id=str(request.user.id))
     
-    # Get all chat rooms where current user is participant
-    rooms_as_user1 = ChatRoom.objects(user1=current_user).order_by('-last_message_at')
-    rooms_as_user2 = ChatRoom.objects(user2=current_user).order_by('-last_message_at')
+    # First page of the user's rooms from one index-backed query
+    rooms, next_cursor = ChatRoom.get_rooms_for_user(current_user, limit=ROOMS_PAGE_SIZE)
     
-    # Combine and sort by last_message_at
-    all_rooms = list(rooms_as_user1) + list(rooms_as_user2)
-    all_rooms.sort(key=lambda x: x.last_message_at, reverse=True)
-    
-    # Add additional info to each room
-    for room in all_rooms:
-        room.other_user = room.get_other_user(current_user)
-        # Get last message
-        last_msg = Message.objects(room=room).order_by('-timestamp').first()
-        if last_msg:
-            room.last_message = last_msg.get_decrypted_content()[:50] + '...' if len(last_msg.get_decrypted_content()) > 50 else last_msg.get_decrypted_content()
-        else:
-            room.last_message = 'No messages yet'
-        
-        # Count unread messages
-        unread_count = Message.objects(room=room, is_read=False).filter(sender__ne=current_user).count()
-        room.unread_count = unread_count
+    # Inbox summaries are denormalized on the room, so no per-room queries
+    for room in rooms:
+        _annotate_room(room, current_user)
+    _annotate_presence(rooms, current_user)
     
     search_form = SearchUserForm()
     
     return render(request, 'chat/chat_home.html', {
-        'rooms': all_rooms,
+        'rooms': rooms,
+        'next_cursor': next_cursor,
         'search_form': search_form
     })
 
 
+@login_required
+def get_rooms_api(request):
+    """
+    API endpoint to get a page of chat rooms (for infinite scrolling)
+    """
+    current_user = User.objects.get(id=str(request.user.id))
+    
+    try:
+        rooms, next_cursor = ChatRoom.get_rooms_for_user(
+            current_user,
+            limit=ROOMS_PAGE_SIZE,
+            cursor=request.GET.get('cursor')
+        )
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    _annotate_presence(rooms, current_user)
+    rooms_data = []
+    for room in rooms:
+        _annotate_room(room, current_user)
+        rooms_data.append({
+            'id': str(room.id),
+            'other_user': room.other_user.username,
+            'last_message': room.last_message,
+            'last_message_at': room.last_message_at.strftime('%b %d, %Y %H:%M'),
+            'unread_count': room.unread_count,
+            'other_online': room.other_online
+        })
+    
+    return JsonResponse({'rooms': rooms_data, 'next_cursor': next_cursor})
+
+
 @login_required
 def search_user(request):
     """
@@ -104,26 +164,28 @@ def chat_room(request, room_id):
         if form.is_valid():
             content = form.cleaned_data['message']
             
-            # Create encrypted message
-            Message.create_message(room, current_user, content)
+            # Create encrypted message and update both users' live inboxes
+            message = Message.create_message(room, current_user, content)
+            notify_message_sent(room, message, current_user)
             
             messages.success(request, 'Message sent!')
             return redirect('chat_room', room_id=room_id)
     else:
         form = MessageForm()
     
-    # Get messages (decrypted)
-    chat_messages = room.get_messages(limit=100)
+    # Get the newest page of messages (decrypted)
+    chat_messages, prev_cursor, _ = room.get_messages_page(limit=MESSAGES_PAGE_SIZE)
     
-    # Mark unread messages as read
-    unread_messages = Message.objects(room=room, sender=other_user, is_read=False)
-    for msg in unread_messages:
-        msg.mark_as_read()
+    # Mark unread messages as read (watermark + one bulk update) and clear
+    # the badge on the user's other open inboxes
+    if room.mark_read(current_user):
+        notify_unread_count(current_user.id, room.id, 0)
     
     return render(request, 'chat/chat_room.html', {
         'room': room,
         'other_user': other_user,
         'messages': chat_messages,
+        'prev_cursor': prev_cursor,
         'form': form,
         'current_user': current_user
     })
@@ -132,7 +194,8 @@ def chat_room(request, room_id):
 @login_required
 def delete_chat(request, room_id):
     """
-    Delete a chat room and all its messages
+    Delete a chat room. The room is removed right away; its messages are
+    purged in the background by the purge_deleted_chats worker
     """
     current_user = User.objects.get(id=str(request.user.id))
     
@@ -144,11 +207,12 @@ def delete_chat(request, room_id):
             messages.error(request, 'You do not have access to this chat room.')
             return redirect('chat_home')
         
-        # Delete all messages in the room
-        Message.objects(room=room).delete()
+        # Mark the room deleted and queue its messages for purging
+        ChatRoomDeletion.schedule([room.id])
         
-        # Delete the room
-        room.delete()
+        # Close open sockets for the room so they drop their cached room,
+        # and take it out of both users' live inboxes
+        notify_room_deleted(room_id, room.participant_ids())
         
         messages.success(request, 'Chat deleted successfully!')
     except ChatRoom.DoesNotExist:
@@ -157,10 +221,61 @@ def delete_chat(request, room_id):
     return redirect('chat_home')
 
 
+def _message_json(msg, current_user):
+    """
+    JSON representation of a decrypted message for the messages APIs
+    """
+    return {
+        'id': str(msg.id),
+        'sender': msg.sender.username,
+        'content': msg.decrypted_content,
+        'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_current_user': str(msg.sender.id) == str(current_user.id)
+    }
+
+
+def export_lines(room):
+    """
+    Plain-text transcript lines for a room export
+    """
+    for msg in room.export_messages():
+        yield f"[{msg.timestamp:%Y-%m-%d %H:%M:%S}] {msg.sender.username}: {msg.decrypted_content}\n"
+
+
+@login_required
+def export_chat(request, room_id):
+    """
+    Download the whole conversation as a plain-text transcript.
+    Streamed in batches, so long histories are never held in memory at once
+    """
+    current_user = User.objects.get(id=str(request.user.id))
+    
+    try:
+        room = ChatRoom.objects.get(id=ObjectId(room_id))
+        
+        # Verify access
+        if not room.has_participant(current_user):
+            messages.error(request, 'You do not have access to this chat room.')
+            return redirect('chat_home')
+        
+        other_user = room.get_other_user(current_user)
+        response = StreamingHttpResponse(export_lines(room), content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = f'attachment; filename="chat-{other_user.username}.txt"'
+        return response
+        
+    except ChatRoom.DoesNotExist:
+        messages.error(request, 'Chat room not found.')
+        return redirect('chat_home')
+
+
 @login_required
 def get_messages_api(request, room_id):
     """
-    API endpoint to get messages (for AJAX polling)
+    API endpoint to get messages (for AJAX polling and history scrolling).
+    Pass ?before=<cursor> for older messages, ?after=<cursor> for newer ones,
+    or ?since=<message_id> to poll for messages posted after a known message.
+    Responses carry an ETag; unchanged rooms answer If-None-Match with a 304
+    without querying or decrypting any messages
     """
     current_user = User.objects.get(id=str(request.user.id))
     
@@ -168,24 +283,81 @@ def get_messages_api(request, room_id):
         room = ChatRoom.objects.get(id=ObjectId(room_id))
         
         # Verify access
-        if str(room.user1.id) != str(current_user.id) and str(room.user2.id) != str(current_user.id):
+        if not room.has_participant(current_user):
             return JsonResponse({'error': 'Access denied'}, status=403)
         
-        # Get messages
-        messages_list = room.get_messages(limit=100)
-        
-        # Format for JSON
-        messages_data = []
-        for msg in messages_list:
-            messages_data.append({
-                'id': str(msg.id),
-                'sender': msg.sender.username,
-                'content': msg.decrypted_content,
-                'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                'is_current_user': str(msg.sender.id) == str(current_user.id)
-            })
-        
-        return JsonResponse({'messages': messages_data})
+        # Nothing posted since the client's copy: skip the message query entirely
+        etag = _messages_etag(room, request)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        
+        # Get one page of messages
+        try:
+            after = request.GET.get('after')
+            since = request.GET.get('since')
+            if since:
+                after = room.get_message_cursor(since)
+            
+            messages_list, prev_cursor, next_cursor = room.get_messages_page(
+                limit=MESSAGES_PAGE_SIZE,
+                before=request.GET.get('before'),
+                after=after
+            )
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        
+        response = JsonResponse({
+            'messages': [_message_json(msg, current_user) for msg in messages_list],
+            'prev_cursor': prev_cursor,
+            'next_cursor': next_cursor
+        })
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+        
+    except ChatRoom.DoesNotExist:
+        return JsonResponse({'error': 'Room not found'}, status=404)
+
+
+@login_required
+def search_messages_api(request, room_id):
+    """
+    Search a room's messages: ?q=<words> returns messages containing every
+    word, newest page first. Pages with the same before/after cursors as
+    get_messages_api; only matching messages are decrypted
+    """
+    current_user = User.objects.get(id=str(request.user.id))
+    
+    try:
+        room = ChatRoom.objects.get(id=ObjectId(room_id))
+        
+        # Verify access
+        if not room.has_participant(current_user):
+            return JsonResponse({'error': 'Access denied'}, status=403)
+        
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'error': 'Search query is required'}, status=400)
+        
+        try:
+            messages_list, prev_cursor, next_cursor = room.search_messages_page(
+                query,
+                limit=MESSAGES_PAGE_SIZE,
+                before=request.GET.get('before'),
+                after=request.GET.get('after')
+            )
+        except InvalidCursor:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        except InvalidSearchQuery as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        return JsonResponse({
+            'messages': [_message_json(msg, current_user) for msg in messages_list],
+            'prev_cursor': prev_cursor,
+            'next_cursor': next_cursor
+        })
         
     except ChatRoom.DoesNotExist:
         return JsonResponse({'error': 'Room not found'}, status=404)
@@ -0,0 +1,180 @@
+"""
+Write-behind buffer for chat messages.
+Lets the WebSocket consumer broadcast a message immediately and persist it
+in batches in the background (enabled with CHAT_WRITE_BEHIND)
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# Messages that could not be stored after max_attempts flushes
+DEAD_LETTER_COLLECTION = 'chat_message_dead_letters'
+
+
+class MessageWriteBehind:
+    """
+    Per-process queue of built-but-unsaved messages.
+    Pending messages are stored with one insert_many every flush_interval
+    seconds, or as soon as batch_size of them are waiting. At most max_pending
+    messages are buffered; further enqueue() calls wait for the next flush
+    (backpressure). A batch that fails is put back and retried, with
+    exponential backoff, using Message.bulk_create(retry=True), which skips
+    what was already stored and recomputes room summaries. Messages still
+    failing after max_attempts are moved to the dead-letter collection so
+    they cannot block everything queued behind them. Anything still pending
+    at interpreter exit is flushed synchronously
+    """
+
+    def __init__(self, flush_interval=0.05, batch_size=200, max_pending=10000, max_attempts=8, max_backoff=5.0):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.pending = []
+        self.failed = {}  # id -> failed attempts, for pending messages whose batch failed before
+        self.retry_at = 0.0  # monotonic time the next attempt after a failure may start
+        self.lock = threading.Lock()  # guards pending against the atexit flush
+        self._slots = None
+        self._wakeup = None
+        self._task = None
+        self._loop = None
+        atexit.register(self.flush_sync)
+
+    def _ensure_started(self):
+        """
+        Start the background flusher on the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_pending - len(self.pending))
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def enqueue(self, message):
+        """
+        Queue a message built with Message.build_message for storage
+        """
+        self._ensure_started()
+        await self._slots.acquire()
+        with self.lock:
+            self.pending.append(message)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _take_batch(self):
+        with self.lock:
+            batch = self.pending[:self.batch_size]
+            del self.pending[:self.batch_size]
+            retry = any(msg.id in self.failed for msg in batch)
+        return batch, retry
+
+    def _finish_batch(self, batch, stored):
+        """
+        Record the outcome of a batch. Returns the messages given up on
+        """
+        with self.lock:
+            if stored:
+                for msg in batch:
+                    self.failed.pop(msg.id, None)
+                return []
+
+            retry, dead = [], []
+            for msg in batch:
+                self.failed[msg.id] = self.failed.get(msg.id, 0) + 1
+                if self.failed[msg.id] >= self.max_attempts:
+                    del self.failed[msg.id]
+                    dead.append(msg)
+                else:
+                    retry.append(msg)
+            # Put the rest back so it is retried, after a growing pause
+            self.pending[:0] = retry
+            attempts = max((self.failed[msg.id] for msg in retry), default=0)
+            self.retry_at = time.monotonic() + min(self.flush_interval * 2 ** attempts, self.max_backoff)
+        return dead
+
+    def _dead_letter(self, messages):
+        """
+        Keep messages that could not be stored (still encrypted) for inspection or replay
+        """
+        logger.error('Giving up on storing %d chat message(s) after %d attempts: %s',
+                     len(messages), self.max_attempts, [str(msg.id) for msg in messages])
+        try:
+            collection = Message._get_collection().database[DEAD_LETTER_COLLECTION]
+            collection.insert_many([msg.to_mongo().to_dict() for msg in messages], ordered=False)
+        except Exception:
+            logger.exception('Could not write %d chat message(s) to %s', len(messages), DEAD_LETTER_COLLECTION)
+
+    async def flush(self):
+        """
+        Store pending messages in batches until the buffer is empty
+        """
+        if time.monotonic() < self.retry_at:
+            return
+        while True:
+            batch, retry = self._take_batch()
+            if not batch:
+                return
+            try:
+                await sync_to_async(Message.bulk_create, thread_sensitive=False)(batch, retry=retry)
+            except Exception:
+                logger.exception('Error flushing %d chat message(s)', len(batch))
+                dead = self._finish_batch(batch, stored=False)
+                if dead:
+                    await sync_to_async(self._dead_letter, thread_sensitive=False)(dead)
+                    for _ in dead:
+                        self._slots.release()
+                return
+            self._finish_batch(batch, stored=True)
+            for _ in batch:
+                self._slots.release()
+
+    def flush_sync(self):
+        """
+        Synchronously store everything still pending (used at shutdown)
+        """
+        with self.lock:
+            batch, self.pending = self.pending, []
+            retry = any(msg.id in self.failed for msg in batch)
+        if batch:
+            try:
+                Message.bulk_create(batch, retry=retry)
+            except Exception:
+                logger.exception('Error flushing %d chat message(s) at shutdown', len(batch))
+                self._dead_letter(batch)
+
+
+_write_behind = None
+
+
+def get_write_behind():
+    """
+    Get the per-process write-behind buffer configured from settings
+    """
+    global _write_behind
+    if _write_behind is None:
+        _write_behind = MessageWriteBehind(
+            flush_interval=settings.CHAT_WRITE_BEHIND_INTERVAL_MS / 1000,
+            batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+            max_attempts=settings.CHAT_WRITE_BEHIND_MAX_ATTEMPTS
+        )
+    return _write_behind